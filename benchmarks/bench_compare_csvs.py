@@ -0,0 +1,144 @@
+"""
+Benchmarks the primary key diff engine against the old diff + regex implementation
+of compare_csvs on a synthetic sales_order table.
+
+Usage:
+    PYTHONPATH=$(pwd) python benchmarks/bench_compare_csvs.py --rows 1000000
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import re
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from src.utils.diff_utils import diff_snapshots
+
+header = [
+    "sales_order_id",
+    "created_at",
+    "last_updated",
+    "design_id",
+    "staff_id",
+    "counterparty_id",
+    "units_sold",
+    "unit_price",
+    "currency_id",
+    "agreed_delivery_date",
+    "agreed_payment_date",
+    "agreed_delivery_location_id",
+]
+
+
+def sales_order_row(sales_order_id, rng, updated):
+    created_at = datetime(2022, 11, 3, 14, 20, 52) + timedelta(minutes=sales_order_id)
+    last_updated = created_at + timedelta(days=1) if updated else created_at
+    delivery_date = created_at.date() + timedelta(days=rng.randint(1, 30))
+    return [
+        sales_order_id,
+        created_at.isoformat(sep=" ", timespec="milliseconds"),
+        last_updated.isoformat(sep=" ", timespec="milliseconds"),
+        rng.randint(1, 300),
+        rng.randint(1, 20),
+        rng.randint(1, 20),
+        rng.randint(1000, 100000),
+        f"{rng.uniform(2, 4):.2f}",
+        rng.randint(1, 3),
+        delivery_date.isoformat(),
+        (delivery_date + timedelta(days=rng.randint(1, 30))).isoformat(),
+        rng.randint(1, 30),
+    ]
+
+
+def write_snapshots(directory, rows, churn, seed):
+    """
+    Writes an original snapshot and a new snapshot where churn of the rows have
+    been updated, deleted or inserted (a third each).
+    """
+    rng = random.Random(seed)
+    changed = int(rows * churn) // 3
+    updated = set(rng.sample(range(1, rows + 1), changed))
+    deleted = set(rng.sample(range(1, rows + 1), changed)) - updated
+    old_path = os.path.join(directory, "sales_order.csv")
+    new_path = os.path.join(directory, "sales_order_new.csv")
+    with open(old_path, "w", newline="") as old, open(new_path, "w", newline="") as new:
+        old_writer, new_writer = csv.writer(old), csv.writer(new)
+        old_writer.writerow(header)
+        new_writer.writerow(header)
+        for sales_order_id in range(1, rows + 1):
+            row_seed = rng.random()
+            old_writer.writerow(sales_order_row(sales_order_id, random.Random(row_seed), False))
+            if sales_order_id not in deleted:
+                is_updated = sales_order_id in updated
+                new_writer.writerow(sales_order_row(sales_order_id, random.Random(row_seed), is_updated))
+        for sales_order_id in range(rows + 1, rows + changed + 1):
+            new_writer.writerow(sales_order_row(sales_order_id, rng, False))
+    return old_path, new_path
+
+
+def legacy_compare_csvs(csv1, csv2):
+    """
+    The change detection of the original compare_csvs, minus its database calls.
+    """
+    regex = r'(> ([A-Za-z,0-9]+))|(\\ ([A-Za-z,0-9]+))'
+    diff_output = subprocess.run(["diff", csv1, csv2], capture_output=True, text=True).stdout
+    differences = subprocess.run(["echo", diff_output], capture_output=True, text=True)
+    changes_to_table = re.findall(regex, differences.stdout)
+    return [[k for k in list(change) if not '' == k][1].split(',') for change in changes_to_table]
+
+
+def primary_key_compare_csvs(csv1, csv2, partitions):
+    return list(diff_snapshots(csv1, csv2, "sales_order_id", partitions))
+
+
+def measure(function, *args):
+    """
+    Times function in one run and measures its peak python memory in another, as
+    tracemalloc slows down python code a lot more than the legacy subprocesses and
+    would skew the comparison.
+    """
+    try:
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        tracemalloc.start()
+        try:
+            function(*args)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    except OSError as e:
+        # The legacy implementation passes the whole diff to echo as a single
+        # argument, which fails once the diff is bigger than the kernel's limit
+        return {"error": str(e)}
+    return {"seconds": round(seconds, 3), "python_peak_mb": round(peak / 2**20, 1), "changes": len(result)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--churn", type=float, default=0.01)
+    parser.add_argument("--partitions", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        old_path, new_path = write_snapshots(directory, args.rows, args.churn, args.seed)
+        results = {
+            "rows": args.rows,
+            "churn": args.churn,
+            "legacy_diff_regex": measure(legacy_compare_csvs, old_path, new_path),
+            "primary_key_hash_join": measure(primary_key_compare_csvs, old_path, new_path, 1),
+            f"primary_key_hash_join_{args.partitions}_partitions": measure(
+                primary_key_compare_csvs, old_path, new_path, args.partitions
+            ),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
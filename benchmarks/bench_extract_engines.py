@@ -0,0 +1,69 @@
+"""
+Compares the throughput (rows/sec) of the extraction engines against a local
+Postgres. Uploads go to a moto mocked bucket, so the numbers measure the database
+read and csv encoding rather than the network to S3.
+
+Uses the same PG_* environment variables as the test suite, for example:
+    export ENV=testing
+    PYTHONPATH=$(pwd) python benchmarks/bench_extract_engines.py --tables sales_order payment
+"""
+import argparse
+import json
+import os
+import time
+import boto3
+from dotenv import load_dotenv, find_dotenv
+from moto import mock_aws
+from src.utils.extract_utils import ConnectionPool, data_tables, extraction_engines
+
+env_file = find_dotenv(f'.env.{os.getenv("ENV")}')
+load_dotenv(env_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tables", nargs="+", default=data_tables)
+    parser.add_argument("--engines", nargs="+", default=list(extraction_engines))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    credentials = {
+        "user": os.getenv("PG_USER"),
+        "password": os.getenv("PG_PASSWORD"),
+        "host": os.getenv("PG_HOST"),
+        "database": os.getenv("PG_DATABASE"),
+        "port": os.getenv("PG_PORT"),
+    }
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-2")
+    results = {}
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket="totesys-raw-data-benchmark",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        pool = ConnectionPool(credentials, 1)
+        try:
+            for table in args.tables:
+                results[table] = {}
+                for engine in args.engines:
+                    best = None
+                    for _ in range(args.repeat):
+                        start = time.perf_counter()
+                        result = extraction_engines[engine](
+                            pool, s3, "totesys-raw-data-benchmark", table, f"{engine}/{table}.csv"
+                        )
+                        seconds = time.perf_counter() - start
+                        best = seconds if best is None else min(best, seconds)
+                    results[table][engine] = {
+                        "rows": result["rows"],
+                        "seconds": round(best, 4),
+                        "rows_per_sec": round(result["rows"] / best) if best else None,
+                    }
+        finally:
+            pool.close()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+DROP DATABASE test_warehouse;
+
+CREATE DATABASE test_warehouse;
+
+\c test_warehouse
+
+CREATE TABLE "dim_date" (
+  "date_id" date PRIMARY KEY NOT NULL,
+  "year" int NOT NULL,
+  "month" int NOT NULL,
+  "day" int NOT NULL,
+  "day_of_week" int NOT NULL,
+  "day_name" varchar NOT NULL,
+  "month_name" varchar NOT NULL,
+  "quarter" int NOT NULL
+);
+
+CREATE TABLE "dim_staff" (
+  "staff_id" int PRIMARY KEY NOT NULL,
+  "first_name" varchar NOT NULL,
+  "last_name" varchar NOT NULL,
+  "department_name" varchar NOT NULL,
+  "location" varchar NOT NULL,
+  "email_address" varchar NOT NULL
+);
+
+CREATE TABLE "dim_location" (
+  "location_id" int PRIMARY KEY NOT NULL,
+  "address_line_1" varchar NOT NULL,
+  "address_line_2" varchar,
+  "district" varchar,
+  "city" varchar NOT NULL,
+  "postal_code" varchar NOT NULL,
+  "country" varchar NOT NULL,
+  "phone" varchar NOT NULL
+);
+
+CREATE TABLE "dim_design" (
+  "design_id" int PRIMARY KEY NOT NULL,
+  "design_name" varchar NOT NULL,
+  "file_location" varchar NOT NULL,
+  "file_name" varchar NOT NULL
+);
+
+CREATE TABLE "dim_currency" (
+  "currency_id" int PRIMARY KEY NOT NULL,
+  "currency_code" varchar NOT NULL,
+  "currency_name" varchar NOT NULL
+);
+
+CREATE TABLE "dim_counterparty" (
+  "counterparty_id" int PRIMARY KEY NOT NULL,
+  "counterparty_legal_name" varchar NOT NULL,
+  "counterparty_legal_address_line_1" varchar NOT NULL,
+  "counterparty_legal_address_line_2" varchar,
+  "counterparty_legal_district" varchar,
+  "counterparty_legal_city" varchar NOT NULL,
+  "counterparty_legal_postal_code" varchar NOT NULL,
+  "counterparty_legal_country" varchar NOT NULL,
+  "counterparty_legal_phone_number" varchar NOT NULL
+);
+
+CREATE TABLE "fact_sales_order" (
+  "sales_record_id" SERIAL PRIMARY KEY,
+  "sales_order_id" int NOT NULL,
+  "created_date" date NOT NULL REFERENCES "dim_date" ("date_id"),
+  "created_time" time NOT NULL,
+  "last_updated_date" date NOT NULL REFERENCES "dim_date" ("date_id"),
+  "last_updated_time" time NOT NULL,
+  "sales_staff_id" int NOT NULL REFERENCES "dim_staff" ("staff_id"),
+  "counterparty_id" int NOT NULL REFERENCES "dim_counterparty" ("counterparty_id"),
+  "units_sold" int NOT NULL,
+  "unit_price" numeric(10, 2) NOT NULL,
+  "currency_id" int NOT NULL REFERENCES "dim_currency" ("currency_id"),
+  "design_id" int NOT NULL REFERENCES "dim_design" ("design_id"),
+  "agreed_payment_date" date NOT NULL REFERENCES "dim_date" ("date_id"),
+  "agreed_delivery_date" date NOT NULL REFERENCES "dim_date" ("date_id"),
+  "agreed_delivery_location_id" int NOT NULL REFERENCES "dim_location" ("location_id"),
+  "version" int NOT NULL,
+  "valid_from" timestamp NOT NULL,
+  "valid_to" timestamp,
+  "is_deleted" boolean NOT NULL
+);
+
+CREATE TABLE "fact_purchase_orders" (
+  "purchase_record_id" SERIAL PRIMARY KEY,
+  "purchase_order_id" int NOT NULL,
+  "created_date" date NOT NULL REFERENCES "dim_date" ("date_id"),
+  "created_time" time NOT NULL,
+  "last_updated_date" date NOT NULL REFERENCES "dim_date" ("date_id"),
+  "last_updated_time" time NOT NULL,
+  "staff_id" int NOT NULL REFERENCES "dim_staff" ("staff_id"),
+  "counterparty_id" int NOT NULL REFERENCES "dim_counterparty" ("counterparty_id"),
+  "item_code" varchar NOT NULL,
+  "item_quantity" int NOT NULL,
+  "item_unit_price" numeric NOT NULL,
+  "currency_id" int NOT NULL REFERENCES "dim_currency" ("currency_id"),
+  "agreed_delivery_date" date NOT NULL,
+  "agreed_payment_date" date NOT NULL,
+  "agreed_delivery_location_id" int NOT NULL REFERENCES "dim_location" ("location_id"),
+  "version" int NOT NULL,
+  "valid_from" timestamp NOT NULL,
+  "valid_to" timestamp,
+  "is_deleted" boolean NOT NULL
+);
+
+CREATE TABLE "fact_payment" (
+  "payment_record_id" SERIAL PRIMARY KEY,
+  "payment_id" int NOT NULL,
+  "created_date" date NOT NULL REFERENCES "dim_date" ("date_id"),
+  "created_time" time NOT NULL,
+  "last_updated_date" date NOT NULL REFERENCES "dim_date" ("date_id"),
+  "last_updated_time" time NOT NULL,
+  "transaction_id" int NOT NULL,
+  "counterparty_id" int NOT NULL REFERENCES "dim_counterparty" ("counterparty_id"),
+  "payment_amount" numeric NOT NULL,
+  "currency_id" int NOT NULL REFERENCES "dim_currency" ("currency_id"),
+  "payment_type_id" int NOT NULL,
+  "paid" boolean NOT NULL,
+  "payment_date" date NOT NULL,
+  "company_ac_number" int NOT NULL,
+  "counterparty_ac_number" int NOT NULL,
+  "version" int NOT NULL,
+  "valid_from" timestamp NOT NULL,
+  "valid_to" timestamp,
+  "is_deleted" boolean NOT NULL
+);
+
+CREATE TABLE "pipeline_freshness" (
+  "pipeline_freshness_id" SERIAL PRIMARY KEY,
+  "time_prefix" varchar NOT NULL,
+  "table_name" varchar NOT NULL,
+  "rows" int NOT NULL,
+  "source_last_updated" timestamp,
+  "extracted_at" timestamp NOT NULL,
+  "processed_at" timestamp,
+  "loaded_at" timestamp NOT NULL,
+  "extract_lag_seconds" numeric,
+  "transform_lag_seconds" numeric,
+  "load_lag_seconds" numeric,
+  "lag_p50_seconds" numeric,
+  "lag_p90_seconds" numeric,
+  "lag_p99_seconds" numeric,
+  "lag_max_seconds" numeric
+);
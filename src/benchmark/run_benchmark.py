@@ -0,0 +1,355 @@
+"""
+End to end benchmark of the pipeline on synthetic data. Fills the source database
+with generated tables, extracts a first snapshot, churns the data, then times the
+extract, transform and load of the changes. Reports seconds, rows, rows per second
+and peak RSS for every stage as JSON, so results can be compared between commits.
+
+    python -m src.benchmark.run_benchmark --rows 100000 --churn 0.01
+
+Needs a local Postgres with the source tables (database/test_db.sql) and the
+warehouse tables (database/test_warehouse.sql), reached with the PG_* variables of
+.env.{ENV}. The warehouse database is WAREHOUSE_DATABASE, test_warehouse unless
+set. S3 and Secrets Manager are mocked in process with moto, unless --endpoint-url
+points at a moto server, optionally with --s3-endpoint-url pointing S3 at MinIO.
+With --storage-backend local, the buckets are directories under --storage-root, a
+temporary directory unless given, instead of S3, see storage_utils.
+
+With --components-only, compare_csvs, the snapshot index diff and
+convert_csv_to_parquet are timed on the generated sales orders alone, without
+Postgres. With --parquet-profiles, every parquet profile of transform_utils is
+compared on the generated tables and the warehouse tables built from them
+instead: the size of the files, and the write and read throughput.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from io import BytesIO
+from datetime import datetime, timezone
+import boto3
+import numpy as np
+import polars as pl
+from dotenv import load_dotenv, find_dotenv
+from moto import mock_aws
+from src.benchmark.synthetic_data import generate_tables, churn, apply_churn, seed_database, churn_database
+from src.lambda_functions.extract import lambda_handler as extract
+from src.lambda_functions.transform import lambda_handler as transform
+from src.lambda_functions.load import lambda_handler as load
+from src.utils.cache_utils import clear_cache
+from src.utils.diff_utils import index_rows, build_index, encode_index, diff_batch
+from src.utils.extract_utils import compare_csvs, connect_to_db
+from src.utils.load_utils import warehouse_secret_name, warehouse_tables
+from src.utils.storage_utils import LocalStorage, default_backend, get_storage
+from src.utils.transform_utils import (
+    convert_csv_to_parquet, parquet_options, parquet_profiles, tables_parquet_profile, star_schema, build_star_table
+)
+
+raw_data_bucket = "totesys-raw-data-benchmark"
+processed_data_bucket = "totesys-processed-data-benchmark"
+
+
+def peak_rss_mb():
+    """Peak resident set size of the process so far, which only ever goes up."""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def timed(report, stage, function, count_rows):
+    """
+    Runs function as a stage of the benchmark and adds its timing to the report.
+
+    Args:
+        count_rows (callable): given the stage's result, returns the rows it handled
+
+    Returns:
+        the function's result
+    """
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    rows = count_rows(result)
+    report["stages"][stage] = {
+        "seconds": round(seconds, 4),
+        "rows": rows,
+        "rows_per_sec": round(rows / seconds) if rows and seconds else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print(f"{stage}: {report['stages'][stage]}")
+    return result
+
+
+def total_rows(tables):
+    return sum(df.height for df in tables.values())
+
+
+def changed_rows(changes):
+    return sum(change["updated"].height + change["inserted"].height for change in changes.values())
+
+
+def database_credentials(database):
+    return {
+        "user": os.getenv("PG_USER"),
+        "password": os.getenv("PG_PASSWORD"),
+        "host": os.getenv("PG_HOST") or "localhost",
+        "database": database,
+        "port": int(os.getenv("PG_PORT") or 5432),
+    }
+
+
+def create_services(source, warehouse):
+    """
+    Creates the data buckets, in the storage backend picked with STORAGE_BACKEND,
+    and the database secrets the lambda functions look for.
+    """
+    storage = get_storage()
+    if isinstance(storage, LocalStorage):
+        for bucket in [raw_data_bucket, processed_data_bucket]:
+            os.makedirs(os.path.join(storage.root, bucket), exist_ok=True)
+    else:
+        s3 = boto3.client("s3", region_name="eu-west-2")
+        existing = [bucket["Name"] for bucket in s3.list_buckets()["Buckets"]]
+        for bucket in [raw_data_bucket, processed_data_bucket]:
+            if bucket not in existing:
+                s3.create_bucket(Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+    secrets = boto3.client("secretsmanager", region_name="eu-west-2")
+    for name, credentials in [("totesys_database_credentials", source), (warehouse_secret_name, warehouse)]:
+        try:
+            secrets.create_secret(Name=name, SecretString=json.dumps(credentials))
+        except secrets.exceptions.ResourceExistsException:
+            secrets.put_secret_value(SecretId=name, SecretString=json.dumps(credentials))
+
+
+def benchmark_components(report, tables, churned):
+    """Times the pieces that scale with table size on the sales orders, in memory and the storage."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tables["sales_order"].write_csv(f"{tmp_dir}/original.csv")
+        churned["sales_order"].write_csv(f"{tmp_dir}/new.csv")
+        timed(
+            report, "compare_csvs",
+            lambda: compare_csvs(f"{tmp_dir}/original.csv", f"{tmp_dir}/new.csv", "sales_order_id", tmp_dir),
+            lambda _: churned["sales_order"].height,
+        )
+        with open(f"{tmp_dir}/new.csv", "rb") as f, get_storage().writer(raw_data_bucket, "/benchmark/sales_order.csv") as writer:
+            shutil.copyfileobj(f, writer)
+    benchmark_snapshot_index(report, tables["sales_order"], churned["sales_order"])
+    timed(
+        report, "convert_csv_to_parquet",
+        lambda: convert_csv_to_parquet("/benchmark/sales_order.csv"),
+        lambda _: churned["sales_order"].height,
+    )
+
+
+def benchmark_snapshot_index(report, original, new):
+    """
+    Times building the snapshot index of the original sales orders, hashing the
+    churned ones and diffing them against it, and reports the index's size.
+    """
+    def csv_rows(df):
+        return df.cast(pl.String).fill_null("").rows()
+
+    def build():
+        rows = csv_rows(original)
+        keys, hashes = index_rows(rows, 0)
+        return build_index(["original.csv"], keys, hashes, np.zeros(len(rows), dtype=np.uint32))
+
+    index = timed(report, "index_snapshot", build, lambda _: original.height)
+    report["index_bytes"] = len(encode_index(index))
+
+    keys, hashes = timed(report, "hash_rows", lambda: index_rows(csv_rows(new), 0), lambda _: new.height)
+    timed(
+        report, "diff_index",
+        lambda: diff_batch(index, keys, hashes, np.zeros(len(index["keys"]), dtype=bool)),
+        lambda _: new.height,
+    )
+
+
+def benchmark_parquet_profiles(report, tables):
+    """
+    Writes every generated table and the warehouse tables built from them to
+    memory with each parquet profile, and with each table's own settings as
+    "tables", then reads them back.
+    """
+    tables = {
+        **tables,
+        **{
+            table_name: build_star_table(table_name, {source: tables[source].lazy() for source in spec["sources"]}).collect()
+            for table_name, spec in star_schema.items()
+        },
+    }
+    in_memory_mb = sum(df.estimated_size("mb") for df in tables.values())
+    rows = total_rows(tables)
+    results = {}
+    for profile in [*parquet_profiles, tables_parquet_profile]:
+        written = {}
+        start = time.perf_counter()
+        for table_name, df in tables.items():
+            buffer = BytesIO()
+            df.write_parquet(buffer, **parquet_options(table_name, profile))
+            written[table_name] = buffer.getvalue()
+        write_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for data in written.values():
+            pl.read_parquet(BytesIO(data))
+        read_seconds = time.perf_counter() - start
+        result = {
+            "bytes": sum(len(data) for data in written.values()),
+            "write_seconds": round(write_seconds, 4),
+            "read_seconds": round(read_seconds, 4),
+            "write_rows_per_sec": round(rows / write_seconds),
+            "read_rows_per_sec": round(rows / read_seconds),
+            "write_mb_per_sec": round(in_memory_mb / write_seconds, 1),
+            "read_mb_per_sec": round(in_memory_mb / read_seconds, 1),
+        }
+        print(f"{profile}: {result}")
+        result["table_bytes"] = {table_name: len(data) for table_name, data in written.items()}
+        results[profile] = result
+    report["parquet_profiles"] = results
+
+
+def benchmark_pipeline(report, tables, changes, event):
+    """Times every stage of the pipeline against the local Postgres."""
+    source = connect_to_db(database_credentials(os.getenv("PG_DATABASE")))
+    warehouse = connect_to_db(database_credentials(os.getenv("WAREHOUSE_DATABASE") or "test_warehouse"))
+    try:
+        # Facts are appended, so the previous benchmark's rows are cleared first
+        warehouse.run(f"TRUNCATE {', '.join(warehouse_tables)} RESTART IDENTITY CASCADE")
+        timed(report, "seed_database", lambda: seed_database(source, tables), lambda _: total_rows(tables))
+        snapshot = timed(report, "extract_snapshot", lambda: extract(event, None), lambda _: total_rows(tables))
+        timed(report, "churn_database", lambda: churn_database(source, changes), lambda _: changed_rows(changes))
+    finally:
+        source.close()
+        warehouse.close()
+
+    # The first snapshot fills the warehouse, so the changes are loaded on top of it
+    transform_and_load(report, snapshot, "_snapshot")
+    extracted = timed(
+        report, "extract", lambda: extract(event, None), lambda _: total_rows(tables) + changed_rows(changes)
+    )
+    transformed, loaded = transform_and_load(report, extracted)
+    report["details"] = {
+        "changed_tables": extracted["changed_tables"],
+        "failed_tables": {
+            "extract": extracted["failed_tables"],
+            "transform": transformed["failed_tables"],
+        },
+        "transform": transformed["timings"],
+        "load": loaded["loaded"],
+    }
+
+
+def transform_and_load(report, extracted, suffix=""):
+    """Times the transform and load of an extract's output."""
+    transformed = timed(
+        report, f"transform{suffix}",
+        lambda: transform({"time_prefix": extracted["time_prefix"], "output_format": extracted["output_format"]}, None),
+        lambda result: sum(timing.get("rows", 0) for timing in result["timings"].values()),
+    )
+    loaded = timed(
+        report, f"load{suffix}",
+        lambda: load({"time_prefix": extracted["time_prefix"], "source_last_updated": extracted["source_last_updated"]}, None),
+        lambda result: sum(table["rows"] for table in result["loaded"].values()),
+    )
+    return transformed, loaded
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(rows, seed=0, churn_fraction=0.01, event=None, components_only=False, parquet_profiles_only=False):
+    """
+    Runs the benchmark for rows sales orders, see the module docstring.
+
+    Returns:
+        dict: the benchmark's settings, environment and a timing for every stage
+    """
+    report = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "polars": pl.__version__,
+        "cpus": os.cpu_count(),
+        "rows": rows,
+        "seed": seed,
+        "churn": churn_fraction,
+        "event": event or {},
+        "storage_backend": os.getenv("STORAGE_BACKEND", default_backend),
+        "stages": {},
+    }
+    tables = timed(report, "generate", lambda: generate_tables(rows, seed), total_rows)
+    report["table_rows"] = {table_name: df.height for table_name, df in tables.items()}
+    if parquet_profiles_only:
+        benchmark_parquet_profiles(report, tables)
+        return report
+    changes = timed(report, "generate_churn", lambda: churn(tables, churn_fraction, seed + 1), changed_rows)
+
+    clear_cache()
+    create_services(
+        database_credentials(os.getenv("PG_DATABASE")),
+        database_credentials(os.getenv("WAREHOUSE_DATABASE") or "test_warehouse"),
+    )
+    benchmark_components(report, tables, apply_churn(tables, changes))
+    if not components_only:
+        benchmark_pipeline(report, tables, changes, event or {})
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000, help="sales orders to generate, 10k to 10M")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated data")
+    parser.add_argument("--churn", type=float, default=0.01, help="fraction of rows changed between extracts")
+    parser.add_argument("--mode", default="snapshot", help="extract mode, snapshot or incremental")
+    parser.add_argument("--engine", default="python", help="extraction engine")
+    parser.add_argument("--output-format", default="csv", help="raw file format, csv or parquet")
+    parser.add_argument("--concurrency", type=int, default=4, help="max_concurrency of extract")
+    parser.add_argument("--components-only", action="store_true", help="only time the diffs and convert_csv_to_parquet")
+    parser.add_argument("--parquet-profiles", action="store_true", help="only compare the parquet profiles")
+    parser.add_argument("--endpoint-url", help="AWS endpoint to use instead of moto in process, e.g. a moto server")
+    parser.add_argument("--s3-endpoint-url", help="S3 endpoint, e.g. MinIO, used with --endpoint-url")
+    parser.add_argument("--storage-backend", choices=["s3", "local"], default="s3", help="where the buckets are kept")
+    parser.add_argument("--storage-root", help="directory of the local storage backend's buckets")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    load_dotenv(find_dotenv(f'.env.{os.getenv("ENV")}'))
+    # The stage timings are in the report, so the handlers' metric lines aren't printed
+    os.environ.setdefault("METRICS_SINK", "local")
+    event = {
+        "mode": args.mode,
+        "engine": args.engine,
+        "output_format": args.output_format,
+        "max_concurrency": args.concurrency,
+    }
+
+    def run():
+        return run_benchmark(args.rows, args.seed, args.churn, event, args.components_only, args.parquet_profiles)
+
+    os.environ["STORAGE_BACKEND"] = args.storage_backend
+    if args.endpoint_url:
+        os.environ["AWS_ENDPOINT_URL"] = args.endpoint_url
+        if args.s3_endpoint_url:
+            os.environ["AWS_ENDPOINT_URL_S3"] = args.s3_endpoint_url
+    # The local backend keeps its buckets under STORAGE_ROOT, the s3 one ignores it
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ["STORAGE_ROOT"] = args.storage_root or tmp_dir
+        if args.endpoint_url:
+            report = run()
+        else:
+            with mock_aws():
+                report = run()
+
+    output = args.output or f"benchmark_results/{args.rows}_{datetime.now():%Y%m%dT%H%M%S}.json"
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Results written to {output}")
@@ -0,0 +1,388 @@
+"""
+Seeded generator of synthetic totesys data, shaped like database/test_db.sql, for
+benchmarking the pipeline at sizes the test database doesn't reach. The same size,
+seed and start time always give the same rows.
+"""
+from datetime import datetime, timedelta
+import numpy as np
+import polars as pl
+from pg8000.native import identifier
+from src.utils.diff_utils import primary_keys
+from src.utils.load_utils import copy_into, default_batch_size
+
+default_start = datetime(2022, 11, 3, 14, 20, 49)
+
+# Data in the source database spans about two years
+time_span = timedelta(days=730)
+
+first_names = ["Jeremie", "Deron", "Jeanette", "Ana", "Magdalena", "Korey", "Raphael", "Oswaldo", "Brody", "Jazmyn"]
+last_names = ["Franey", "Beier", "Erdman", "Glover", "Zieme", "Kreiger", "Rippin", "Bergnaum", "Ratke", "Kuhn"]
+streets = ["Gleason Mews", "Crona Groves", "Hessel Estates", "Okuneva Ville", "Lind Grove", "Runte Falls"]
+cities = ["New Patienceburgh", "Aliso Viejo", "Lake Charles", "Olsonside", "Fort Shadburgh", "Kendraburgh"]
+countries = ["Austria", "San Marino", "Cayman Islands", "Turkey", "Chad", "Antigua and Barbuda"]
+districts = ["Avon", "Bedfordshire", "Buckinghamshire", "Cambridgeshire", None]
+design_names = ["Wooden", "Steel", "Granite", "Bronze", "Soft", "Frozen", "Rubber", "Concrete", "Fresh", "Cotton"]
+department_names = ["Sales", "Purchasing", "Production", "Dispatch", "Finance", "Facilities", "Communications", "HR"]
+company_suffixes = ["Inc", "LLC", "Group", "and Sons", "Ltd"]
+currency_codes = ["GBP", "USD", "EUR"]
+payment_type_names = ["SALES_RECEIPT", "SALES_REFUND", "PURCHASE_PAYMENT", "PURCHASE_REFUND"]
+
+# How churn changes the rows it updates, the other tables' rows don't change in
+# the source database
+churn_updates = {
+    "sales_order": {"units_sold": pl.col("units_sold") + 100},
+    "purchase_order": {"item_quantity": pl.col("item_quantity") + 1},
+    "payment": {"paid": ~pl.col("paid")},
+    "staff": {"email_address": pl.col("email_address").str.replace("@", ".new@")},
+    "counterparty": {"delivery_contact": pl.col("delivery_contact") + " Jr"},
+    "address": {"phone": pl.col("phone").str.replace(" ", " 0")},
+    "design": {"file_location": pl.col("file_location") + "/v2"},
+    "department": {"manager": pl.col("manager") + " Jr"},
+}
+
+
+def table_sizes(rows):
+    """
+    Row counts of every table for a run with rows sales orders, keeping the
+    proportions of the source database: half as many purchase orders, and a
+    transaction and a payment for every order.
+    """
+    purchase_orders = max(1, rows // 2)
+    return {
+        "sales_order": rows,
+        "design": max(10, rows // 100),
+        "currency": len(currency_codes),
+        "staff": max(20, rows // 2000),
+        "counterparty": max(20, rows // 1000),
+        "address": max(30, rows // 1000),
+        "department": len(department_names),
+        "purchase_order": purchase_orders,
+        "payment_type": len(payment_type_names),
+        "payment": rows + purchase_orders,
+        "transaction": rows + purchase_orders,
+    }
+
+
+def timestamps(rng, n, start, span=time_span):
+    """n random timestamps between start and start + span, in ascending order."""
+    micros = np.sort(rng.integers(0, int(span.total_seconds() * 1_000_000), n))
+    return pl.Series(micros).cast(pl.Datetime("us")) + (start - datetime(1970, 1, 1))
+
+
+def pick(rng, values, n):
+    """n values drawn from a list."""
+    return pl.Series(values)[rng.integers(0, len(values), n)]
+
+
+def ids(rng, size, n):
+    """n random ids of a table with size rows, i.e. valid foreign keys."""
+    return pl.Series(rng.integers(1, size + 1, n), dtype=pl.Int64)
+
+
+def id_range(first_id, n):
+    return pl.int_range(first_id, first_id + n, eager=True, dtype=pl.Int64)
+
+
+def days_after(created_at, rng, low=2, high=14):
+    """Dates low to high days after created_at, as yyyy-mm-dd strings like the source."""
+    days = pl.Series(rng.integers(low, high, len(created_at)))
+    return pl.select((pl.lit(created_at) + pl.duration(days=pl.lit(days))).dt.strftime("%Y-%m-%d")).to_series()
+
+
+def codes(rng, n, length=7):
+    """n random codes of capital letters, like the source's item codes."""
+    letters = rng.integers(ord("A"), ord("Z") + 1, (n, length)).astype(np.uint8)
+    return pl.Series(np.frombuffer(letters.tobytes(), dtype=f"S{length}").astype(str))
+
+
+def numbers(rng, n, digits):
+    return pl.Series(rng.integers(10 ** (digits - 1), 10 ** digits, n))
+
+
+def names(rng, n):
+    return pick(rng, first_names, n) + " " + pick(rng, last_names, n)
+
+
+def with_timestamps(df, created_at):
+    return df.with_columns(created_at.alias("created_at"), created_at.alias("last_updated"))
+
+
+def generate_design(rng, sizes, first_id, n, created_at):
+    design_id = id_range(first_id, n)
+    name = pick(rng, design_names, n)
+    return with_timestamps(pl.DataFrame({"design_id": design_id}), created_at).with_columns(
+        design_name=name,
+        file_location=pl.lit("/") + pick(rng, ["usr", "opt", "home/user", "private"], n),
+        file_name=name.str.to_lowercase() + "-" + codes(rng, n, 12).str.to_lowercase() + ".json",
+    )
+
+
+def generate_currency(rng, sizes, first_id, n, created_at):
+    return pl.DataFrame({
+        "currency_id": id_range(first_id, n),
+        "currency_code": pl.Series(currency_codes * (n // len(currency_codes) + 1))[:n],
+        "created_at": created_at,
+        "last_updated": created_at,
+    })
+
+
+def generate_staff(rng, sizes, first_id, n, created_at):
+    first_name = pick(rng, first_names, n)
+    last_name = pick(rng, last_names, n)
+    staff_id = id_range(first_id, n)
+    return pl.DataFrame({
+        "staff_id": staff_id,
+        "first_name": first_name,
+        "last_name": last_name,
+        "department_id": ids(rng, sizes["department"], n),
+        "email_address": first_name.str.to_lowercase() + "." + last_name.str.to_lowercase()
+        + staff_id.cast(pl.String) + "@terrifictotes.com",
+        "created_at": created_at,
+        "last_updated": created_at,
+    })
+
+
+def generate_counterparty(rng, sizes, first_id, n, created_at):
+    return pl.DataFrame({
+        "counterparty_id": id_range(first_id, n),
+        "counterparty_legal_name": pick(rng, last_names, n) + " " + pick(rng, company_suffixes, n),
+        "legal_address_id": ids(rng, sizes["address"], n),
+        "commercial_contact": names(rng, n),
+        "delivery_contact": names(rng, n),
+        "created_at": created_at,
+        "last_updated": created_at,
+    })
+
+
+def generate_address(rng, sizes, first_id, n, created_at):
+    return pl.DataFrame({
+        "address_id": id_range(first_id, n),
+        "address_line_1": numbers(rng, n, 3).cast(pl.String) + " " + pick(rng, streets, n),
+        "address_line_2": pick(rng, [None, None, "Flat 1", "Suite 300"], n),
+        "district": pick(rng, districts, n),
+        "city": pick(rng, cities, n),
+        "postal_code": numbers(rng, n, 5).cast(pl.String),
+        "country": pick(rng, countries, n),
+        "phone": "1803 " + numbers(rng, n, 6).cast(pl.String),
+        "created_at": created_at,
+        "last_updated": created_at,
+    })
+
+
+def generate_department(rng, sizes, first_id, n, created_at):
+    return pl.DataFrame({
+        "department_id": id_range(first_id, n),
+        "department_name": pl.Series(department_names * (n // len(department_names) + 1))[:n],
+        "location": pick(rng, ["Manchester", "Leeds"], n),
+        "manager": names(rng, n),
+        "created_at": created_at,
+        "last_updated": created_at,
+    })
+
+
+def generate_sales_order(rng, sizes, first_id, n, created_at):
+    return pl.DataFrame({
+        "sales_order_id": id_range(first_id, n),
+        "created_at": created_at,
+        "last_updated": created_at,
+        "design_id": ids(rng, sizes["design"], n),
+        "staff_id": ids(rng, sizes["staff"], n),
+        "counterparty_id": ids(rng, sizes["counterparty"], n),
+        "units_sold": rng.integers(1000, 100001, n),
+        "unit_price": np.round(rng.uniform(2, 4, n), 2),
+        "currency_id": ids(rng, sizes["currency"], n),
+        "agreed_delivery_date": days_after(created_at, rng),
+        "agreed_payment_date": days_after(created_at, rng),
+        "agreed_delivery_location_id": ids(rng, sizes["address"], n),
+    })
+
+
+def generate_purchase_order(rng, sizes, first_id, n, created_at):
+    return pl.DataFrame({
+        "purchase_order_id": id_range(first_id, n),
+        "created_at": created_at,
+        "last_updated": created_at,
+        "staff_id": ids(rng, sizes["staff"], n),
+        "counterparty_id": ids(rng, sizes["counterparty"], n),
+        "item_code": codes(rng, n),
+        "item_quantity": rng.integers(1, 1001, n),
+        "item_unit_price": np.round(rng.uniform(1, 1000, n), 2),
+        "currency_id": ids(rng, sizes["currency"], n),
+        "agreed_delivery_date": days_after(created_at, rng),
+        "agreed_payment_date": days_after(created_at, rng),
+        "agreed_delivery_location_id": ids(rng, sizes["address"], n),
+    })
+
+
+def generate_payment_type(rng, sizes, first_id, n, created_at):
+    return pl.DataFrame({
+        "payment_type_id": id_range(first_id, n),
+        "payment_type_name": pl.Series(payment_type_names * (n // len(payment_type_names) + 1))[:n],
+        "created_at": created_at,
+        "last_updated": created_at,
+    })
+
+
+def generate_transaction(rng, first_id, sales_order, purchase_order):
+    """A transaction for every sales and purchase order, made when the order was."""
+    sales, purchases = sales_order.height, purchase_order.height
+    created_at = pl.concat([sales_order["created_at"], purchase_order["created_at"]])
+    return pl.DataFrame({
+        "transaction_id": id_range(first_id, sales + purchases),
+        "transaction_type": pl.Series(["SALE"] * sales + ["PURCHASE"] * purchases),
+        "sales_order_id": pl.concat([sales_order["sales_order_id"], pl.Series([None] * purchases, dtype=pl.Int64)]),
+        "purchase_order_id": pl.concat([pl.Series([None] * sales, dtype=pl.Int64), purchase_order["purchase_order_id"]]),
+        "created_at": created_at,
+        "last_updated": created_at,
+    })
+
+
+def generate_payment(rng, sizes, first_id, transaction):
+    """
+    A payment for every transaction, made when the transaction was: mostly receipts
+    for sales and payments for purchases, with the odd refund.
+    """
+    n = transaction.height
+    is_sale = transaction["transaction_type"] == "SALE"
+    created_at = transaction["created_at"]
+    return pl.DataFrame({
+        "payment_id": id_range(first_id, n),
+        "created_at": created_at,
+        "last_updated": created_at,
+        "transaction_id": transaction["transaction_id"],
+        "counterparty_id": ids(rng, sizes["counterparty"], n),
+        "payment_amount": np.round(rng.uniform(1, 100000, n), 2),
+        "currency_id": ids(rng, sizes["currency"], n),
+        "payment_type_id": pl.select(pl.when(pl.lit(is_sale)).then(1).otherwise(3)).to_series().cast(pl.Int64)
+        + pl.Series(rng.random(n) < 0.05).cast(pl.Int64),
+        "paid": rng.random(n) < 0.5,
+        "payment_date": days_after(created_at, rng),
+        "company_ac_number": numbers(rng, n, 8),
+        "counterparty_ac_number": numbers(rng, n, 8),
+    })
+
+
+# Generators of the tables that don't grow with the number of orders, called as
+# generator(rng, sizes, first_id, n, created_at)
+generators = {
+    "design": generate_design,
+    "currency": generate_currency,
+    "staff": generate_staff,
+    "counterparty": generate_counterparty,
+    "address": generate_address,
+    "department": generate_department,
+    "payment_type": generate_payment_type,
+}
+
+
+def generate_orders(rng, sizes, first_ids, sales_orders, purchase_orders, created_at):
+    """
+    Generates orders with the transaction and payment for each of them, made at
+    times drawn from created_at.
+
+    Returns:
+        dict: sales_order, purchase_order, transaction and payment data frames
+    """
+    def times(n):
+        return created_at[rng.integers(0, len(created_at), n)].sort()
+
+    sales = generate_sales_order(rng, sizes, first_ids["sales_order"], sales_orders, times(sales_orders))
+    purchases = generate_purchase_order(rng, sizes, first_ids["purchase_order"], purchase_orders, times(purchase_orders))
+    transaction = generate_transaction(rng, first_ids["transaction"], sales, purchases)
+    payment = generate_payment(rng, sizes, first_ids["payment"], transaction)
+    return {"sales_order": sales, "purchase_order": purchases, "transaction": transaction, "payment": payment}
+
+
+def generate_tables(rows, seed=0, start=default_start):
+    """
+    Generates every table of the source database for rows sales orders, with the
+    other tables sized by table_sizes. Foreign keys always point at existing rows.
+
+    Returns:
+        dict: table name to data frame, in the order of diff_utils.primary_keys
+    """
+    rng = np.random.default_rng(seed)
+    sizes = table_sizes(rows)
+    tables = {
+        table_name: generator(rng, sizes, 1, sizes[table_name], timestamps(rng, sizes[table_name], start, timedelta(days=30)))
+        for table_name, generator in generators.items()
+    }
+    first_ids = {table_name: 1 for table_name in sizes}
+    tables.update(generate_orders(
+        rng, sizes, first_ids, sizes["sales_order"], sizes["purchase_order"], timestamps(rng, rows, start)
+    ))
+    return {table_name: tables[table_name] for table_name in primary_keys}
+
+
+def churn(tables, fraction=0.01, seed=1, at=None):
+    """
+    Simulates the source database changing between two extracts: fraction of the
+    rows of the tables in churn_updates are updated, and fraction new orders are
+    placed, each with a transaction and a payment. Changed rows get last_updated
+    set to at.
+
+    Returns:
+        dict: table name to {"updated": ..., "inserted": ...} data frames
+    """
+    rng = np.random.default_rng(seed)
+    at = at or default_start + time_span
+    sizes = {table_name: df.height for table_name, df in tables.items()}
+
+    changes = {}
+    for table_name, updates in churn_updates.items():
+        df = tables[table_name]
+        rows = np.sort(rng.choice(df.height, max(1, int(df.height * fraction)), replace=False))
+        changes[table_name] = {
+            "updated": df[rows].with_columns(**updates).with_columns(pl.lit(at).cast(pl.Datetime("us")).alias("last_updated")),
+            "inserted": df.clear(),
+        }
+
+    new_orders = generate_orders(
+        rng, sizes, {table_name: size + 1 for table_name, size in sizes.items()},
+        max(1, int(sizes["sales_order"] * fraction)), max(1, int(sizes["purchase_order"] * fraction)),
+        timestamps(rng, 1, at, timedelta(seconds=1)),
+    )
+    for table_name, df in new_orders.items():
+        df = df.with_columns(pl.lit(at).cast(pl.Datetime("us")).alias(column) for column in ["created_at", "last_updated"])
+        changes.setdefault(table_name, {"updated": df.clear()})["inserted"] = df
+    return changes
+
+
+def apply_churn(tables, changes):
+    """
+    Returns the tables as they are after the churn, e.g. for the snapshot diffed
+    against the original one.
+    """
+    churned = {}
+    for table_name, df in tables.items():
+        if table_name not in changes:
+            churned[table_name] = df
+            continue
+        updated = df.update(changes[table_name]["updated"], on=primary_keys[table_name])
+        churned[table_name] = pl.concat([updated, changes[table_name]["inserted"]])
+    return churned
+
+
+def seed_database(conn, tables, batch_size=default_batch_size):
+    """
+    Replaces the rows of the source tables with the generated ones, using COPY.
+    The tables have to exist already, e.g. created with database/test_db.sql.
+    """
+    conn.run(f"TRUNCATE {', '.join(identifier(table_name) for table_name in tables)} RESTART IDENTITY")
+    for table_name, df in tables.items():
+        copy_into(conn, table_name, df, batch_size)
+
+
+def churn_database(conn, changes, batch_size=default_batch_size):
+    """
+    Applies churn to the source tables: updated rows are deleted and copied in
+    again with their new values, new rows are copied in.
+    """
+    for table_name, change in changes.items():
+        key = primary_keys[table_name]
+        if not change["updated"].is_empty():
+            conn.run(
+                f"DELETE FROM {identifier(table_name)} WHERE {identifier(key)} = ANY(:ids)",
+                ids=change["updated"][key].to_list(),
+            )
+        copy_into(conn, table_name, pl.concat([change["updated"], change["inserted"]]), batch_size)
@@ -1,9 +1,17 @@
-import boto3
 import logging
-import os
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pg8000.native import Error
-from src.utils.extract_utils import get_secret, create_and_upload_to_bucket, compare_csvs
-from src.utils.extract_utils import create_time_prefix_for_file, connect_to_bucket, connect_to_db
+from src.utils.extract_utils import extraction_engines, create_time_prefix_for_file, diff_table
+from src.utils.extract_utils import get_watermarks, save_watermarks, get_connection_pool
+from src.utils.extract_utils import get_watermark_keys, save_watermark_keys
+from src.utils.extract_utils import get_fingerprints, save_fingerprints, table_fingerprint
+from src.utils.extract_utils import get_cached_raw_data_bucket
+from src.utils.cache_utils import get_s3_client
+from src.utils.diff_utils import primary_keys, diff_parquet_snapshots
+from src.utils.metrics_utils import measure, reset_metrics, metrics_summary
+from src.utils.schema_utils import load_schema_catalog, table_columns, table_primary_key
+from src.utils.storage_utils import get_storage, run
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -22,6 +30,8 @@ data_tables = [
     "transaction",
 ]
 
+default_max_concurrency = 1
+
 """
 
 history/year/month/day/hh:mm:s/files with no prefix
@@ -64,68 +74,269 @@ def lambda_handler(event, context):
     """
     Wrapper function that allows us to run our utils functions together, and allows
     us to invoke them all in AWS
+
+    The event can contain:
+        mode (string): "snapshot" (default) queries every table in full and diffs it
+            against the last snapshot, "incremental" only queries rows whose
+            last_updated is newer than the table's saved watermark
+        full_snapshot (bool): forces a full snapshot of every table in incremental
+            mode, resetting the watermarks
+        max_concurrency (int): how many tables are extracted at the same time
+        db_pool_size (int): how many database connections are opened, defaults to
+            max_concurrency. Keep it low to protect the read-only replica.
+        engine (string): how tables are read and uploaded, "python" (default) loads
+            each table into memory, "cursor" streams it in batches from a
+            server-side cursor into an S3 multipart upload and "copy" streams the
+            csv produced by Postgres' COPY into an S3 multipart upload
+        output_format (string): "csv" (default) or "parquet". Parquet extracts are
+            streamed from a server-side cursor into typed, compressed parquet files
+            and override the engine setting
+        fingerprint (string): "keys" (default) compares each table's row count,
+            max last_updated and a hash of its primary keys with the last run's,
+            "counts" leaves out the hash and "off" always extracts every table
+
+    A table that fails to extract doesn't stop the others, failures are reported
+    per table in the returned failed_tables. An exception is only raised when the
+    database can't be reached or every table failed.
+
+    Tables whose fingerprint (see table_fingerprint) matches the one saved by the
+    last run are skipped entirely: nothing is queried, uploaded or diffed for them.
+    full_snapshot ignores the saved fingerprints.
+
+    The max last_updated of every table that changed is returned as
+    source_last_updated, which is passed through to the load function to measure
+    how far the warehouse is behind.
+
+    The secret, S3 client, bucket name and database connections are cached in the
+    container, so warm invocations skip the Secrets Manager call, the bucket
+    listing and the database handshake.
+
+    Every table's extract and diff is measured, see metrics_utils, and the totals
+    are returned as metrics.
     """
-    db_credentials = get_secret()
-    s3_client = boto3.client("s3")
-    raw_data_bucket = connect_to_bucket(s3_client)
+    reset_metrics()
+    incremental = event.get("mode", "snapshot") == "incremental"
+    full_snapshot = event.get("full_snapshot", False)
+    max_concurrency = max(1, int(event.get("max_concurrency", default_max_concurrency)))
+    db_pool_size = int(event.get("db_pool_size", max_concurrency))
+    engine = event.get("engine", "python")
+    output_format = event.get("output_format", "csv")
+    fingerprint_mode = event.get("fingerprint", "keys")
+    if output_format == "parquet":
+        engine = "parquet"
+    if engine not in extraction_engines:
+        raise Exception(f"Unknown extraction engine: {engine}")
+    s3_client = get_s3_client()
+    raw_data_bucket = get_cached_raw_data_bucket(s3_client)
     time_prefix = create_time_prefix_for_file()
-    bucket_content = s3_client.list_objects(Bucket=raw_data_bucket)
-    if bucket_content.get("Contents"):
-        bucket_files = [dict_["Key"] for dict_ in bucket_content["Contents"]]
-    else:
-        bucket_files = []
-    try:
-        conn = connect_to_db(db_credentials)
-        for data_table_name in data_tables:
-            print()
-            query = f"SELECT column_name FROM information_schema.columns WHERE table_name = '{data_table_name}';"
-            column_names = conn.run(query)
-            header = []
-            for column in column_names:
-                header.append(column[0])
-
-            query = f"SELECT * FROM {data_table_name};"
-            data_rows = conn.run(query)
-            file_data = [header] + data_rows
-
-            if f"/source/{data_table_name}/{data_table_name}_original.csv" not in bucket_files:
-                create_and_upload_to_bucket(
-                    file_data, s3_client, raw_data_bucket, data_table_name, True
-                )
-            else:
-                print("\n _ORIGINAL CSV FILES FOUND")
-                create_and_upload_to_bucket(
-                    file_data, s3_client, raw_data_bucket, data_table_name, False
-                )
-                # file_buffer = StringIO()
-                # csv.writer(file_buffer).writerows(file_data)
-                s3_client.download_file(Bucket=raw_data_bucket,
-                                        Key=f'/source/{data_table_name}/{data_table_name}_original.csv',
-                                        Filename=f'/tmp/{data_table_name}.csv')
-
-                s3_client.download_file(Bucket=raw_data_bucket,
-                                        Key=f'/source/{data_table_name}/{data_table_name}_new.csv',
-                                        Filename=f'/tmp/{data_table_name}_new.csv')
-
-                changes_csv = compare_csvs(f'/source/{data_table_name}/{data_table_name}_original.csv', f'/source/{data_table_name}/{data_table_name}_new.csv')
-
-                s3_client.upload_file(Bucket=raw_data_bucket, Filename=f"/tmp/{changes_csv}",
-                                      Key=f'/history/{data_table_name}/{changes_csv}')
-
-                os.remove(f'/tmp/{data_table_name}.csv')
-                os.remove(f'/tmp/{data_table_name}_new.csv')
-                # print(f"\n FILE BUFFER: {file_buffer}")
-
-                # file_to_save = bytes(file_to_save.getvalue(), encoding="utf-8")
-
-        logging.info(f"Successfully uploaded raw data to {raw_data_bucket}")
+    # Only the snapshots under /source/ are looked up, and the listing is paginated
+    # so tables past the first 1000 keys are still found
+    bucket_files = run(get_storage(s3_client).list(raw_data_bucket, "/source/"))
+    watermarks = get_watermarks(s3_client, raw_data_bucket) if incremental else {}
+    watermark_keys = get_watermark_keys(s3_client, raw_data_bucket) if incremental else {}
+    saved_fingerprints = {} if fingerprint_mode == "off" else get_fingerprints(s3_client, raw_data_bucket)
+    previous_fingerprints = {} if full_snapshot else saved_fingerprints
+    fingerprints = dict(saved_fingerprints)
 
+    try:
+        pool = get_connection_pool(db_pool_size)
+        with pool.connection() as conn:
+            catalog = load_schema_catalog(conn, s3_client, raw_data_bucket)
     except Error as e:
         logging.error(e)
         raise Exception(f"Connection to database failed: {e}")
 
-    finally:
-        if "conn" in locals():
-            conn.close()
+    failed_tables = {}
+    changed_tables = []
+    skipped_tables = []
+    latest_updates = {}
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {}
+        for data_table_name in data_tables:
+            watermark, seen_keys = None, None
+            if incremental and not full_snapshot:
+                watermark = watermarks.get(data_table_name)
+                seen_keys = watermark_keys.get(data_table_name)
+            future = executor.submit(
+                extract_table,
+                pool,
+                s3_client,
+                raw_data_bucket,
+                data_table_name,
+                bucket_files,
+                time_prefix,
+                watermark,
+                engine,
+                table_columns(catalog, data_table_name),
+                table_primary_key(catalog, data_table_name),
+                fingerprint_mode,
+                previous_fingerprints.get(data_table_name),
+                seen_keys,
+            )
+            futures[future] = data_table_name
+
+        for future in as_completed(futures):
+            data_table_name = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.error(f"Failed to extract {data_table_name}: {e}")
+                failed_tables[data_table_name] = str(e)
+                continue
+            new_watermark, changed = result["max_last_updated"], result["changed"]
+            if result["fingerprint"] is not None:
+                fingerprints[data_table_name] = result["fingerprint"]
+            if result["skipped"]:
+                skipped_tables.append(data_table_name)
+            if changed:
+                changed_tables.append(data_table_name)
+                latest_updates[data_table_name] = new_watermark
+            if incremental and new_watermark:
+                # Rows committed late at the same watermark add to the keys already seen at it
+                keys = result["watermark_keys"]
+                if new_watermark == watermarks.get(data_table_name) and not full_snapshot:
+                    keys = list(dict.fromkeys(watermark_keys.get(data_table_name, []) + keys))
+                # Only advance the watermark once the rows it covers are safely in S3. The
+                # keys are saved first, as keys without their watermark are never matched.
+                watermark_keys[data_table_name] = keys
+                save_watermark_keys(s3_client, raw_data_bucket, watermark_keys)
+                watermarks[data_table_name] = new_watermark
+                save_watermarks(s3_client, raw_data_bucket, watermarks)
+
+    if len(failed_tables) == len(data_tables):
+        raise Exception(f"Failed to extract any table: {failed_tables}")
+    if fingerprint_mode != "off" and fingerprints != saved_fingerprints:
+        save_fingerprints(s3_client, raw_data_bucket, fingerprints)
+
+    logging.info(f"Successfully uploaded raw data to {raw_data_bucket}")
+
+    return {
+        "time_prefix": time_prefix,
+        "output_format": output_format,
+        "failed_tables": failed_tables,
+        "changed_tables": [table for table in data_tables if table in changed_tables],
+        "skipped_tables": [table for table in data_tables if table in skipped_tables],
+        "source_last_updated": latest_updates,
+        "metrics": metrics_summary(),
+    }
+
+
+def extract_table(pool, s3_client, raw_data_bucket, data_table_name, bucket_files, time_prefix,
+                  watermark=None, engine="python", columns=None, primary_key=None,
+                  fingerprint_mode="off", previous_fingerprint=None, seen_keys=None):
+    """
+    Extracts a single table with the chosen extraction engine, either the rows
+    changed since the watermark or a full snapshot when there is no watermark.
+    The columns and primary key come from the schema catalog, seen_keys are the
+    keys of the rows already extracted at the watermark.
+
+    The first snapshot of a table is saved as the _original csv, and copied to
+    the table's history as this run's differences so it reaches the warehouse.
+    Later csv snapshots are diffed in memory against the row hashes of the
+    previous one (see diff_table) and only the changed rows are uploaded. Parquet
+    snapshots are saved as the _new file, compared against the original and then
+    replace it, see diff_against_original. A table whose fingerprint matches
+    previous_fingerprint is skipped, unless it has no _original snapshot to diff
+    against yet.
+
+    Returns:
+        dict: max_last_updated of the extracted rows, None if there were no rows,
+            the primary keys of the rows at it (watermark_keys),
+            whether a file of changed rows was written to the table's history
+            (changed), its fingerprint and whether it was skipped
+    """
+    extension = "parquet" if engine == "parquet" else "csv"
+    original_key = f"/source/{data_table_name}/{data_table_name}_original.{extension}"
+    fingerprint = None
+    if fingerprint_mode != "off":
+        with pool.connection() as conn:
+            fingerprint = table_fingerprint(conn, data_table_name, primary_key if fingerprint_mode == "keys" else None)
+        if fingerprint == previous_fingerprint and (watermark or original_key in bucket_files):
+            return {
+                "max_last_updated": None, "watermark_keys": [], "changed": False, "fingerprint": fingerprint, "skipped": True,
+            }
+
+    if not watermark and original_key in bucket_files and extension == "csv":
+        with measure("diff", data_table_name) as record:
+            result = diff_table(
+                pool, s3_client, raw_data_bucket, data_table_name,
+                f"/history/{data_table_name}/differences_{time_prefix}.csv", original_key,
+                columns, primary_key or primary_keys[data_table_name],
+            )
+            record["rows"] = result["rows"]
+            record["bytes_out"] = result["bytes"]
+        return {
+            "max_last_updated": result["max_last_updated"],
+            "watermark_keys": result["watermark_keys"],
+            "changed": result["changes"] > 0,
+            "fingerprint": fingerprint,
+            "skipped": False,
+        }
+
+    if watermark:
+        key = f"/history/{data_table_name}/differences_{time_prefix}.{extension}"
+    elif original_key not in bucket_files:
+        key = original_key
+    else:
+        key = f"/source/{data_table_name}/{data_table_name}_new.{extension}"
+
+    with measure("extract", data_table_name) as record:
+        result = extraction_engines[engine](
+            pool, s3_client, raw_data_bucket, data_table_name, key, watermark, columns,
+            primary_key or primary_keys[data_table_name], seen_keys if watermark else None,
+        )
+        record["rows"] = result["rows"]
+        record["bytes_out"] = result["bytes"]
+
+    changed = bool(watermark) and result["rows"] > 0
+    if key == original_key and result["rows"] > 0:
+        # Every row of the first snapshot is new to the warehouse, so it is also
+        # this run's differences file, which is all transform reads
+        run(get_storage(s3_client).copy(
+            raw_data_bucket, original_key, raw_data_bucket, f"/history/{data_table_name}/differences_{time_prefix}.{extension}"
+        ))
+        changed = True
+    elif not watermark and key != original_key:
+        changed = diff_against_original(s3_client, raw_data_bucket, data_table_name, time_prefix, extension, primary_key)
+
+    return {
+        "max_last_updated": result["max_last_updated"],
+        "watermark_keys": result["watermark_keys"],
+        "changed": changed,
+        "fingerprint": fingerprint,
+        "skipped": False,
+    }
+
+
+def diff_against_original(s3_client, raw_data_bucket, data_table_name, time_prefix, extension="parquet", primary_key=None):
+    """
+    Compares the _new parquet snapshot of a table against its _original snapshot and
+    uploads the changed rows as parquet to the table's history, under this run's
+    time prefix so the transform stage can find it. The _new snapshot then
+    replaces the _original, so the next run only finds the rows changed since this one.
+
+    Returns:
+        bool: whether any rows changed
+    """
+    import pyarrow.parquet as pq
 
-    return {"time_prefix": time_prefix}
+    original_key = f"/source/{data_table_name}/{data_table_name}_original.{extension}"
+    new_key = f"/source/{data_table_name}/{data_table_name}_new.{extension}"
+    storage = get_storage(s3_client)
+    with measure("diff", data_table_name) as record:
+        snapshots = run(storage.get_many(raw_data_bucket, [original_key, new_key]))
+        original, new = snapshots[original_key]["body"], snapshots[new_key]["body"]
+        record["bytes_in"] = len(original) + len(new)
+        changes = diff_parquet_snapshots(
+            BytesIO(original), BytesIO(new), primary_key or primary_keys[data_table_name]
+        )
+        if changes.num_rows:
+            buffer = BytesIO()
+            pq.write_table(changes, buffer, compression="zstd")
+            record["bytes_out"] = run(storage.put(
+                raw_data_bucket, f"/history/{data_table_name}/differences_{time_prefix}.{extension}", buffer.getvalue()
+            ))
+            # Only replaced once the changed rows are safely in S3
+            run(storage.put(raw_data_bucket, original_key, new))
+        run(storage.delete(raw_data_bucket, [new_key]))
+    return changes.num_rows > 0
@@ -1,2 +1,76 @@
+import logging
+from pg8000.native import Error
+from src.utils.cache_utils import get_s3_client
+from src.utils.extract_utils import get_cached_secret, connect_to_db
+from src.utils.freshness_utils import freshness_report, record_freshness, source_last_updated
+from src.utils.load_utils import (
+    default_batch_size, default_prefetch, warehouse_secret_name, warehouse_tables, prefetch_processed_files, load_table
+)
+from src.utils.metrics_utils import reset_metrics, metrics_summary
+from src.utils.transform_utils import get_data_buckets, processed_key
+
+
 def lambda_handler(event, context):
-    return "hello"
+    """
+    Loads the processed parquet files written for a time prefix into the warehouse
+    star schema, dimensions first and then facts. Tables without a file for the
+    time prefix are skipped.
+
+    The Step Function loads each table in its own invocation, with table_name set
+    in the event, once the dimensions it references are loaded. Every table's load
+    is measured, see metrics_utils.
+
+    How far each loaded table is behind totesys is recorded in the warehouse's
+    freshness table and emitted as metrics, from the max last_updated of each raw
+    table the extract function passes on as source_last_updated, see
+    freshness_utils.
+
+    Args:
+        event (dict): time prefix provided by the transform function, optionally
+            batch_size for how many rows are sent per COPY, prefetch for how many
+            tables' files are downloaded ahead of the one being loaded,
+            table_name to only load that table and source_last_updated
+        context (dict): AWS provided context
+
+    Returns:
+        dict: time prefix, rows, seconds, rows/sec and freshness for each loaded
+            table and the metrics
+    """
+    reset_metrics()
+    prefix = event["time_prefix"]
+    batch_size = int(event.get("batch_size", default_batch_size))
+    prefetch = max(0, int(event.get("prefetch", default_prefetch)))
+    latest_updates = event.get("source_last_updated", {})
+
+    s3_client = get_s3_client()
+    _, processed_data_bucket = get_data_buckets()
+
+    try:
+        conn = connect_to_db(get_cached_secret(warehouse_secret_name))
+    except Error as e:
+        logging.error(e)
+        raise Exception(f"Connection to warehouse failed: {e}")
+
+    table_names = [event["table_name"]] if "table_name" in event else list(warehouse_tables)
+    # The next tables' files are downloaded while one is loaded, in load order
+    files = prefetch_processed_files(
+        s3_client, processed_data_bucket, [processed_key(table_name, prefix) for table_name in table_names], prefetch
+    )
+
+    loaded = {}
+    try:
+        for table_name, (_, (df, processed_at)) in zip(table_names, files):
+            if df is None:
+                continue
+            loaded[table_name] = load_table(conn, table_name, df, batch_size)
+            logging.info(f"Loaded {loaded[table_name]['rows']} rows into {table_name}")
+            report = freshness_report(
+                table_name, df, prefix, source_last_updated(table_name, latest_updates), processed_at
+            )
+            if report is not None:
+                record_freshness(conn, report)
+                loaded[table_name]["lag_max_seconds"] = report["lag_max_seconds"]
+    finally:
+        conn.close()
+
+    return {"time_prefix": prefix, "loaded": loaded, "metrics": metrics_summary()}
@@ -1,7 +1,40 @@
-import boto3
+import copy
 import logging
-from botocore.exceptions import ClientError
-from src.utils.transform_utils import finds_data_buckets, convert_csv_to_parquet
+import time
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import polars as pl
+from src.utils.cache_utils import get_s3_client
+from src.utils.diff_utils import primary_keys
+from src.utils.metrics_utils import measured, reset_metrics, metrics_summary
+from src.utils.pipeline_utils import pipeline_nodes, pipeline_waves
+from src.utils.transform_utils import (
+    get_data_buckets,
+    write_parquet_to_bucket,
+    parquet_options,
+    scan_parquet_from_bucket,
+    star_schema,
+    build_star_table,
+    update_current_snapshot,
+    get_hashes,
+    save_hashes,
+    content_hash,
+    combine_hashes,
+    changed_rows,
+    latest_versions,
+    updated_columns,
+    parse_time_prefix,
+    processed_key,
+    get_manifest,
+    save_manifest,
+    manifest_entry,
+    add_to_manifest,
+    compact_files,
+    compacted_file_bytes,
+    read_typed_csv,
+)
+from src.utils.schema_utils import get_cached_catalog
+from src.utils.storage_utils import get_storage, run
 
 csvs = [
     "sales_order.csv",
@@ -17,37 +50,462 @@ csvs = [
     "transaction.csv",
 ]
 
+# Tables are mostly waiting on S3, so several are transformed at the same time
+default_max_concurrency = 8
+
 
 def lambda_handler(event, context):
     """
-    This function finds data buckets, converts the csvs to parquet, then uploads this
-    to the processed data bucket.
+    This function finds data buckets, converts the files extracted in this run to
+    parquet, then uploads them to the processed data bucket. The changes are then
+    applied to the current snapshot of each raw table and the warehouse tables
+    depending on them are rebuilt. Each step works on its tables concurrently.
+
+    A content hash of every raw file, current snapshot and warehouse table input is
+    kept between runs, so tables whose input hasn't changed are skipped, and only
+    the changed rows of a dimension are uploaded for the load function.
+
+    Every table's conversion, snapshot refresh and warehouse table build is
+    measured, see metrics_utils, and the totals are returned as metrics.
+
+    Processed files are partitioned by table and day (see processed_key) and listed
+    in a manifest per table. The small files of days that are over are merged by a
+    separate daily invocation with stage "compact", see compact_tables.
+
+    The Step Function runs the pipeline one table at a time instead, with stage set
+    in the event: "plan" works out which tables to run from the changed_tables
+    given by the extract function, then each table is run in its own invocation
+    with stage "transform" (raw tables) or "star" (warehouse tables), see
+    run_stage.
 
     Args:
-        event (dict): time prefix provided by extract function
+        event (dict): time prefix and raw file output format ("csv" unless given)
+            provided by extract function, optionally max_concurrency for how many
+            tables are transformed at the same time, or stage, table_name and
+            changed_tables to run one step of the pipeline, or stage "compact"
+            and optionally target_bytes to merge the small files of days that
+            are over
         context (dict): AWS provided context
 
     Returns:
-        dict: dictionary with time prefix to be used in the load function
+        dict: dictionary with time prefix to be used in the load function, the
+            tables that failed, a timing report for each table and the metrics
     """
-    s3_client = boto3.client("s3")
+    reset_metrics()
+    if "stage" in event:
+        return run_stage(event)
+
+    s3_client = get_s3_client()
 
     prefix = event["time_prefix"]
+    raw_format = event.get("output_format", "csv")
+    max_concurrency = max(1, int(event.get("max_concurrency", default_max_concurrency)))
+
+    raw_data_bucket, processed_data_bucket = get_data_buckets()
+    hashes = get_hashes(s3_client, processed_data_bucket)
+    previous_hashes = copy.deepcopy(hashes)
+
+    raw_tables = [file[:-4] for file in csvs]
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        timings, failed_tables = run_concurrently(
+            executor, transform_table, raw_tables,
+            s3_client, raw_data_bucket, processed_data_bucket, prefix, raw_format, hashes["raw"]
+        )
+        if len(failed_tables) == len(raw_tables):
+            raise Exception("Failed to transform every table")
+        for table_name, timing in timings.items():
+            if "hash" in timing:
+                hashes["raw"][table_name] = timing.pop("hash")
+
+        changed_tables = [table for table in raw_tables if table in timings and not timings[table].get("skipped")]
+        current_timings, failed_current = run_concurrently(
+            executor, refresh_current_table, changed_tables,
+            s3_client, processed_data_bucket, prefix, hashes["current"]
+        )
+        for table_name, timing in current_timings.items():
+            hashes["current"][table_name] = timing.pop("hash")
+            timings[table_name]["current"] = timing
+
+        input_hashes = {
+            table_name: star_input_hash(table_name, hashes, changed_tables)
+            for table_name in star_schema
+        }
+        # Tables whose snapshot couldn't be refreshed would build from stale data
+        star_tables = [
+            table_name for table_name, input_hash in input_hashes.items()
+            if input_hash is not None
+            and input_hash != hashes["tables"].get(table_name)
+            and not set(star_schema[table_name]["sources"]) & set(failed_current)
+        ]
+        star_timings, failed_star = run_concurrently(
+            executor, transform_star_table, star_tables, s3_client, processed_data_bucket, prefix
+        )
+        for table_name in star_timings:
+            hashes["tables"][table_name] = input_hashes[table_name]
+
+    timings.update(star_timings)
+    save_hashes(s3_client, processed_data_bucket, hashes, previous_hashes)
+
+    return {
+        "time_prefix": prefix,
+        "failed_tables": failed_tables + failed_current + failed_star,
+        "timings": timings,
+        "metrics": metrics_summary(),
+    }
 
-    _, processed_data_bucket = finds_data_buckets()
 
-    for file in csvs:
-        parquet = convert_csv_to_parquet(file)
-        file = file[:-4]
+def run_stage(event):
+    """
+    Runs one step of the pipeline for the Step Function, or for the local runner.
+    Each table keeps its own hashes, manifest and caches, so invocations for
+    different tables can run at the same time.
+
+    Returns:
+        dict: for "plan", the event with the waves of {"stage", "table_name"} to run
+            (see pipeline_waves), for "compact" see compact_tables, otherwise the
+            time prefix, table name, its timing report and the metrics
+    """
+    stage = event["stage"]
+    if stage == "compact":
+        return compact_tables(event)
+    prefix = event["time_prefix"]
+    if stage == "plan":
+        waves = pipeline_waves(pipeline_nodes(event.get("changed_tables", [file[:-4] for file in csvs])))
+        return {**{key: value for key, value in event.items() if key != "stage"}, "waves": waves}
+
+    s3_client = get_s3_client()
+    raw_data_bucket, processed_data_bucket = get_data_buckets()
+    table_name = event["table_name"]
+    if stage == "transform":
+        hashes = get_hashes(s3_client, processed_data_bucket, [table_name])
+        previous_hashes = copy.deepcopy(hashes)
+        timing = transform_table(
+            s3_client, raw_data_bucket, processed_data_bucket, prefix,
+            event.get("output_format", "csv"), hashes["raw"], table_name
+        )
+        if "hash" in timing:
+            hashes["raw"][table_name] = timing.pop("hash")
+        if not timing.get("skipped"):
+            current = refresh_current_table(s3_client, processed_data_bucket, prefix, hashes["current"], table_name)
+            hashes["current"][table_name] = current.pop("hash")
+            timing["current"] = current
+    elif stage == "star":
+        sources = list(star_schema[table_name]["sources"])
+        hashes = get_hashes(s3_client, processed_data_bucket, [table_name] + sources)
+        previous_hashes = copy.deepcopy(hashes)
+        input_hash = star_input_hash(table_name, hashes, event.get("changed_tables", sources))
+        if input_hash is None or input_hash == hashes["tables"].get(table_name):
+            timing = {"skipped": True}
+        else:
+            timing = transform_star_table(s3_client, processed_data_bucket, prefix, table_name)
+            hashes["tables"][table_name] = input_hash
+    else:
+        raise Exception(f"Unknown stage: {stage}")
+
+    save_hashes(s3_client, processed_data_bucket, hashes, previous_hashes)
+    return {"time_prefix": prefix, "table_name": table_name, "timings": timing, "metrics": metrics_summary()}
+
+
+def run_concurrently(executor, function, table_names, *args):
+    """
+    Calls function(*args, table_name) for every table on the executor.
+
+    Returns:
+        tuple: dict of table name to result for the tables that succeeded, and a
+            list of the tables that failed
+    """
+    futures = {executor.submit(function, *args, table_name): table_name for table_name in table_names}
+    results = {}
+    failed_tables = []
+    for future in as_completed(futures):
+        table_name = futures[future]
         try:
-            s3_client.put_object(
-                Body=parquet,
-                Bucket=processed_data_bucket,
-                Key=f"/history/{prefix}/{file}.parquet",
-            )
+            results[table_name] = future.result()
+        except Exception as e:
+            logging.error(f"Failed to transform {table_name}: {e}")
+            failed_tables.append(table_name)
+    return results, failed_tables
+
+
+@measured("transform")
+def transform_table(s3_client, raw_data_bucket, processed_data_bucket, prefix, raw_format, raw_hashes, table_name):
+    """
+    Converts the file extracted for a table in this run to parquet and uploads it
+    to the processed data bucket. The csv bytes are parsed as they come back from
+    S3 and the parquet is written straight into a multipart upload. Raw parquet
+    files are already in the right format, so they're copied within S3 instead.
+
+    The raw file's ETag is its content hash. Files identical to the last one
+    transformed for the table (e.g. a retried run) and files without any rows are
+    skipped.
+
+    Returns:
+        dict: rows, raw and parquet bytes, the seconds spent on each step and the
+            raw file's hash, or {"skipped": True} if nothing changed for the table
+    """
+    raw_key = f"/history/{table_name}/differences_{prefix}.{raw_format}"
+    key = processed_key(table_name, prefix)
+
+    start = time.perf_counter()
+    storage = get_storage(s3_client)
+    res = run(storage.head(raw_data_bucket, raw_key))
+    # Incremental extracts don't write a file for tables with no new rows
+    if res is None:
+        return {"skipped": True}
+    raw_hash = res["etag"]
+    if raw_hash == raw_hashes.get(table_name):
+        return {"skipped": True}
+
+    if raw_format == "parquet":
+        run(storage.copy(raw_data_bucket, raw_key, processed_data_bucket, key))
+        copied = scan_parquet_from_bucket(s3_client, processed_data_bucket, key)
+        # Only the columns the manifest needs are decoded
+        columns = [column for column in updated_columns if column in copied.collect_schema().names()]
+        entry = manifest_entry(copied.select(columns).collect(), key, res["size"])
+        record_file(s3_client, processed_data_bucket, table_name, entry)
+        return {
+            "bytes_in": res["size"],
+            "copy_seconds": round(time.perf_counter() - start, 4),
+            "hash": raw_hash,
+        }
+
+    csv_data = run(storage.get(raw_data_bucket, raw_key))["body"]
+    fetched = time.perf_counter()
+
+    df = read_typed_csv(csv_data, table_name, get_cached_catalog(s3_client, raw_data_bucket))
+    parsed = time.perf_counter()
+    if df.is_empty():
+        return {"skipped": True, "hash": raw_hash}
+
+    parquet_bytes = write_parquet_to_bucket(df, s3_client, processed_data_bucket, key, **parquet_options(table_name))
+    uploaded = time.perf_counter()
+    record_file(s3_client, processed_data_bucket, table_name, manifest_entry(df, key, parquet_bytes))
+
+    return {
+        "rows": df.height,
+        "bytes_in": res["size"],
+        "parquet_bytes": parquet_bytes,
+        "fetch_seconds": round(fetched - start, 4),
+        "parse_seconds": round(parsed - fetched, 4),
+        "upload_seconds": round(uploaded - parsed, 4),
+        "hash": raw_hash,
+    }
+
+
+def compact_tables(event):
+    """
+    Merges the small files of every table's days before today, or before the day
+    of the time_prefix given in the event, into files of about the event's
+    target_bytes, compacted_file_bytes by default. Runs on its own daily schedule
+    rather than in the transform, and one table at a time, so only one merge is
+    ever in memory, see compact_files.
+
+    Returns:
+        dict: the day compacted up to, how many files were merged away for each
+            table, the tables that failed and the metrics
+    """
+    s3_client = get_s3_client()
+    _, processed_data_bucket = get_data_buckets()
+    run_time = parse_time_prefix(event["time_prefix"]) if "time_prefix" in event else datetime.now(timezone.utc)
+    before_date = f"{run_time:%Y-%m-%d}"
+    target_bytes = event.get("target_bytes", compacted_file_bytes)
+    table_names = [file[:-4] for file in csvs] + list(star_schema)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        compacted_files, failed_tables = run_concurrently(
+            executor, compact_table, table_names, s3_client, processed_data_bucket, before_date, target_bytes
+        )
+    return {
+        "before_date": before_date,
+        "compacted_files": compacted_files,
+        "failed_tables": failed_tables,
+        "metrics": metrics_summary(),
+    }
+
+
+@measured("compact")
+def compact_table(s3_client, processed_data_bucket, before_date, target_bytes, table_name):
+    return compact_files(s3_client, processed_data_bucket, table_name, before_date, target_bytes)
+
+
+def record_file(s3_client, processed_data_bucket, table_name, entry):
+    """
+    Adds a file written in this run to its table's manifest. Each table is written
+    by one thread at a time, so its manifest is too.
+    """
+    manifest = get_manifest(s3_client, processed_data_bucket, table_name)
+    add_to_manifest(manifest, entry)
+    save_manifest(s3_client, processed_data_bucket, table_name, manifest)
+
+
+@measured("current")
+def refresh_current_table(s3_client, processed_data_bucket, prefix, current_hashes, table_name):
+    """
+    Applies the rows that changed in this run to the current snapshot of a raw
+    table, kept at /current/{table_name}.parquet in the processed data bucket. The
+    snapshot is only uploaded again if its content hash changed.
+
+    Returns:
+        dict: rows in the snapshot, whether it changed, seconds taken and its hash
+    """
+    start = time.perf_counter()
+    changes = scan_parquet_from_bucket(s3_client, processed_data_bucket, processed_key(table_name, prefix))
+    current = scan_parquet_from_bucket(s3_client, processed_data_bucket, f"/current/{table_name}.parquet")
+    df = update_current_snapshot(current, changes, primary_keys[table_name]).collect()
+    current_hash = content_hash(df)
+    changed = current_hash != current_hashes.get(table_name)
+    if changed:
+        write_parquet_to_bucket(
+            df, s3_client, processed_data_bucket, f"/current/{table_name}.parquet", **parquet_options(table_name, "compact")
+        )
+    return {
+        "rows": df.height,
+        "changed": changed,
+        "seconds": round(time.perf_counter() - start, 4),
+        "hash": current_hash,
+    }
+
+
+def star_input_hash(table_name, hashes, changed_tables):
+    """
+    Combines the hashes of everything a warehouse table is built from: the current
+    snapshots of its sources, or for tables built from changes, this run's raw
+    files of the sources that changed.
+
+    Returns:
+        string: the hash, None if the table has nothing to be built from in this run
+    """
+    spec = star_schema[table_name]
+    sources = sorted(spec["sources"])
+    if spec["from"] == "changes":
+        sources = [source for source in sources if source in changed_tables]
+        if not sources:
+            return None
+        source_hashes = hashes["raw"]
+    else:
+        source_hashes = hashes["current"]
+    if not all(source in source_hashes for source in sources):
+        return None
+    return combine_hashes([source_hashes[source] for source in sources])
+
+
+@measured("star")
+def transform_star_table(s3_client, processed_data_bucket, prefix, table_name):
+    """
+    Builds a warehouse table from the current snapshots or this run's changes of
+    its sources, as set out in its star_schema spec, and uploads it to its own
+    table partition so the load function finds it under the same time prefix.
+
+    Dimensions are compacted into /current/{table_name}.parquet and only their rows
+    that changed since the last build are uploaded for the load function. Tables
+    whose spec extends a column are cached there too, see extend_cached_table, and
+    facts with history get version numbers, see version_fact.
+
+    Returns:
+        dict: rows uploaded, parquet bytes and seconds taken, or {"skipped": True}
+            if one of the sources has never been extracted, or none of them changed
+            for a table built from changes
+    """
+    spec = star_schema[table_name]
+    start = time.perf_counter()
+    frames = {}
+    for source in spec["sources"]:
+        key = f"/current/{source}.parquet" if spec["from"] == "current" else processed_key(source, prefix)
+        frame = scan_parquet_from_bucket(s3_client, processed_data_bucket, key)
+        if frame is not None:
+            frames[source] = frame
+        elif spec["from"] == "current":
+            return {"skipped": True}
+    # Tables built from changes only need one of their sources to have changed
+    if not frames:
+        return {"skipped": True}
+
+    # Caches are only saved once the table has been uploaded, so a failed upload
+    # is built again from the same cache on the next run
+    if "history" in spec:
+        df, save_cache = version_fact(s3_client, processed_data_bucket, table_name, frames)
+    elif "extends" in spec:
+        df, save_cache = extend_cached_table(s3_client, processed_data_bucket, table_name, frames)
+    elif spec["from"] == "current":
+        df, save_cache = compact_dimension(s3_client, processed_data_bucket, table_name, frames)
+    else:
+        df, save_cache = build_star_table(table_name, frames).collect(), None
+    if df.is_empty():
+        return {"rows": 0, "seconds": round(time.perf_counter() - start, 4)}
+
+    key = processed_key(table_name, prefix)
+    parquet_bytes = write_parquet_to_bucket(df, s3_client, processed_data_bucket, key, **parquet_options(table_name))
+    if save_cache is not None:
+        save_cache()
+    record_file(s3_client, processed_data_bucket, table_name, manifest_entry(df, key, parquet_bytes))
+    return {
+        "rows": df.height,
+        "parquet_bytes": parquet_bytes,
+        "seconds": round(time.perf_counter() - start, 4),
+    }
+
+
+def compact_dimension(s3_client, processed_data_bucket, table_name, frames):
+    """
+    Builds a dimension in full and works out which rows changed since its previous
+    compacted copy.
+
+    Returns:
+        tuple: the inserted and updated rows, and a function replacing the
+            compacted copy with the new build
+    """
+    cache_key = f"/current/{table_name}.parquet"
+    df = build_star_table(table_name, frames).collect()
+    previous = scan_parquet_from_bucket(s3_client, processed_data_bucket, cache_key)
+    delta = changed_rows(df, None if previous is None else previous.collect())
+    # Dimensions are written with the compact profile and their dictionaries
+    return delta, lambda: write_parquet_to_bucket(
+        df, s3_client, processed_data_bucket, cache_key, **parquet_options(table_name)
+    )
+
+
+def extend_cached_table(s3_client, processed_data_bucket, table_name, frames):
+    """
+    Builds only the rows missing from the cached copy of a table whose spec extends
+    a column.
+
+    Returns:
+        tuple: the rows missing from the cache, and a function adding them to it
+    """
+    column = star_schema[table_name]["extends"]
+    cache_key = f"/current/{table_name}.parquet"
+    cached = scan_parquet_from_bucket(s3_client, processed_data_bucket, cache_key)
+    cached_range = None
+    if cached is not None:
+        # Only the column statistics are needed here, not the cached rows
+        cached_range = cached.select(pl.col(column).min().alias("min"), pl.col(column).max().alias("max")).collect().row(0)
+
+    df = build_star_table(table_name, frames, cached_range=cached_range).collect()
+
+    def save_cache():
+        table = df if cached is None else pl.concat([cached.collect(), df]).sort(column)
+        write_parquet_to_bucket(table, s3_client, processed_data_bucket, cache_key, **parquet_options(table_name))
+
+    return df, save_cache
+
+
+def version_fact(s3_client, processed_data_bucket, table_name, frames):
+    """
+    Builds the new versions of a fact's rows from this run's changes. The latest
+    version of every key is kept at /current/{table_name}_versions.parquet so
+    version numbers carry on from the previous run.
+
+    Returns:
+        tuple: the new fact rows, and a function saving their versions
+    """
+    key = star_schema[table_name]["history"]
+    cache_key = f"/current/{table_name}_versions.parquet"
+    previous = scan_parquet_from_bucket(s3_client, processed_data_bucket, cache_key)
+    df = build_star_table(
+        table_name, frames, previous_versions=previous, deleted_at=datetime.now(timezone.utc).replace(tzinfo=None)
+    ).collect()
 
-        except ClientError as e:
-            logging.error(e)
-            return "Failed to upload file"
+    def save_cache():
+        versions = latest_versions(previous, df.lazy(), key).collect()
+        write_parquet_to_bucket(versions, s3_client, processed_data_bucket, cache_key, **parquet_options())
 
-    return {"time_prefix": prefix}
+    return df, save_cache
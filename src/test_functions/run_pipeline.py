@@ -0,0 +1,57 @@
+"""
+Runs the pipeline locally as the same per-table DAG the Step Function runs, on a
+process pool instead of Lambda invocations, to test or time it without deploying.
+The data buckets and warehouse are whatever the environment's credentials reach.
+
+    python -m src.test_functions.run_pipeline --time-prefix 2024_08_16_10:00:00 \
+        --tables sales_order currency --workers 4
+
+With --extract the extract function is run first and its changed tables are used.
+"""
+import argparse
+import json
+from functools import partial
+from src.lambda_functions.extract import lambda_handler as extract, data_tables
+from src.lambda_functions.transform import lambda_handler as transform
+from src.lambda_functions.load import lambda_handler as load
+from src.utils.pipeline_utils import default_max_workers, pipeline_nodes, run_pipeline
+
+
+def run_node(event, stage, table_name):
+    """Runs one node through the Lambda handler of its stage, as the Step Function does."""
+    handler = load if stage == "load" else transform
+    return handler({**event, "stage": stage, "table_name": table_name}, None)
+
+
+def run_locally(event, max_workers=default_max_workers, extract_first=False, skip_load=False):
+    """
+    Runs a pipeline for the event, optionally extracting first.
+
+    Returns:
+        dict: the event the nodes were run with and the report from run_pipeline
+    """
+    if extract_first:
+        event = {**event, **extract(event, None)}
+    nodes = pipeline_nodes(event.get("changed_tables", data_tables))
+    if skip_load:
+        nodes = {node: spec for node, spec in nodes.items() if spec["stage"] != "load"}
+    return {"event": event, **run_pipeline(nodes, partial(run_node, event), max_workers)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--time-prefix", help="time prefix of the extract to transform and load")
+    parser.add_argument("--output-format", default="csv", help="format of the raw files, csv or parquet")
+    parser.add_argument("--tables", nargs="*", help="raw tables that changed, every table if not given")
+    parser.add_argument("--workers", type=int, default=default_max_workers, help="how many nodes run at once")
+    parser.add_argument("--extract", action="store_true", help="run the extract function first")
+    parser.add_argument("--skip-load", action="store_true", help="stop after the transform stages")
+    args = parser.parse_args()
+
+    event = {"output_format": args.output_format}
+    if args.time_prefix:
+        event["time_prefix"] = args.time_prefix
+    if args.tables:
+        event["changed_tables"] = args.tables
+    report = run_locally(event, args.workers, args.extract, args.skip_load)
+    print(json.dumps(report, indent=2, default=str))
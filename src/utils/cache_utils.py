@@ -0,0 +1,79 @@
+import threading
+import time
+import boto3
+from botocore.config import Config
+
+# Module level, so anything cached here lives for as long as the Lambda container
+# stays warm and is shared by every invocation it serves
+_cache = {}
+_lock = threading.Lock()
+
+# S3 requests are retried by storage_utils, with jittered backoff, so botocore's
+# own retries are turned off to keep to one retry policy. The connection pool fits
+# as many requests as a storage runs at once.
+s3_max_pool_connections = 16
+
+
+def get_or_create(key, factory, ttl=None):
+    """
+    Returns the value cached under key, calling factory to create it if it isn't
+    cached yet or has expired.
+
+    Args:
+        key (hashable): name of the cached resource
+        factory (function): called with no arguments to create the resource
+        ttl (number): seconds the value stays valid for, None to keep it forever
+
+    Returns:
+        the cached or newly created value
+    """
+    now = time.monotonic()
+    with _lock:
+        entry = _cache.get(key)
+    if entry is not None and (entry[1] is None or entry[1] > now):
+        return entry[0]
+
+    value = factory()
+    with _lock:
+        _cache[key] = (value, None if ttl is None else now + ttl)
+    return value
+
+
+def peek(key):
+    """
+    Returns the value cached under key without creating it, or None.
+    """
+    with _lock:
+        entry = _cache.get(key)
+    if entry is None or (entry[1] is not None and entry[1] <= time.monotonic()):
+        return None
+    return entry[0]
+
+
+def invalidate(key):
+    """
+    Drops a cached value so it is created again the next time it's needed.
+    """
+    with _lock:
+        _cache.pop(key, None)
+
+
+def clear_cache():
+    """
+    Drops every cached value.
+    """
+    with _lock:
+        _cache.clear()
+
+
+def get_s3_client():
+    """
+    Returns an S3 client shared by every invocation in this container. boto3
+    clients are thread safe, so the same client is used by worker threads too.
+    """
+    return get_or_create(
+        "s3_client",
+        lambda: boto3.client(
+            "s3", config=Config(max_pool_connections=s3_max_pool_connections, retries={"total_max_attempts": 1})
+        ),
+    )
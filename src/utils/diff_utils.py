@@ -0,0 +1,341 @@
+import csv
+import json
+import os
+import struct
+import tempfile
+from datetime import datetime
+from decimal import Decimal
+from hashlib import blake2b
+import numpy as np
+
+primary_keys = {
+    "sales_order": "sales_order_id",
+    "design": "design_id",
+    "currency": "currency_id",
+    "staff": "staff_id",
+    "counterparty": "counterparty_id",
+    "address": "address_id",
+    "department": "department_id",
+    "purchase_order": "purchase_order_id",
+    "payment_type": "payment_type_id",
+    "payment": "payment_id",
+    "transaction": "transaction_id",
+}
+
+INSERT = "insert"
+UPDATE = "update"
+DELETE = "delete"
+
+index_magic = b"TSX2"
+# Indexes of rows hashed as they were written, before canonical_converters
+legacy_index_magic = b"TSX1"
+# Magic, length of the files JSON, number of rows
+index_header = struct.Struct("<4sIQ")
+
+
+def hash_row(row):
+    """
+    Returns a 64 bit hash of a csv row, so a snapshot can be remembered as
+    primary key -> hash instead of keeping every row in memory.
+    """
+    return int.from_bytes(
+        blake2b("\x1f".join(row).encode("utf-8"), digest_size=8).digest(), "big"
+    )
+
+
+def _canonical_boolean(value):
+    if value is None or value == "":
+        return ""
+    return "true" if value in (True, "t", "true", "True") else "false"
+
+
+def _canonical_timestamp(value):
+    if value is None or value == "":
+        return ""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.isoformat(sep=" ")
+
+
+def _canonical_numeric(value):
+    if value is None or value == "":
+        return ""
+    return format(Decimal(str(value)).normalize(), "f")
+
+
+def _canonical_text(value):
+    return "" if value is None else str(value)
+
+
+def canonical_converters(data_types):
+    """
+    Returns a function per column turning its values into the text rows are
+    hashed as. Rows come from the database as python values, and from snapshots
+    as text written by whichever engine wrote them, e.g. t or True for a boolean
+    and a timestamp with or without trailing zeros, so both are parsed and written
+    back the same way.
+    """
+    converters = {"boolean": _canonical_boolean, "numeric": _canonical_numeric}
+    return [
+        _canonical_timestamp if data_type.startswith("timestamp") else converters.get(data_type, _canonical_text)
+        for data_type in data_types
+    ]
+
+
+def canonical_rows(rows, converters):
+    return [[convert(value) for convert, value in zip(converters, row)] for row in rows]
+
+
+def read_header(path):
+    """
+    Returns the header row of a csv file, or the column names of a parquet file.
+    """
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        return pq.read_schema(path).names
+    with open(path, newline="") as f:
+        return next(csv.reader(f), [])
+
+
+def _read_parquet_rows(path):
+    """
+    Streams the rows of a parquet file as lists of strings, formatted the way
+    csv.writer would write them.
+    """
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches():
+        columns = batch.to_pydict().values()
+        for row in zip(*columns):
+            yield ["" if value is None else str(value) for value in row]
+
+
+def _read_rows(path, has_header):
+    """
+    Streams the non empty rows of a csv file, optionally skipping its header.
+    Parquet files are read row by row too, they never have a header row.
+    """
+    if path.endswith(".parquet"):
+        yield from _read_parquet_rows(path)
+        return
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        if has_header:
+            next(reader, None)
+        for row in reader:
+            if row:
+                yield row
+
+
+def _diff_partition(old_path, new_path, key_index, has_header=False):
+    """
+    Diffs two csv files whose keys fit in memory once reduced to
+    primary key -> row hash.
+    """
+    old_hashes = {row[key_index]: hash_row(row) for row in _read_rows(old_path, has_header)}
+
+    for row in _read_rows(new_path, has_header):
+        old_hash = old_hashes.pop(row[key_index], None)
+        if old_hash is None:
+            yield INSERT, row
+        elif old_hash != hash_row(row):
+            yield UPDATE, row
+
+    if old_hashes:
+        # Deleted keys are the ones never seen in the new snapshot, a second pass
+        # over the old snapshot recovers their full rows
+        for row in _read_rows(old_path, has_header):
+            if row[key_index] in old_hashes:
+                yield DELETE, row
+
+
+def index_rows(rows, key_index):
+    """
+    Reduces csv rows to their primary keys and row hashes, the columns of a
+    snapshot index. Primary keys have to be integers, as every totesys key is.
+
+    Returns:
+        tuple: the keys (int64) and hashes (uint64) as arrays, in row order
+    """
+    keys = np.fromiter((int(row[key_index]) for row in rows), dtype=np.int64, count=len(rows))
+    hashes = np.fromiter((hash_row(row) for row in rows), dtype=np.uint64, count=len(rows))
+    return keys, hashes
+
+
+def build_index(files, keys, hashes, file_ids):
+    """
+    Makes a snapshot index out of unsorted rows: their primary keys, row hashes
+    of their canonical text (see canonical_converters) and the index into files of
+    the csv each row was last written to. Files no row points at are dropped.
+    """
+    order = np.argsort(keys, kind="stable")
+    used, file_ids = np.unique(file_ids[order], return_inverse=True)
+    return {
+        "files": [files[file_id] for file_id in used],
+        "keys": keys[order],
+        "hashes": hashes[order],
+        "file_ids": file_ids.astype(np.uint32),
+        "canonical": True,
+    }
+
+
+def encode_index(index):
+    """
+    Serializes a snapshot index: a fixed header with the length of a JSON list of
+    its files, padded so the arrays stay 8 byte aligned, then the raw keys, hashes
+    and file ids. About 20 bytes a row.
+    """
+    files = json.dumps(index["files"]).encode("utf-8")
+    files += b" " * (-len(files) % 8)
+    return b"".join([
+        index_header.pack(index_magic, len(files), len(index["keys"])),
+        files,
+        index["keys"].astype(np.int64).tobytes(),
+        index["hashes"].astype(np.uint64).tobytes(),
+        index["file_ids"].astype(np.uint32).tobytes(),
+    ])
+
+
+def decode_index(data):
+    """
+    Loads a snapshot index written by encode_index. The arrays are views over data
+    rather than copies. Indexes written before rows were hashed as canonical text
+    are loaded with canonical set to False, for their hashes to be rebuilt.
+    """
+    magic, files_length, rows = index_header.unpack_from(data)
+    if magic not in (index_magic, legacy_index_magic):
+        raise ValueError("Not a snapshot index")
+    offset = index_header.size
+    files = json.loads(data[offset:offset + files_length])
+    offset += files_length
+    keys = np.frombuffer(data, dtype=np.int64, count=rows, offset=offset)
+    hashes = np.frombuffer(data, dtype=np.uint64, count=rows, offset=offset + 8 * rows)
+    file_ids = np.frombuffer(data, dtype=np.uint32, count=rows, offset=offset + 16 * rows)
+    return {"files": files, "keys": keys, "hashes": hashes, "file_ids": file_ids, "canonical": magic == index_magic}
+
+
+def diff_batch(index, keys, hashes, seen):
+    """
+    Compares a batch of a new snapshot with the index of the previous one, with
+    a binary search of the index's sorted keys for every key of the batch.
+
+    Args:
+        index (dict): snapshot index of the previous snapshot
+        keys, hashes (ndarray): primary keys and row hashes of the batch
+        seen (ndarray): booleans over the index's rows, the rows found in the
+            batch are set. The rows never seen in any batch were deleted.
+
+    Returns:
+        tuple: position of each key in the index, -1 for new keys, and whether
+            each row of the batch was inserted or updated
+    """
+    positions = np.searchsorted(index["keys"], keys)
+    found = positions < len(index["keys"])
+    found[found] = index["keys"][positions[found]] == keys[found]
+    positions = np.where(found, positions, -1)
+    seen[positions[found]] = True
+    changed = ~found
+    changed[found] = index["hashes"][positions[found]] != hashes[found]
+    return positions, changed
+
+
+def _differs(new, old):
+    """
+    Whether each pair of values differs, a null and a value counting as different.
+    """
+    import pyarrow.compute as pc
+
+    return pc.or_(pc.fill_null(pc.not_equal(new, old), False), pc.xor(pc.is_null(new), pc.is_null(old)))
+
+
+def diff_parquet_snapshots(old_source, new_source, primary_key):
+    """
+    Compares two parquet snapshots of the same table by primary key. Unlike
+    diff_snapshots the changed rows keep the snapshots' column types, so they can
+    be written back out as parquet. Both snapshots are read into memory.
+
+    Args:
+        old_source, new_source: parquet files (paths or file objects) of the
+            previous and new snapshots
+        primary_key (string): name of the primary key column
+
+    Returns:
+        pyarrow.Table: the inserted and updated rows of the new snapshot, then the
+            deleted rows of the old one, with the type of change in a change_type
+            column
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    old = pq.read_table(old_source)
+    new = pq.read_table(new_source)
+    joined = new.append_column("_new_row", pa.array(np.arange(new.num_rows))).join(
+        old.append_column("_old_row", pa.array(np.arange(old.num_rows))),
+        primary_key, join_type="full outer", right_suffix="_old",
+    )
+    inserted = pc.is_null(joined["_old_row"])
+    deleted = pc.is_null(joined["_new_row"])
+    updated = pa.array(np.zeros(joined.num_rows, dtype=bool))
+    for name in new.column_names:
+        if name != primary_key:
+            updated = pc.or_(updated, _differs(joined[name], joined[f"{name}_old"]))
+    updated = pc.and_(updated, pc.invert(pc.or_(inserted, deleted)))
+
+    def rows(table, position, mask, change_type):
+        taken = table.take(np.sort(pc.filter(joined[position], mask).to_numpy()))
+        return taken.append_column("change_type", pa.array([change_type] * taken.num_rows, type=pa.string()))
+
+    return pa.concat_tables([
+        rows(new, "_new_row", inserted, INSERT),
+        rows(new, "_new_row", updated, UPDATE),
+        rows(old, "_old_row", deleted, DELETE),
+    ])
+
+
+def _partition_csv(path, key_index, partitions, directory, name):
+    """
+    Splits the rows of a csv file (minus its header) into partition files by the
+    hash of their primary key, so matching keys always land in the same partition.
+    Returns the list of partition paths.
+    """
+    paths = [os.path.join(directory, f"{name}_{i}.csv") for i in range(partitions)]
+    files = [open(p, "w", newline="") for p in paths]
+    try:
+        writers = [csv.writer(f) for f in files]
+        for row in _read_rows(path, has_header=True):
+            writers[hash_row([row[key_index]]) % partitions].writerow(row)
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+
+def diff_snapshots(old_path, new_path, primary_key, partitions=1):
+    """
+    Compares two csv snapshots of the same table by primary key and yields the
+    changes between them.
+
+    Args:
+        old_path (string): csv or parquet file containing the previous snapshot
+        new_path (string): csv or parquet file containing the new snapshot
+        primary_key (string): name of the primary key column
+        partitions (int): number of hash partitions to split large snapshots into.
+            Only 1/partitions of the keys are held in memory at any time.
+
+    Yields:
+        tuple: (change_type, row) where change_type is "insert", "update" or
+        "delete" and row is the new row (or the old row for deletes)
+    """
+    key_index = read_header(new_path).index(primary_key)
+
+    if partitions <= 1:
+        yield from _diff_partition(old_path, new_path, key_index, has_header=True)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        old_parts = _partition_csv(old_path, key_index, partitions, directory, "old")
+        new_parts = _partition_csv(new_path, key_index, partitions, directory, "new")
+        for old_part, new_part in zip(old_parts, new_parts):
+            yield from _diff_partition(old_part, new_part, key_index)
@@ -2,14 +2,37 @@ import boto3
 import logging
 import csv
 import json
-import re
-import subprocess
+import os
+import queue
+import threading
+import time
+import numpy as np
+from contextlib import contextmanager
 from datetime import datetime as dt
-from pg8000.native import Connection, Error
+from pg8000.native import Connection, Error, identifier, literal
 from botocore.exceptions import ClientError
 from io import StringIO
+from src.utils.cache_utils import get_or_create, invalidate, peek
+from src.utils.diff_utils import diff_snapshots, read_header, index_rows, build_index, encode_index, decode_index
+from src.utils.diff_utils import canonical_converters, canonical_rows
+from src.utils.diff_utils import diff_batch, INSERT, UPDATE, DELETE
+from src.utils.storage_utils import get_storage, run
 
 all_data_file_path = "/source/"
+watermark_file_path = "/state/watermarks.json"
+watermark_keys_file_path = "/state/watermark_keys.json"
+fingerprint_file_path = "/state/fingerprints.json"
+snapshot_index_path = "/state/snapshot_index"
+# Snapshots bigger than this are hash partitioned on disk before being diffed
+diff_partition_size = 64 * 1024 * 1024
+# Seconds a pooled connection can sit idle before it is checked with SELECT 1
+liveness_check_after = 30
+# Seconds the database secret is cached for in a warm container
+secret_ttl = 15 * 60
+# Rows fetched per round trip by the streaming extraction engines
+default_batch_size = 10000
+# Decimal places kept for numeric columns when extracting to parquet
+numeric_scale = 10
 
 data_tables = [
     "sales_order",
@@ -29,22 +52,10 @@ data_tables = [
 def create_time_prefix_for_file():
     """
     Retrieves the current time at which the lambda function is invoked for use in
-    the file structure and in returning a value for the lambda handler
-    """
-    current_time = dt.now()
-    year = current_time.year
-    month = current_time.month
-    day = current_time.day
-    hour = current_time.hour
-    if len(str(hour)) == 1:
-        hour = "0" + str(hour)
-    minute = current_time.minute
-    if len(str(minute)) == 1:
-        minute = "0" + str(minute)
-    second = current_time.second
-    if len(str(second)) == 1:
-        second = "0" + str(second)
-    return f"{year}_{month}_{day}_{hour}:{minute}:{second}"
+    the file structure and in returning a value for the lambda handler. Every part
+    is zero padded so prefixes sort in time order, e.g. 2024_08_05_09:03:07
+    """
+    return dt.now().strftime("%Y_%m_%d_%H:%M:%S")
 
 
 def get_secret(secret_name="totesys_database_credentials"):
@@ -77,10 +88,9 @@ def connect_to_bucket(client):
     Searches for a raw data bucket within an AWS account and returns bucket name if
     bucket is found or raises exception if bucket is not found.
     """
-    buckets = client.list_buckets()
-    for bucket in buckets["Buckets"]:
-        if bucket["Name"].startswith("totesys-raw-data-"):
-            return bucket["Name"]
+    for bucket in run(get_storage(client).list_buckets()):
+        if bucket.startswith("totesys-raw-data-"):
+            return bucket
     logging.error("No raw data bucket found")
     raise Exception("No raw data bucket found")
 
@@ -99,80 +109,841 @@ def connect_to_db(credentials):
     )
 
 
-def create_and_upload_to_bucket(data, client, bucket, filename, original):
+class ConnectionPool:
     """
-    Converts a table from a database into a CSV file and uploads that CSV file to a
-    specified bucket, raising an exception if there's an error in uploading the file.
-    The data argument is a list of lists.
+    A fixed size pool of database connections made with connect_to_db, which can
+    be shared between threads. Connections are opened lazily up to the pool size,
+    apart from the first one which is opened straight away so bad credentials or an
+    unreachable database fail before any work is started.
+    """
+
+    def __init__(self, credentials, size):
+        self.credentials = credentials
+        self.size = max(1, size)
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 1
+        self._release(self._open())
+
+    def _release(self, conn):
+        self._idle.put((conn, time.monotonic()))
+
+    def _is_alive(self, conn, idle_since):
+        # Connections left idle between invocations may have been dropped by the
+        # server, so they are checked with a cheap query before being reused
+        if time.monotonic() - idle_since < liveness_check_after:
+            return True
+        try:
+            conn.run("SELECT 1;")
+            return True
+        except Exception:
+            self._discard(conn)
+            return False
+
+    def _open(self):
+        # The caller has already counted this connection in self._opened
+        try:
+            return connect_to_db(self.credentials)
+        except Exception:
+            with self._lock:
+                self._opened -= 1
+            raise
+
+    def _acquire(self):
+        while True:
+            try:
+                conn, idle_since = self._idle.get_nowait()
+                if self._is_alive(conn, idle_since):
+                    return conn
+                continue
+            except queue.Empty:
+                pass
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                return self._open()
+            try:
+                # Wake up now and then in case a broken connection was discarded,
+                # which frees a slot without anything being put back in the queue
+                conn, idle_since = self._idle.get(timeout=1)
+            except queue.Empty:
+                continue
+            if self._is_alive(conn, idle_since):
+                return conn
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection for the duration of a with block. Connections that
+        raised a database error are closed rather than handed to the next thread.
+        """
+        conn = self._acquire()
+        try:
+            yield conn
+        except Error:
+            self._discard(conn)
+            raise
+        except BaseException:
+            self._release(conn)
+            raise
+        self._release(conn)
+
+    def _discard(self, conn):
+        with self._lock:
+            self._opened -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """
+        Closes every idle connection in the pool.
+        """
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+
+def get_cached_secret(secret_name="totesys_database_credentials"):
+    """
+    Returns the secret from get_secret, cached in the warm container for
+    secret_ttl seconds so Secrets Manager is called once per container rather than
+    once per invocation.
+    """
+    return get_or_create(("secret", secret_name), lambda: get_secret(secret_name), secret_ttl)
+
+
+def get_cached_raw_data_bucket(client):
+    """
+    Returns the raw data bucket name from connect_to_bucket, memoized in the warm
+    container so the buckets are only listed once.
+    """
+    return get_or_create("raw_data_bucket", lambda: connect_to_bucket(client))
+
+
+def is_authentication_failure(error):
+    """
+    Checks whether a pg8000 error means Postgres rejected the credentials.
+    """
+    details = error.args[0] if error.args else None
+    return isinstance(details, dict) and details.get("C") in ("28P01", "28000")
+
+
+def get_connection_pool(size, secret_name="totesys_database_credentials"):
+    """
+    Returns a ConnectionPool that is kept in the warm container, so its
+    connections survive between invocations. If Postgres rejects the cached
+    credentials the secret is fetched again once, in case it has been rotated.
+    """
+    pool = peek("connection_pool")
+    if pool is not None and pool.size == size:
+        return pool
+    if pool is not None:
+        pool.close()
+        invalidate("connection_pool")
+
+    def create_pool():
+        try:
+            return ConnectionPool(get_cached_secret(secret_name), size)
+        except Error as e:
+            if not is_authentication_failure(e):
+                raise
+            logging.info("Database credentials rejected, refreshing the secret")
+            invalidate(("secret", secret_name))
+            return ConnectionPool(get_cached_secret(secret_name), size)
+
+    return get_or_create("connection_pool", create_pool)
+
+
+def upload_csv_to_bucket(data, client, bucket, key):
+    """
+    Converts a list of lists into a CSV file and uploads it to the given key of a
+    bucket, raising an exception if there's an error in uploading the file.
+
+    Returns:
+        int: bytes uploaded
     """
     file_to_save = StringIO()
     csv.writer(file_to_save).writerows(data)
     file_to_save = bytes(file_to_save.getvalue(), encoding="utf-8")
 
     try:
-        if original:
-            client.put_object(Body=file_to_save,
-                              Bucket=bucket,
-                              Key=f"{all_data_file_path}{filename}/{filename}_original.csv")
-        else:
-            client.put_object(Body=file_to_save,
-                              Bucket=bucket,
-                              Key=f"{all_data_file_path}{filename}/{filename}_new.csv")
-    except ClientError as e:
+        # Retried with backoff if S3 throttles or drops the request
+        return run(get_storage(client).put(bucket, key, file_to_save))
+    except Exception as e:
         logging.error(e)
         raise Exception("Failed to upload file")
 
 
-def compare_csvs(csv1, csv2):
+def create_and_upload_to_bucket(data, client, bucket, filename, original):
     """
-    Takes two csvs and compares the differences between them, returning an
-    empty csv if no differences found.
+    Converts a table from a database into a CSV file and uploads that CSV file to a
+    specified bucket, raising an exception if there's an error in uploading the file.
+    The data argument is a list of lists.
+    """
+    if original:
+        key = f"{all_data_file_path}{filename}/{filename}_original.csv"
+    else:
+        key = f"{all_data_file_path}{filename}/{filename}_new.csv"
+    upload_csv_to_bucket(data, client, bucket, key)
+
+
+def get_watermarks(client, bucket):
+    """
+    Retrieves the per-table high-water marks saved by previous incremental runs.
 
     Args:
-    csv1 - Csv containing previous database data
-    csv2 - Csv containing new database data
+        client (boto3 S3 client): client used to read the state object
+        bucket (string): name of the raw data bucket
 
     Returns:
-    csv file containing all changes to database (if csv1 and csv2 are not equal)
-    None (if csv1 and csv2 are equal)
+        dict: table name -> ISO formatted max last_updated value already extracted.
+        Empty if no incremental run has completed yet.
     """
     try:
-        conn = connect_to_db(get_secret())
-        for data_table_name in data_tables:
-            query = f"SELECT column_name FROM information_schema.columns WHERE table_name = '{data_table_name}';"
-            column_names = conn.run(query)
-            header = []
-            for column in column_names:
-                header.append(column[0])
-
-        regex = r'(> ([A-Za-z,0-9]+))|(\\ ([A-Za-z,0-9]+))'
-
-        '''
-        command = f"echo $(diff {csv1} {csv2})" 
-        This command had to be broken down due to security risks of using shell commands
-        '''
-        diff_output = subprocess.run(["diff", csv1, csv2], capture_output=True, text=True).stdout
-        differences = subprocess.run(["echo", diff_output], capture_output=True, text=True)
-        changes_to_table = re.findall(regex, differences.stdout)
-        filepath = f"differences_{create_time_prefix_for_file()}.csv"
-        with open(f"/tmp/{filepath}", "w", newline='') as f:
-            csvwriter = csv.writer(f)
-            csvwriter.writerow(header)
-            for change in changes_to_table:
-                change_list = [k for k in list(change) if not '' == k]
-                csvwriter.writerow(change_list[1].split(','))
-
-        if changes_to_table == '\n':
-            logging.info("No changes in table found")
-        else:
-            logging.info("Changes found in table")
+        obj = run(get_storage(client).get(bucket, watermark_file_path))
+    except Exception as e:
+        logging.error(e)
+        raise Exception(f"Can't retrieve watermarks due to {e}")
+    return {} if obj is None else json.loads(obj["body"])
+
 
-    except Error as e:
+def save_watermarks(client, bucket, watermarks):
+    """
+    Saves the per-table high-water marks as a single JSON state object. The object
+    is replaced in one write so readers never see a partial update.
+    """
+    try:
+        run(get_storage(client).put(bucket, watermark_file_path, json.dumps(watermarks, sort_keys=True).encode()))
+    except Exception as e:
         logging.error(e)
-        raise Exception(f"Connection to database failed: {e}")
+        raise Exception("Failed to save watermarks")
 
-    finally:
-        if "conn" in locals():
-            conn.close()
+
+def get_watermark_keys(client, bucket):
+    """
+    Retrieves the primary keys of the rows already extracted at each table's
+    watermark, see build_watermark_condition.
+
+    Returns:
+        dict: table name -> list of primary keys, empty if none were saved yet
+    """
+    try:
+        obj = run(get_storage(client).get(bucket, watermark_keys_file_path))
+    except Exception as e:
+        logging.error(e)
+        raise Exception(f"Can't retrieve watermark keys due to {e}")
+    return {} if obj is None else json.loads(obj["body"])
+
+
+def save_watermark_keys(client, bucket, watermark_keys):
+    """
+    Saves the primary keys of the rows extracted at each table's watermark as a
+    single JSON state object.
+    """
+    try:
+        run(get_storage(client).put(
+            bucket, watermark_keys_file_path, json.dumps(watermark_keys, sort_keys=True).encode()
+        ))
+    except Exception as e:
+        logging.error(e)
+        raise Exception("Failed to save watermark keys")
+
+
+def get_fingerprints(client, bucket):
+    """
+    Retrieves the per-table fingerprints saved by the previous run, see
+    table_fingerprint.
+
+    Returns:
+        dict: table name -> fingerprint, empty if none were saved yet
+    """
+    try:
+        obj = run(get_storage(client).get(bucket, fingerprint_file_path))
+    except Exception as e:
+        logging.error(e)
+        raise Exception(f"Can't retrieve fingerprints due to {e}")
+    return {} if obj is None else json.loads(obj["body"])
+
+
+def save_fingerprints(client, bucket, fingerprints):
+    """
+    Saves the per-table fingerprints as a single JSON state object.
+    """
+    try:
+        run(get_storage(client).put(bucket, fingerprint_file_path, json.dumps(fingerprints, sort_keys=True).encode()))
+    except Exception as e:
+        logging.error(e)
+        raise Exception("Failed to save fingerprints")
+
+
+def build_fingerprint_query(table_name, primary_key=None):
+    """
+    Builds the query aggregating a table into its fingerprint: its row count and
+    max last_updated, and an md5 of its primary keys in order when one is given.
+    """
+    aggregates = ["count(*)", "max(last_updated)"]
+    if primary_key is not None:
+        key = identifier(primary_key)
+        aggregates.append(f"md5(string_agg({key}::text, ',' ORDER BY {key}))")
+    return f"SELECT {', '.join(aggregates)} FROM {identifier(table_name)};"
+
+
+def table_fingerprint(conn, table_name, primary_key=None):
+    """
+    Asks Postgres for a cheap fingerprint of a table. Inserts and updates move the
+    max last_updated, deletes change the row count, and the hash of the primary
+    keys catches a delete and an insert cancelling each other out. Only a row
+    changed without touching its last_updated goes unnoticed.
+
+    Returns:
+        list: row count, ISO formatted max last_updated and keys hash, JSON ready
+    """
+    row = conn.run(build_fingerprint_query(table_name, primary_key))[0]
+    return [value.isoformat() if isinstance(value, dt) else value for value in row]
+
+
+def get_snapshot_index(client, bucket, table_name):
+    """
+    Retrieves the snapshot index saved by the last snapshot diff of a table, see
+    diff_table and diff_utils.encode_index.
+
+    Returns:
+        dict: files, the keys of the csvs the rows were last written to, and the
+            sorted primary keys, row hashes and file ids. None if none was saved yet
+    """
+    try:
+        obj = run(get_storage(client).get(bucket, f"{snapshot_index_path}/{table_name}.idx"))
+    except Exception as e:
+        logging.error(e)
+        raise Exception(f"Can't retrieve the snapshot index of {table_name} due to {e}")
+    return None if obj is None else decode_index(obj["body"])
+
+
+def save_snapshot_index(client, bucket, table_name, index):
+    """
+    Saves the snapshot index of a table.
+
+    Returns:
+        int: bytes uploaded
+    """
+    body = encode_index(index)
+    try:
+        run(get_storage(client).put(bucket, f"{snapshot_index_path}/{table_name}.idx", body))
+    except Exception as e:
+        logging.error(e)
+        raise Exception(f"Failed to save the snapshot index of {table_name}")
+    return len(body)
+
+
+def read_csv_object(client, bucket, key):
+    """
+    Reads a csv object into memory as a list of rows, header included.
+    """
+    try:
+        obj = run(get_storage(client).get(bucket, key))
+    except Exception as e:
+        logging.error(e)
+        raise Exception(f"Can't retrieve {key} due to {e}")
+    if obj is None:
+        logging.error(f"{key} doesn't exist")
+        raise Exception(f"Can't retrieve {key} as it doesn't exist")
+    return [row for row in csv.reader(StringIO(obj["body"].decode("utf-8"))) if row]
+
+
+def index_from_snapshot(client, bucket, key, primary_key, converters):
+    """
+    Builds the snapshot index of a table from a snapshot csv, for tables diffed
+    for the first time since snapshot indexes were introduced.
+    """
+    header, *rows = read_csv_object(client, bucket, key)
+    keys, hashes = index_rows(canonical_rows(rows, converters), header.index(primary_key))
+    return build_index([key], keys, hashes, np.zeros(len(rows), dtype=np.uint32))
+
+
+def rehash_index(client, bucket, index, primary_key, converters):
+    """
+    Hashes the rows of an index written before rows were hashed as canonical text
+    again, from the files they were last written to, so the first diff with it
+    doesn't report every row whose text changed as an update.
+    """
+    hashes = np.array(index["hashes"])
+    for file_id in np.unique(index["file_ids"]):
+        positions = np.flatnonzero(index["file_ids"] == file_id)
+        header, *rows = read_csv_object(client, bucket, index["files"][file_id])
+        keys, file_hashes = index_rows(canonical_rows(rows, converters), header.index(primary_key))
+        # Each key is in the file it was last written to once
+        found = np.searchsorted(index["keys"][positions], keys)
+        found[found == len(positions)] = 0
+        matched = index["keys"][positions][found] == keys
+        hashes[positions[found[matched]]] = file_hashes[matched]
+    return {**index, "hashes": hashes, "canonical": True}
+
+
+def find_deleted_rows(client, bucket, index, positions, primary_key, width):
+    """
+    Reads the last full row of each deleted key from the file it was last written
+    to, the original snapshot or a differences csv. Only the files holding deleted
+    keys are read, and only when a table has deletes.
+
+    Args:
+        positions (ndarray): positions of the deleted keys in the index
+        width (int): number of columns of the table, the change_type column of
+            differences csvs is dropped
+    """
+    deleted_rows = []
+    for file_id in np.unique(index["file_ids"][positions]):
+        file_keys = set(index["keys"][positions[index["file_ids"][positions] == file_id]].tolist())
+        header, *rows = read_csv_object(client, bucket, index["files"][file_id])
+        key_index = header.index(primary_key)
+        deleted_rows.extend(row[:width] for row in rows if int(row[key_index]) in file_keys)
+    return deleted_rows
+
+
+def get_table_columns(conn, table_name):
+    """
+    Returns (column name, data type) pairs for a table in column order. Used when
+    an engine isn't given the columns from the schema catalog.
+    """
+    query = (
+        "SELECT column_name, data_type FROM information_schema.columns "
+        "WHERE table_name = :table_name ORDER BY ordinal_position;"
+    )
+    return [tuple(column) for column in conn.run(query, table_name=table_name)]
+
+
+def build_watermark_condition(watermark, primary_key=None, seen_keys=None):
+    """
+    Builds the last_updated condition of an incremental extract, with watermark
+    the SQL for the watermark value (a bind parameter or an escaped literal).
+
+    Rows committed late with the same last_updated as the watermark would be
+    missed by a strict last_updated > watermark. When the primary key is known,
+    rows at the watermark are extracted again, minus seen_keys, the primary keys
+    of the rows already extracted at it.
+    """
+    if primary_key is None:
+        return f"last_updated > {watermark}"
+    condition = f"last_updated >= {watermark}"
+    if seen_keys:
+        keys = ", ".join(literal(key) for key in seen_keys)
+        condition += f" AND NOT (last_updated = {watermark} AND {identifier(primary_key)} IN ({keys}))"
+    return condition
+
+
+def build_select_query(table_name, watermark=None, primary_key=None, seen_keys=None):
+    """
+    Builds the SELECT statement (without a trailing semicolon) and its parameters
+    used to extract a table, filtered on last_updated when a watermark is given.
+    """
+    if watermark is None:
+        return f"SELECT * FROM {identifier(table_name)}", {}
+    return (
+        f"SELECT * FROM {identifier(table_name)} WHERE "
+        f"{build_watermark_condition(':watermark', primary_key, seen_keys)}",
+        {"watermark": watermark},
+    )
+
+
+def query_table(conn, table_name, watermark=None, primary_key=None, seen_keys=None):
+    """
+    Selects the rows of a table. When a watermark is given only rows updated after
+    it are returned, otherwise the whole table is returned.
+    """
+    query, params = build_select_query(table_name, watermark, primary_key, seen_keys)
+    return conn.run(f"{query};", **params)
+
+
+def find_max_last_updated(header, rows):
+    """
+    Finds the latest last_updated value within a set of rows so it can be used as
+    the next watermark. Returns None if there are no rows.
+    """
+    if not rows:
+        return None
+    column = header.index("last_updated")
+    latest = max(row[column] for row in rows)
+    if isinstance(latest, dt):
+        return latest.isoformat()
+    return str(latest)
+
+
+def stream_table(conn, table_name, watermark=None, batch_size=default_batch_size, primary_key=None, seen_keys=None):
+    """
+    Fetches a table through a server-side cursor, yielding lists of at most
+    batch_size rows so only one batch is held in memory at a time.
+    """
+    query, params = build_select_query(table_name, watermark, primary_key, seen_keys)
+    cursor = identifier(f"{table_name}_cursor")
+    conn.run("START TRANSACTION;")
+    try:
+        conn.run(f"DECLARE {cursor} NO SCROLL CURSOR FOR {query};", **params)
+        while True:
+            rows = conn.run(f"FETCH FORWARD {int(batch_size)} FROM {cursor};")
+            if not rows:
+                break
+            yield rows
+        conn.run(f"CLOSE {cursor};")
+    except BaseException:
+        conn.run("ROLLBACK;")
+        raise
+    conn.run("COMMIT;")
+
+
+def python_engine(pool, client, bucket, table_name, key, watermark=None, columns=None, primary_key=None, seen_keys=None):
+    """
+    Extraction engine that loads the whole table into memory with conn.run and
+    uploads it with a single put_object, as create_and_upload_to_bucket does.
+    The connection is released before uploading. Incremental extracts with no new
+    rows upload nothing.
+
+    Returns:
+        dict: number of rows extracted, bytes uploaded, their max last_updated and
+            the primary keys of the rows at it
+    """
+    with pool.connection() as conn:
+        header = [name for name, _ in columns or get_table_columns(conn, table_name)]
+        data_rows = query_table(conn, table_name, watermark, primary_key, seen_keys)
+
+    uploaded = 0
+    if data_rows or watermark is None:
+        uploaded = upload_csv_to_bucket([header] + data_rows, client, bucket, key)
+    _, watermark_keys = _latest(None, [], data_rows, header.index("last_updated"), _key_column(header, primary_key))
+    return {
+        "rows": len(data_rows),
+        "bytes": uploaded,
+        "max_last_updated": find_max_last_updated(header, data_rows),
+        "watermark_keys": watermark_keys,
+    }
+
+
+def _key_column(header, primary_key):
+    return header.index(primary_key) if primary_key in header else None
+
+
+def _latest(current, keys, batch, column, key_column=None):
+    """
+    Returns the later of current and the max value of a column within a batch,
+    with the primary keys (read from key_column, if given) of the rows holding it.
+    """
+    if not batch:
+        return current, keys
+    batch_max = max(row[column] for row in batch)
+    if current is not None and batch_max < current:
+        return current, keys
+    batch_keys = [] if key_column is None else [row[key_column] for row in batch if row[column] == batch_max]
+    if current is None or batch_max > current:
+        return batch_max, batch_keys
+    return current, keys + batch_keys
+
+
+def cursor_engine(pool, client, bucket, table_name, key, watermark=None, columns=None, primary_key=None, seen_keys=None,
+                  batch_size=default_batch_size):
+    """
+    Extraction engine that streams the table from a server-side cursor in batches,
+    encodes each batch as csv and pushes it through an S3 multipart upload. Peak
+    memory is bounded by the batch and part sizes rather than the table size.
+    Incremental extracts with no new rows upload nothing.
+
+    Returns:
+        dict: number of rows extracted, bytes uploaded, their max last_updated and
+            the primary keys of the rows at it
+    """
+    rows = 0
+    max_last_updated, watermark_keys = None, []
+    with pool.connection() as conn, get_storage(client).writer(bucket, key) as writer:
+        header = [name for name, _ in columns or get_table_columns(conn, table_name)]
+        last_updated = header.index("last_updated")
+        key_column = _key_column(header, primary_key)
+        file_to_save = StringIO()
+        csv.writer(file_to_save).writerow(header)
+        writer.write(file_to_save.getvalue().encode("utf-8"))
+        for batch in stream_table(conn, table_name, watermark, batch_size, primary_key, seen_keys):
+            file_to_save = StringIO()
+            csv.writer(file_to_save).writerows(batch)
+            writer.write(file_to_save.getvalue().encode("utf-8"))
+            rows += len(batch)
+            max_last_updated, watermark_keys = _latest(max_last_updated, watermark_keys, batch, last_updated, key_column)
+        if rows == 0 and watermark is not None:
+            writer.abort()
+
+    if isinstance(max_last_updated, dt):
+        max_last_updated = max_last_updated.isoformat()
+    return {
+        "rows": rows,
+        "bytes": writer.bytes_written if rows or watermark is None else 0,
+        "max_last_updated": max_last_updated,
+        "watermark_keys": watermark_keys,
+    }
+
+
+def build_copy_query(table_name, watermark=None, upper_bound=None, primary_key=None, seen_keys=None):
+    """
+    Builds a COPY statement that makes Postgres write a table straight out as csv
+    with a header. COPY doesn't accept bind parameters, so the last_updated bounds
+    are escaped with pg8000's literal instead.
+    """
+    conditions = []
+    if watermark is not None:
+        conditions.append(build_watermark_condition(literal(watermark), primary_key, seen_keys))
+    if upper_bound is not None:
+        conditions.append(f"last_updated <= {literal(upper_bound)}")
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return f"COPY (SELECT * FROM {identifier(table_name)}{where}) TO STDOUT WITH (FORMAT csv, HEADER)"
+
+
+def copy_engine(pool, client, bucket, table_name, key, watermark=None, columns=None, primary_key=None, seen_keys=None):
+    """
+    Extraction engine that has Postgres produce the csv bytes itself with
+    COPY ... TO STDOUT, streamed by pg8000 straight into an S3 multipart upload.
+    Rows are never decoded into Python objects, which makes it the cheapest engine
+    on large tables.
+
+    The max last_updated is read first and used as an upper bound on the COPY, so
+    the returned watermark matches exactly the rows that were copied. The keys of
+    the rows at it are read before the COPY, so a row committed in between is
+    extracted again by the next run rather than missed. Note that
+    Postgres formats values its own way (booleans as t/f, timestamps without
+    trailing zeros), so its csv is not byte for byte the same as the other engines'.
+    Incremental extracts with no new rows upload nothing.
+
+    Returns:
+        dict: number of rows extracted, bytes uploaded, their max last_updated and
+            the primary keys of the rows at it
+    """
+    with pool.connection() as conn:
+        if watermark is None:
+            upper_bound = conn.run(f"SELECT max(last_updated) FROM {identifier(table_name)};")[0][0]
+        else:
+            upper_bound = conn.run(
+                f"SELECT max(last_updated) FROM {identifier(table_name)} "
+                f"WHERE {build_watermark_condition(':watermark', primary_key, seen_keys)};",
+                watermark=watermark,
+            )[0][0]
+            if upper_bound is None:
+                return {"rows": 0, "bytes": 0, "max_last_updated": None, "watermark_keys": []}
+
+        watermark_keys = []
+        if primary_key is not None and upper_bound is not None:
+            watermark_keys = [
+                row[0] for row in conn.run(
+                    f"SELECT {identifier(primary_key)} FROM {identifier(table_name)} WHERE last_updated = :upper_bound;",
+                    upper_bound=upper_bound,
+                )
+            ]
+        with get_storage(client).writer(bucket, key) as writer:
+            conn.run(build_copy_query(table_name, watermark, upper_bound, primary_key, seen_keys), stream=writer)
+        rows = conn.row_count
+
+    if isinstance(upper_bound, dt):
+        upper_bound = upper_bound.isoformat()
+    return {"rows": rows, "bytes": writer.bytes_written, "max_last_updated": upper_bound, "watermark_keys": watermark_keys}
+
+
+def arrow_type(data_type):
+    """
+    Maps a Postgres data type, as named by information_schema, to an Arrow type.
+    Anything not listed is kept as a string.
+    """
+    import pyarrow as pa
+
+    arrow_types = {
+        "smallint": pa.int16(),
+        "integer": pa.int32(),
+        "bigint": pa.int64(),
+        "numeric": pa.decimal128(38, numeric_scale),
+        "real": pa.float32(),
+        "double precision": pa.float64(),
+        "boolean": pa.bool_(),
+        "date": pa.date32(),
+        "timestamp without time zone": pa.timestamp("us"),
+        "timestamp with time zone": pa.timestamp("us", tz="UTC"),
+    }
+    return arrow_types.get(data_type, pa.string())
+
+
+def parquet_engine(pool, client, bucket, table_name, key, watermark=None, columns=None, primary_key=None, seen_keys=None,
+                   batch_size=default_batch_size):
+    """
+    Extraction engine that streams the table from a server-side cursor and writes
+    it as zstd compressed Parquet, one row group per batch, through an S3
+    multipart upload. Columns are typed from information_schema so numeric,
+    timestamp and boolean values keep their types and transform doesn't have to
+    parse or infer anything. Needs pyarrow, which is only imported when used.
+    Incremental extracts with no new rows upload nothing.
+
+    Returns:
+        dict: number of rows extracted, bytes uploaded, their max last_updated and
+            the primary keys of the rows at it
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception("pyarrow is required to extract tables as parquet")
+
+    rows = 0
+    max_last_updated, watermark_keys = None, []
+    with pool.connection() as conn, get_storage(client).writer(bucket, key) as writer:
+        columns = columns or get_table_columns(conn, table_name)
+        schema = pa.schema([(name, arrow_type(data_type)) for name, data_type in columns])
+        last_updated = schema.get_field_index("last_updated")
+        key_column = _key_column(schema.names, primary_key)
+        with pq.ParquetWriter(writer, schema, compression="zstd") as parquet_writer:
+            for batch in stream_table(conn, table_name, watermark, batch_size, primary_key, seen_keys):
+                arrays = [
+                    pa.array([row[i] for row in batch], type=field.type)
+                    for i, field in enumerate(schema)
+                ]
+                parquet_writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                rows += len(batch)
+                max_last_updated, watermark_keys = _latest(max_last_updated, watermark_keys, batch, last_updated, key_column)
+        if rows == 0 and watermark is not None:
+            writer.abort()
+
+    if isinstance(max_last_updated, dt):
+        max_last_updated = max_last_updated.isoformat()
+    return {
+        "rows": rows,
+        "bytes": writer.bytes_written if rows or watermark is None else 0,
+        "max_last_updated": max_last_updated,
+        "watermark_keys": watermark_keys,
+    }
+
+
+# Every engine is called as engine(pool, client, bucket, table_name, key, watermark, columns,
+# primary_key, seen_keys), where columns are the table's (name, data type) pairs from the
+# schema catalog and seen_keys the keys of the rows already extracted at the watermark
+extraction_engines = {
+    "python": python_engine,
+    "cursor": cursor_engine,
+    "copy": copy_engine,
+    "parquet": parquet_engine,
+}
+
+
+def diff_table(pool, client, bucket, table_name, key, original_key, columns=None, primary_key=None,
+               batch_size=default_batch_size):
+    """
+    Diffs a table's snapshot against the previous one in memory. The table is
+    streamed from a server-side cursor and each batch is compared with the table's
+    snapshot index by binary search over its sorted primary keys, see
+    diff_utils.diff_batch. The snapshot is never uploaded, downloaded or written to
+    /tmp, and only the changed rows are uploaded to key, with a change_type
+    column. Nothing is uploaded when nothing changed.
+
+    The index is built from the original snapshot the first time. Rows are hashed
+    as canonical text (see diff_utils.canonical_converters), so a row's hash is
+    the same whichever engine wrote the snapshot it was read from.
+
+    Returns:
+        dict: rows read, bytes uploaded, their max last_updated, the primary keys
+            of the rows at it and the number of changes found
+    """
+    index = get_snapshot_index(client, bucket, table_name)
+    rebuilt = index is None
+    with pool.connection() as conn:
+        columns = columns or get_table_columns(conn, table_name)
+        header = [name for name, _ in columns]
+        converters = canonical_converters([data_type for _, data_type in columns])
+        primary_key = primary_key or header[0]
+        key_index = header.index(primary_key)
+        last_updated = header.index("last_updated")
+        if rebuilt:
+            index = index_from_snapshot(client, bucket, original_key, primary_key, converters)
+        elif not index["canonical"]:
+            index = rehash_index(client, bucket, index, primary_key, converters)
+            rebuilt = True
+        file_id = len(index["files"])
+        seen = np.zeros(len(index["keys"]), dtype=bool)
+        rows = 0
+        max_last_updated, watermark_keys = None, []
+        changes = []
+        new_keys, new_hashes, new_file_ids = [], [], []
+        for batch in stream_table(conn, table_name, batch_size=batch_size):
+            rows += len(batch)
+            max_last_updated, watermark_keys = _latest(max_last_updated, watermark_keys, batch, last_updated, key_index)
+            keys, hashes = index_rows(canonical_rows(batch, converters), key_index)
+            batch = [["" if value is None else str(value) for value in row] for row in batch]
+            positions, changed = diff_batch(index, keys, hashes, seen)
+            changes.extend(
+                batch[i] + [INSERT if positions[i] < 0 else UPDATE] for i in np.flatnonzero(changed)
+            )
+            new_keys.append(keys)
+            new_hashes.append(hashes)
+            # Unchanged rows were found in the index and keep their file, the rest
+            # are in the delta. Only found positions are gathered, as the index
+            # is empty when the table was empty at its last snapshot.
+            file_ids = np.full(len(keys), file_id, dtype=np.uint32)
+            file_ids[~changed] = index["file_ids"][positions[~changed]]
+            new_file_ids.append(file_ids)
+
+    deleted = np.flatnonzero(~seen)
+    uploaded = 0
+    if changes or len(deleted):
+        deleted_rows = find_deleted_rows(client, bucket, index, deleted, primary_key, len(header))
+        uploaded = upload_csv_to_bucket(
+            [header + ["change_type"]] + changes + [row + [DELETE] for row in deleted_rows], client, bucket, key
+        )
+    if changes or len(deleted) or rebuilt:
+        # Only saved once the changed rows are safely in S3
+        new_index = build_index(
+            index["files"] + [key],
+            np.concatenate(new_keys or [np.empty(0, dtype=np.int64)]),
+            np.concatenate(new_hashes or [np.empty(0, dtype=np.uint64)]),
+            np.concatenate(new_file_ids or [np.empty(0, dtype=np.uint32)]),
+        )
+        save_snapshot_index(client, bucket, table_name, new_index)
+
+    if isinstance(max_last_updated, dt):
+        max_last_updated = max_last_updated.isoformat()
+    return {
+        "rows": rows,
+        "bytes": uploaded,
+        "max_last_updated": max_last_updated,
+        "watermark_keys": watermark_keys,
+        "changes": len(changes) + len(deleted),
+    }
+
+
+def compare_csvs(csv1, csv2, primary_key=None, output_dir="/tmp"):
+    """
+    Takes two csvs and compares the differences between them by primary key,
+    returning a csv containing only its header if no differences found.
+
+    Args:
+    csv1 - Csv containing previous database data
+    csv2 - Csv containing new database data
+    primary_key - Name of the primary key column, defaults to the first column
+    output_dir - Directory the differences csv is written to
+
+    Returns:
+    name of the csv file in output_dir containing every inserted, updated and deleted
+    row, with the type of change in an extra change_type column
+    """
+    header = read_header(csv2)
+    if primary_key is None:
+        primary_key = header[0]
+    partitions = os.path.getsize(csv1) // diff_partition_size + 1
+
+    filepath = f"differences_{create_time_prefix_for_file()}.csv"
+    changes_found = False
+    with open(os.path.join(output_dir, filepath), "w", newline='') as f:
+        csvwriter = csv.writer(f)
+        csvwriter.writerow(header + ["change_type"])
+        for change_type, row in diff_snapshots(csv1, csv2, primary_key, partitions):
+            csvwriter.writerow(row + [change_type])
+            changes_found = True
+
+    if not changes_found:
+        logging.info("No changes in table found")
+    else:
+        logging.info("Changes found in table")
 
     return filepath
@@ -0,0 +1,142 @@
+import logging
+from datetime import datetime, timezone
+import polars as pl
+from pg8000.native import Error, identifier
+from src.utils.metrics_utils import emit_values
+from src.utils.transform_utils import star_schema, updated_columns, parse_time_prefix
+
+# The warehouse has to be no more than 30 minutes behind totesys
+freshness_target_seconds = 30 * 60
+freshness_table = "pipeline_freshness"
+lag_percentiles = [50, 90, 99]
+
+freshness_columns = {
+    "time_prefix": "varchar NOT NULL",
+    "table_name": "varchar NOT NULL",
+    "rows": "int NOT NULL",
+    "source_last_updated": "timestamp",
+    "extracted_at": "timestamp NOT NULL",
+    "processed_at": "timestamp",
+    "loaded_at": "timestamp NOT NULL",
+    "extract_lag_seconds": "numeric",
+    "transform_lag_seconds": "numeric",
+    "load_lag_seconds": "numeric",
+    **{f"lag_p{percentile}_seconds": "numeric" for percentile in lag_percentiles},
+    "lag_max_seconds": "numeric",
+}
+
+
+def utc_now():
+    """The current time as a naive UTC datetime, like the time prefixes and totesys' timestamps."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def source_last_updated(table_name, latest_updates):
+    """
+    The newest source change a warehouse table was built from in this run, from
+    the max last_updated of each raw table the extract function passes on.
+
+    Returns:
+        datetime: the latest of its sources' max last_updated, None if none of
+            them were passed on
+    """
+    sources = star_schema[table_name]["sources"] if table_name in star_schema else [table_name]
+    values = [datetime.fromisoformat(latest_updates[source]) for source in sources if latest_updates.get(source)]
+    return max(values, default=None)
+
+
+def row_lags(df, loaded_at):
+    """
+    Seconds between each row's source change and loaded_at, for tables that carry
+    their last_updated (or valid_from, for facts with history).
+
+    Returns:
+        Series: the lags, None for tables without a last_updated column
+    """
+    column = next((column for column in updated_columns if column in df.columns), None)
+    if column is None:
+        return None
+    return df.select(
+        ((pl.lit(loaded_at, dtype=pl.Datetime("us")) - pl.col(column)).dt.total_milliseconds() / 1000).alias("lag")
+    ).to_series().drop_nulls()
+
+
+def seconds_between(start, end):
+    if start is None or end is None:
+        return None
+    return round((end - start).total_seconds(), 3)
+
+
+def freshness_report(table_name, df, prefix, latest_source_update, processed_at=None, loaded_at=None):
+    """
+    Works out how far behind totesys a table was when it was loaded, split into
+    the time each stage took: source change to extract (the run's time prefix),
+    extract to the processed file being written, and that to the load finishing.
+
+    Lag percentiles are taken over the rows' own last_updated where the table has
+    one, otherwise the newest source change is the only value.
+
+    Returns:
+        dict: a row for the freshness table, None when neither is known, e.g. dim_date
+    """
+    loaded_at = loaded_at or utc_now()
+    extracted_at = parse_time_prefix(prefix)
+    lags = row_lags(df, loaded_at)
+    if lags is None or lags.is_empty():
+        if latest_source_update is None:
+            return None
+        lags = pl.Series("lag", [seconds_between(latest_source_update, loaded_at)])
+
+    report = {
+        "time_prefix": prefix,
+        "table_name": table_name,
+        "rows": df.height,
+        "source_last_updated": latest_source_update,
+        "extracted_at": extracted_at,
+        "processed_at": processed_at,
+        "loaded_at": loaded_at,
+        "extract_lag_seconds": seconds_between(latest_source_update, extracted_at),
+        "transform_lag_seconds": seconds_between(extracted_at, processed_at),
+        "load_lag_seconds": seconds_between(processed_at or extracted_at, loaded_at),
+    }
+    for percentile in lag_percentiles:
+        report[f"lag_p{percentile}_seconds"] = round(lags.quantile(percentile / 100, "linear"), 3)
+    report["lag_max_seconds"] = round(lags.max(), 3)
+    return report
+
+
+def build_freshness_table_query():
+    columns = ", ".join(f"{identifier(column)} {data_type}" for column, data_type in freshness_columns.items())
+    return (
+        f"CREATE TABLE IF NOT EXISTS {identifier(freshness_table)} "
+        f"({identifier(freshness_table + '_id')} SERIAL PRIMARY KEY, {columns})"
+    )
+
+
+def record_freshness(conn, report):
+    """
+    Adds a table's freshness report to the freshness table in the warehouse,
+    creating it if it isn't there, and emits its lags as metrics. A failure to
+    record it is logged rather than raised, as the data itself is loaded.
+    """
+    emit_values(
+        "freshness", report["table_name"],
+        {
+            name: report[f"{name}_seconds"]
+            for name in ["extract_lag", "transform_lag", "load_lag", "lag_max"]
+            + [f"lag_p{percentile}" for percentile in lag_percentiles]
+        },
+        "Seconds",
+    )
+    if report["lag_max_seconds"] > freshness_target_seconds:
+        logging.warning(
+            f"{report['table_name']} was loaded {report['lag_max_seconds']}s after its source changed, "
+            f"over the {freshness_target_seconds}s target"
+        )
+    try:
+        conn.run(build_freshness_table_query())
+        columns = ", ".join(identifier(column) for column in freshness_columns)
+        values = ", ".join(f":{column}" for column in freshness_columns)
+        conn.run(f"INSERT INTO {identifier(freshness_table)} ({columns}) VALUES ({values})", **report)
+    except Error as e:
+        logging.error(f"Failed to record the freshness of {report['table_name']}: {e}")
@@ -0,0 +1,228 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+from io import BytesIO
+import polars as pl
+from pg8000.native import Error, identifier
+from src.utils.metrics_utils import measured
+from src.utils.storage_utils import get_storage, run
+
+warehouse_secret_name = "totesys_warehouse_credentials"
+
+default_batch_size = 50000
+# How many tables' files are downloaded ahead of the one being loaded
+default_prefetch = 2
+# Column added to staging tables with each row's position in the loaded file
+staged_row_column = "staged_row"
+
+# Tables loaded into the warehouse, in load order so dimensions are there before
+# the facts that reference them. Dimensions only hold the latest version of each
+# row and are upserted on their key, facts keep every version of the rows of
+# their history key and are appended.
+warehouse_tables = {
+    "dim_date": {"key": "date_id"},
+    "dim_staff": {"key": "staff_id"},
+    "dim_location": {"key": "location_id"},
+    "dim_design": {"key": "design_id"},
+    "dim_currency": {"key": "currency_id"},
+    "dim_counterparty": {"key": "counterparty_id"},
+    "fact_sales_order": {"key": None, "history": "sales_order_id"},
+    "fact_purchase_orders": {"key": None, "history": "purchase_order_id"},
+    "fact_payment": {"key": None, "history": "payment_id"},
+}
+
+
+def read_processed_file(client, bucket, key):
+    """
+    Reads a parquet file from the processed data bucket into a data frame, along
+    with when it was written.
+
+    Returns:
+        tuple: the file's rows and its last modified time as a naive UTC datetime,
+            (None, None) if the file doesn't exist
+    """
+    return read_processed_files(client, bucket, [key])[key]
+
+
+def read_processed_files(client, bucket, keys):
+    """
+    Reads several parquet files from the processed data bucket at once, through
+    the async storage, see read_processed_file.
+
+    Returns:
+        dict: key -> (rows, last modified time), (None, None) for missing files
+    """
+    objects = run(get_storage(client).get_many(bucket, keys))
+    return {
+        key: (None, None) if obj is None else (
+            pl.read_parquet(obj["body"]), obj["last_modified"].astimezone(timezone.utc).replace(tzinfo=None)
+        )
+        for key, obj in objects.items()
+    }
+
+
+def prefetch_processed_files(client, bucket, keys, prefetch=default_prefetch):
+    """
+    Reads the processed files of keys in order, see read_processed_file, while the
+    next prefetch files are downloaded in the background. Only those files and the
+    one being used are held in memory, however many tables are loaded.
+
+    Yields:
+        tuple: key and (rows, last modified time)
+    """
+    with ThreadPoolExecutor(max_workers=max(1, prefetch)) as executor:
+        pending = deque()
+        for key in keys:
+            pending.append((key, executor.submit(read_processed_file, client, bucket, key)))
+            if len(pending) > prefetch:
+                key, future = pending.popleft()
+                yield key, future.result()
+        while pending:
+            key, future = pending.popleft()
+            yield key, future.result()
+
+
+def read_processed_parquet(client, bucket, key):
+    """
+    Reads a parquet file from the processed data bucket into a data frame.
+
+    Returns:
+        DataFrame: the file's rows, None if the file doesn't exist
+    """
+    return read_processed_file(client, bucket, key)[0]
+
+
+def copy_into(conn, table_name, df, batch_size=default_batch_size):
+    """
+    Bulk inserts a data frame into a table with COPY FROM STDIN, sending the rows
+    as csv in batches of batch_size so only one batch is encoded at a time. Nulls
+    are written as unquoted empty fields and empty strings as "", which is how
+    COPY tells them apart.
+    """
+    columns = ", ".join(identifier(column) for column in df.columns)
+    sql = f"COPY {identifier(table_name)} ({columns}) FROM STDIN WITH (FORMAT csv)"
+    for offset in range(0, df.height, batch_size):
+        buffer = BytesIO()
+        df.slice(offset, batch_size).write_csv(buffer, include_header=False)
+        buffer.seek(0)
+        conn.run(sql, stream=buffer)
+
+
+def build_upsert_query(table_name, staging_table, columns, key):
+    """
+    Builds the statement that moves the rows of a staging table into a dimension,
+    updating rows whose key is already there. Only the last row loaded for each key
+    is kept, as ON CONFLICT can't update the same row twice in one statement. The
+    last row is found by the staged_row column, as the physical order of a table
+    isn't guaranteed to follow the order rows were copied in.
+    """
+    column_list = ", ".join(identifier(column) for column in columns)
+    updates = ", ".join(
+        f"{identifier(column)} = EXCLUDED.{identifier(column)}"
+        for column in columns
+        if column != key
+    )
+    on_conflict = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+    return (
+        f"INSERT INTO {identifier(table_name)} ({column_list}) "
+        f"SELECT DISTINCT ON ({identifier(key)}) {column_list} FROM {identifier(staging_table)} "
+        f"ORDER BY {identifier(key)}, {identifier(staged_row_column)} DESC "
+        f"ON CONFLICT ({identifier(key)}) {on_conflict}"
+    )
+
+
+def upsert_dimension(conn, table_name, df, key, batch_size=default_batch_size):
+    """
+    Upserts a dimension: the rows are copied into a temporary staging table shaped
+    like the dimension, numbered in the order of the data frame, then merged into
+    it with a single INSERT ... ON CONFLICT, all in one transaction.
+    """
+    staging_table = f"staging_{table_name}"
+    conn.run("START TRANSACTION")
+    try:
+        conn.run(
+            f"CREATE TEMPORARY TABLE {identifier(staging_table)} "
+            f"(LIKE {identifier(table_name)} INCLUDING DEFAULTS, {identifier(staged_row_column)} bigint) ON COMMIT DROP"
+        )
+        copy_into(conn, staging_table, df.with_row_index(staged_row_column), batch_size)
+        conn.run(build_upsert_query(table_name, staging_table, df.columns, key))
+        conn.run("COMMIT")
+    except Exception:
+        conn.run("ROLLBACK")
+        raise
+
+
+def build_close_versions_query(table_name, staging_table, key):
+    """
+    Builds the statement that closes the versions left open by previous loads:
+    the open version of every key in the staging table is valid until the first
+    staged version of the key.
+    """
+    table, key = identifier(table_name), identifier(key)
+    return (
+        f"UPDATE {table} SET valid_to = staged.valid_from "
+        f"FROM (SELECT {key}, min(valid_from) AS valid_from FROM {identifier(staging_table)} GROUP BY {key}) AS staged "
+        f"WHERE {table}.{key} = staged.{key} AND {table}.valid_to IS NULL"
+    )
+
+
+def append_fact(conn, table_name, df, batch_size=default_batch_size, history_key=None):
+    """
+    Appends rows to a fact table, copying every batch in one transaction so a
+    failed load doesn't leave part of the file behind.
+
+    Versions of the rows of history_key are staged first, so the versions left
+    open by previous loads can be closed before the new ones are inserted, in
+    the order of the data frame.
+    """
+    conn.run("START TRANSACTION")
+    try:
+        if history_key is None or "valid_to" not in df.columns:
+            copy_into(conn, table_name, df, batch_size)
+        else:
+            staging_table = f"staging_{table_name}"
+            columns = ", ".join(identifier(column) for column in df.columns)
+            conn.run(
+                f"CREATE TEMPORARY TABLE {identifier(staging_table)} ON COMMIT DROP AS "
+                f"SELECT {columns}, NULL::bigint AS {identifier(staged_row_column)} "
+                f"FROM {identifier(table_name)} WITH NO DATA"
+            )
+            copy_into(conn, staging_table, df.with_row_index(staged_row_column), batch_size)
+            conn.run(build_close_versions_query(table_name, staging_table, history_key))
+            conn.run(
+                f"INSERT INTO {identifier(table_name)} ({columns}) "
+                f"SELECT {columns} FROM {identifier(staging_table)} ORDER BY {identifier(staged_row_column)}"
+            )
+        conn.run("COMMIT")
+    except Exception:
+        conn.run("ROLLBACK")
+        raise
+
+
+@measured("load")
+def load_table(conn, table_name, df, batch_size=default_batch_size):
+    """
+    Loads a data frame into a warehouse table, upserting dimensions and appending
+    facts as set out in warehouse_tables.
+
+    Returns:
+        dict: rows loaded, seconds taken and rows per second
+    """
+    key = warehouse_tables[table_name]["key"]
+    start = time.perf_counter()
+    try:
+        if key is None:
+            append_fact(conn, table_name, df, batch_size, warehouse_tables[table_name].get("history"))
+        else:
+            upsert_dimension(conn, table_name, df, key, batch_size)
+    except Error as e:
+        logging.error(e)
+        raise Exception(f"Failed to load {table_name}")
+    seconds = time.perf_counter() - start
+    return {
+        "rows": df.height,
+        "seconds": round(seconds, 4),
+        "rows_per_sec": round(df.height / seconds) if seconds else None,
+    }
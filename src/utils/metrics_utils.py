@@ -0,0 +1,181 @@
+import functools
+import inspect
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+namespace = "Totesys/Pipeline"
+# "emf" prints every record as a CloudWatch Embedded Metric Format log line,
+# "local" only keeps them for metrics_summary. Neither makes any external call:
+# CloudWatch extracts the metrics from the function's logs.
+default_sink = "emf"
+metric_units = {
+    "seconds": ("Seconds", "Seconds"),
+    "rows": ("Rows", "Count"),
+    "bytes_in": ("BytesIn", "Bytes"),
+    "bytes_out": ("BytesOut", "Bytes"),
+    "peak_rss_mb": ("PeakMemory", "Megabytes"),
+}
+# Keys of the dicts returned by functions decorated with measured that are
+# copied into their record
+result_fields = {"rows": "rows", "bytes_in": "bytes_in", "bytes_out": "bytes_out", "parquet_bytes": "bytes_out"}
+
+# Module level like cache_utils, as tables are measured from several threads
+_records = []
+_started = [time.perf_counter()]
+_lock = threading.Lock()
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the process so far. Tables measured at the same
+    time share the process, so this is the high-water mark when a stage finished
+    rather than the stage's own use.
+    """
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def get_sink():
+    return os.getenv("METRICS_SINK", default_sink)
+
+
+def reset_metrics():
+    """Drops the records of the previous invocation, called as a handler starts."""
+    with _lock:
+        _records.clear()
+        _started[0] = time.perf_counter()
+
+
+def emf_object(stage, table_name, metrics, properties=None):
+    """
+    Formats metrics as a CloudWatch Embedded Metric Format object, dimensioned by
+    stage and by stage and table.
+
+    Args:
+        metrics (dict): metric name to (value, unit)
+        properties (dict): extra values logged alongside, not turned into metrics
+    """
+    dimensions = {"Stage": stage}
+    if table_name is not None:
+        dimensions["Table"] = table_name
+    return {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": namespace,
+                "Dimensions": [["Stage"], list(dimensions)] if "Table" in dimensions else [["Stage"]],
+                "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in metrics.items()],
+            }],
+        },
+        **dimensions,
+        **{name: value for name, (value, _) in metrics.items()},
+        **(properties or {}),
+    }
+
+
+def emf_line(record):
+    """Formats a record made by measure as a CloudWatch Embedded Metric Format object."""
+    metrics = {name: (record[field], unit) for field, (name, unit) in metric_units.items()}
+    return emf_object(record["stage"], record["table_name"], metrics, {"Failed": record["failed"]})
+
+
+def write_emf(emf):
+    if get_sink() == "emf":
+        # Written straight to stdout, a logging prefix would stop CloudWatch parsing it
+        sys.stdout.write(json.dumps(emf, default=str) + "\n")
+
+
+def emit(record):
+    with _lock:
+        _records.append(record)
+    write_emf(emf_line(record))
+
+
+def emit_values(stage, table_name, values, unit):
+    """
+    Emits values that aren't measured with measure, e.g. lags, as metrics in the
+    same unit. Values that are None are left out. They aren't part of metrics_summary.
+    """
+    metrics = {
+        "".join(part.capitalize() for part in name.split("_")): (value, unit)
+        for name, value in values.items() if value is not None
+    }
+    write_emf(emf_object(stage, table_name, metrics))
+
+
+@contextmanager
+def measure(stage, table_name=None):
+    """
+    Measures a stage of the pipeline for one table. The yielded record's rows,
+    bytes_in and bytes_out are filled in by the caller, seconds and peak memory
+    are added when the block exits, and the record is emitted even if it raises.
+
+        with measure("extract", "sales_order") as record:
+            record["rows"] = ...
+    """
+    record = {"stage": stage, "table_name": table_name, "rows": 0, "bytes_in": 0, "bytes_out": 0, "failed": False}
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception:
+        record["failed"] = True
+        raise
+    finally:
+        record["seconds"] = round(time.perf_counter() - start, 4)
+        record["peak_rss_mb"] = peak_rss_mb()
+        emit(record)
+
+
+def measured(stage):
+    """
+    Decorator measuring every call of a function as a stage, for the table given
+    by its table_name argument. The fields named in result_fields are copied from
+    the dict it returns.
+    """
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            table_name = signature.bind(*args, **kwargs).arguments.get("table_name")
+            with measure(stage, table_name) as record:
+                result = function(*args, **kwargs)
+                if isinstance(result, dict):
+                    for key, field in result_fields.items():
+                        if key in result:
+                            record[field] = result[key]
+            return result
+        return wrapper
+    return decorator
+
+
+def metrics_summary():
+    """
+    Totals of the records since reset_metrics, for the handler's return payload.
+
+    Returns:
+        dict: wall seconds, peak memory, and for each stage the tables measured,
+            the failed ones and the total seconds, rows and bytes
+    """
+    with _lock:
+        records = list(_records)
+        started = _started[0]
+    stages = {}
+    for record in records:
+        totals = stages.setdefault(
+            record["stage"], {"tables": 0, "failed": 0, "seconds": 0, "rows": 0, "bytes_in": 0, "bytes_out": 0}
+        )
+        totals["tables"] += 1
+        totals["failed"] += record["failed"]
+        for field in ["seconds", "rows", "bytes_in", "bytes_out"]:
+            totals[field] += record[field] or 0
+        totals["seconds"] = round(totals["seconds"], 4)
+    return {
+        "wall_seconds": round(time.perf_counter() - started, 4),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": stages,
+    }
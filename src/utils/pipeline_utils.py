@@ -0,0 +1,134 @@
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from src.utils.transform_utils import star_schema
+
+default_max_workers = 4
+
+
+def node_id(stage, table_name):
+    return f"{stage}:{table_name}"
+
+
+def pipeline_nodes(changed_tables):
+    """
+    Works out the steps a run needs from the raw tables that changed in it. Raw
+    tables that didn't change, and the warehouse tables built only from them, are
+    left out entirely.
+
+    A warehouse table is built once every changed raw table it's made from has been
+    transformed, and loaded once it's built and the dimensions it references that
+    are also loaded in this run are there.
+
+    Returns:
+        dict: node id ("stage:table_name") to {"stage", "table_name", "needs"},
+            where needs lists the ids of the nodes it depends on
+    """
+    nodes = {}
+    for table_name in changed_tables:
+        nodes[node_id("transform", table_name)] = {"stage": "transform", "table_name": table_name, "needs": []}
+
+    for table_name, spec in star_schema.items():
+        sources = [source for source in spec["sources"] if source in changed_tables]
+        if sources:
+            nodes[node_id("star", table_name)] = {
+                "stage": "star",
+                "table_name": table_name,
+                "needs": [node_id("transform", source) for source in sources],
+            }
+
+    for table_name, spec in star_schema.items():
+        if node_id("star", table_name) not in nodes:
+            continue
+        references = [
+            node_id("load", dimension) for dimension in spec.get("references", [])
+            if node_id("star", dimension) in nodes
+        ]
+        nodes[node_id("load", table_name)] = {
+            "stage": "load",
+            "table_name": table_name,
+            "needs": [node_id("star", table_name)] + references,
+        }
+    return nodes
+
+
+def pipeline_waves(nodes):
+    """
+    Groups the nodes into waves, each only depending on the waves before it, for
+    runners that can't start a node as soon as its own dependencies finish, like
+    the Step Function's Map states.
+
+    Returns:
+        list: lists of {"stage", "table_name"}, in the order they have to run
+    """
+    done = set()
+    waves = []
+    remaining = dict(nodes)
+    while remaining:
+        ready = sorted(node for node, spec in remaining.items() if all(need in done for need in spec["needs"]))
+        if not ready:
+            raise Exception(f"Pipeline has a dependency cycle between {sorted(remaining)}")
+        waves.append([{"stage": remaining[node]["stage"], "table_name": remaining[node]["table_name"]} for node in ready])
+        done.update(ready)
+        for node in ready:
+            del remaining[node]
+    return waves
+
+
+def run_pipeline(nodes, run_node, max_workers=default_max_workers, executor_class=ProcessPoolExecutor):
+    """
+    Runs the nodes on a pool, starting each one as soon as the nodes it needs have
+    finished, so a slow table only holds up the tables that depend on it. Nodes
+    depending on one that failed are skipped.
+
+    Args:
+        nodes (dict): as returned by pipeline_nodes
+        run_node (callable): called as run_node(stage, table_name), has to be
+            picklable for a process pool, e.g. a module level function or a
+            functools.partial of one
+        max_workers (int): how many nodes run at the same time
+        executor_class: ProcessPoolExecutor, or ThreadPoolExecutor for nodes that
+            are mostly waiting on I/O
+
+    Returns:
+        dict: results of the nodes that succeeded, errors of the ones that failed,
+            the ids of the nodes skipped and seconds taken
+    """
+    start = time.perf_counter()
+    results = {}
+    failed = {}
+    skipped = []
+    waiting = dict(nodes)
+    running = {}
+    with executor_class(max_workers=max_workers) as executor:
+        while waiting or running:
+            progressed = False
+            for node, spec in list(waiting.items()):
+                if any(need in failed or need in skipped for need in spec["needs"]):
+                    skipped.append(node)
+                elif all(need in results for need in spec["needs"]):
+                    running[executor.submit(run_node, spec["stage"], spec["table_name"])] = node
+                else:
+                    continue
+                del waiting[node]
+                progressed = True
+            if not running:
+                if waiting and not progressed:
+                    raise Exception(f"Pipeline has a dependency cycle between {sorted(waiting)}")
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                try:
+                    results[node] = future.result()
+                except Exception as e:
+                    logging.error(f"Failed to run {node}: {e}")
+                    failed[node] = str(e)
+
+    return {
+        "results": results,
+        "failed": failed,
+        "skipped": sorted(skipped),
+        "seconds": round(time.perf_counter() - start, 4),
+    }
@@ -0,0 +1,126 @@
+import logging
+from botocore.exceptions import ClientError, BotoCoreError
+
+# S3 rejects multipart parts smaller than 5MB, apart from the last one
+minimum_part_size = 5 * 1024 * 1024
+
+
+class S3MultipartWriter:
+    """
+    A write-only file-like object that uploads everything written to it to a
+    single S3 object. Data is buffered until a part is big enough and then sent
+    with upload_part, so memory use is bounded by the part size rather than the
+    size of the object. Objects smaller than one part are sent with a single
+    put_object call on close.
+
+    Use it as a context manager: the upload is completed when the block exits
+    normally and aborted if it raises, so no half written object is left behind.
+
+    Every request is made with call(function, **kwargs), e.g. to retry it as
+    storage_utils.call_with_retries does, and made once if call is None.
+    """
+
+    def __init__(self, client, bucket, key, part_size=minimum_part_size, call=None):
+        self.client = client
+        self.call = call or (lambda function, **kwargs: function(**kwargs))
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, minimum_part_size)
+        self.bytes_written = 0
+        self.closed = False
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed S3MultipartWriter")
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[: self.part_size])
+            del self._buffer[: self.part_size]
+            self._upload_part(part)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self.bytes_written
+
+    def _upload_part(self, part):
+        try:
+            if self._upload_id is None:
+                self._upload_id = self.call(
+                    self.client.create_multipart_upload, Bucket=self.bucket, Key=self.key
+                )["UploadId"]
+            res = self.call(
+                self.client.upload_part,
+                Body=part,
+                Bucket=self.bucket,
+                Key=self.key,
+                PartNumber=len(self._parts) + 1,
+                UploadId=self._upload_id,
+            )
+        except (ClientError, BotoCoreError) as e:
+            logging.error(e)
+            self.abort()
+            raise Exception(f"Failed to upload part of {self.key}")
+        self._parts.append({"ETag": res["ETag"], "PartNumber": len(self._parts) + 1})
+
+    def close(self):
+        """
+        Uploads whatever is left in the buffer and completes the upload.
+        """
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                self.call(
+                    self.client.put_object, Body=bytes(self._buffer), Bucket=self.bucket, Key=self.key
+                )
+            else:
+                if self._buffer:
+                    self._upload_part(bytes(self._buffer))
+                self.call(
+                    self.client.complete_multipart_upload,
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    MultipartUpload={"Parts": self._parts},
+                    UploadId=self._upload_id,
+                )
+        except (ClientError, BotoCoreError) as e:
+            logging.error(e)
+            self.abort()
+            raise Exception(f"Failed to upload {self.key}")
+        self._buffer = bytearray()
+        self.closed = True
+
+    def abort(self):
+        """
+        Throws away the buffered data and any parts already uploaded.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._buffer = bytearray()
+        if self._upload_id is not None:
+            try:
+                self.client.abort_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+                )
+            except (ClientError, BotoCoreError) as e:
+                logging.error(e)
@@ -0,0 +1,230 @@
+import json
+import logging
+from src.utils.cache_utils import get_or_create
+from src.utils.storage_utils import get_storage, run
+
+catalog_file_path = "/state/schema_catalog.json"
+# How long the transform function keeps the catalog saved by extract
+catalog_ttl = 5 * 60
+
+timestamp = "timestamp without time zone"
+varchar = "character varying"
+
+# Columns of the totesys tables as set out in database/test_db.sql, for when the
+# extract function hasn't saved a catalog yet. Columns are NOT NULL unless they're
+# in nullable_columns.
+totesys_columns = {
+    "sales_order": [
+        ("sales_order_id", "integer"), ("created_at", timestamp), ("last_updated", timestamp),
+        ("design_id", "integer"), ("staff_id", "integer"), ("counterparty_id", "integer"),
+        ("units_sold", "integer"), ("unit_price", "numeric"), ("currency_id", "integer"),
+        ("agreed_delivery_date", varchar), ("agreed_payment_date", varchar),
+        ("agreed_delivery_location_id", "integer"),
+    ],
+    "design": [
+        ("design_id", "integer"), ("created_at", timestamp), ("last_updated", timestamp),
+        ("design_name", varchar), ("file_location", varchar), ("file_name", varchar),
+    ],
+    "currency": [
+        ("currency_id", "integer"), ("currency_code", varchar), ("created_at", timestamp), ("last_updated", timestamp),
+    ],
+    "staff": [
+        ("staff_id", "integer"), ("first_name", varchar), ("last_name", varchar), ("department_id", "integer"),
+        ("email_address", varchar), ("created_at", timestamp), ("last_updated", timestamp),
+    ],
+    "counterparty": [
+        ("counterparty_id", "integer"), ("counterparty_legal_name", varchar), ("legal_address_id", "integer"),
+        ("commercial_contact", varchar), ("delivery_contact", varchar), ("created_at", timestamp),
+        ("last_updated", timestamp),
+    ],
+    "address": [
+        ("address_id", "integer"), ("address_line_1", varchar), ("address_line_2", varchar),
+        ("district", varchar), ("city", varchar), ("postal_code", varchar), ("country", varchar),
+        ("phone", varchar), ("created_at", timestamp), ("last_updated", timestamp),
+    ],
+    "department": [
+        ("department_id", "integer"), ("department_name", varchar), ("location", varchar),
+        ("manager", varchar), ("created_at", timestamp), ("last_updated", timestamp),
+    ],
+    "purchase_order": [
+        ("purchase_order_id", "integer"), ("created_at", timestamp), ("last_updated", timestamp),
+        ("staff_id", "integer"), ("counterparty_id", "integer"), ("item_code", varchar),
+        ("item_quantity", "integer"), ("item_unit_price", "numeric"), ("currency_id", "integer"),
+        ("agreed_delivery_date", varchar), ("agreed_payment_date", varchar),
+        ("agreed_delivery_location_id", "integer"),
+    ],
+    "payment_type": [
+        ("payment_type_id", "integer"), ("payment_type_name", varchar), ("created_at", timestamp),
+        ("last_updated", timestamp),
+    ],
+    "payment": [
+        ("payment_id", "integer"), ("created_at", timestamp), ("last_updated", timestamp),
+        ("transaction_id", "integer"), ("counterparty_id", "integer"), ("payment_amount", "numeric"),
+        ("currency_id", "integer"), ("payment_type_id", "integer"), ("paid", "boolean"),
+        ("payment_date", varchar), ("company_ac_number", "integer"), ("counterparty_ac_number", "integer"),
+    ],
+    "transaction": [
+        ("transaction_id", "integer"), ("transaction_type", varchar), ("sales_order_id", "integer"),
+        ("purchase_order_id", "integer"), ("created_at", timestamp), ("last_updated", timestamp),
+    ],
+}
+nullable_columns = {
+    ("counterparty", "commercial_contact"), ("counterparty", "delivery_contact"),
+    ("address", "address_line_2"), ("address", "district"),
+    ("department", "location"), ("department", "manager"),
+    ("transaction", "sales_order_id"), ("transaction", "purchase_order_id"),
+}
+
+# Primary keys are read from pg_index rather than information_schema's constraint
+# views, which only list the constraints of tables the current role owns or can
+# change, and so show no keys at all to the read-only totesys user
+catalog_query = """
+SELECT
+    c.table_name,
+    c.column_name,
+    c.ordinal_position,
+    c.data_type,
+    c.is_nullable = 'YES' AS is_nullable,
+    EXISTS (
+        SELECT 1
+        FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indisprimary
+            AND i.indrelid = format('%I.%I', c.table_schema, c.table_name)::regclass
+            AND a.attname = c.column_name
+    ) AS is_primary_key
+FROM information_schema.columns c
+WHERE c.table_schema = 'public'
+"""
+
+schema_hash_query = f"""
+SELECT md5(string_agg(
+    concat_ws(':', table_name, column_name, ordinal_position, data_type, is_nullable, is_primary_key),
+    ',' ORDER BY table_name, ordinal_position
+))
+FROM ({catalog_query}) catalog;
+"""
+
+
+def get_schema_hash(conn):
+    """
+    Asks Postgres for an md5 hash of every table's columns, types and primary keys.
+    The hash changes whenever the schema does, so it tells us when a cached catalog
+    has to be rebuilt without transferring the catalog itself.
+    """
+    return conn.run(schema_hash_query)[0][0]
+
+
+def fetch_schema_catalog(conn, schema_hash=None):
+    """
+    Fetches the column names, positions, types and primary keys of every table in
+    a single query.
+
+    Returns:
+        dict: {"hash": schema hash, "tables": {table name: {"columns": [...],
+        "primary_key": [...]}}} with columns in ordinal order, each column a dict
+        with its name, data_type and whether it is nullable
+    """
+    if schema_hash is None:
+        schema_hash = get_schema_hash(conn)
+    rows = conn.run(f"{catalog_query} ORDER BY c.table_name, c.ordinal_position;")
+    tables = {}
+    for table_name, column_name, _, data_type, is_nullable, is_primary_key in rows:
+        table = tables.setdefault(table_name, {"columns": [], "primary_key": []})
+        table["columns"].append(
+            {"name": column_name, "data_type": data_type, "nullable": is_nullable}
+        )
+        if is_primary_key:
+            table["primary_key"].append(column_name)
+    for table_name, table in tables.items():
+        if not table["primary_key"]:
+            logging.warning(f"No primary key found for {table_name}, its fingerprint won't hash its keys")
+    return {"hash": schema_hash, "tables": tables}
+
+
+def _read_catalog_from_bucket(client, bucket):
+    try:
+        obj = run(get_storage(client).get(bucket, catalog_file_path))
+    except Exception as e:
+        logging.error(e)
+        return None
+    return None if obj is None else json.loads(obj["body"])
+
+
+def load_schema_catalog(conn, client, bucket):
+    """
+    Returns the schema catalog, only rebuilding it when the schema hash changes.
+    The catalog is looked up in the warm container first, then in the state object
+    in the raw bucket, and is only fetched from the database when neither matches
+    the current hash.
+    """
+    schema_hash = get_schema_hash(conn)
+
+    def build_catalog():
+        catalog = _read_catalog_from_bucket(client, bucket)
+        if catalog and catalog["hash"] == schema_hash:
+            return catalog
+        logging.info("Schema changed, rebuilding the schema catalog")
+        catalog = fetch_schema_catalog(conn, schema_hash)
+        try:
+            run(get_storage(client).put(bucket, catalog_file_path, json.dumps(catalog).encode()))
+        except Exception as e:
+            # The catalog can always be rebuilt, so failing to cache it isn't fatal
+            logging.error(e)
+        return catalog
+
+    # Cached per schema hash, so a new hash builds a new catalog
+    return get_or_create(("schema_catalog", bucket, schema_hash), build_catalog)
+
+
+def table_columns(catalog, table_name):
+    """
+    Returns (column name, data type) pairs for a table in column order, or None if
+    the table isn't in the catalog.
+    """
+    if table_name not in catalog["tables"]:
+        return None
+    return [
+        (column["name"], column["data_type"])
+        for column in catalog["tables"][table_name]["columns"]
+    ]
+
+
+def table_primary_key(catalog, table_name):
+    """
+    Returns the name of a table's primary key column, or None if it has none.
+    Composite keys aren't used by totesys, so only the first column is returned.
+    """
+    primary_key = catalog["tables"].get(table_name, {}).get("primary_key")
+    return primary_key[0] if primary_key else None
+
+
+def default_catalog():
+    """
+    A catalog built from totesys_columns, shaped like the one fetch_schema_catalog
+    returns, with the first column of each table as its primary key.
+    """
+    return {
+        "hash": None,
+        "tables": {
+            table_name: {
+                "columns": [
+                    {"name": name, "data_type": data_type, "nullable": (table_name, name) in nullable_columns}
+                    for name, data_type in columns
+                ],
+                "primary_key": [columns[0][0]],
+            }
+            for table_name, columns in totesys_columns.items()
+        },
+    }
+
+
+def get_cached_catalog(client, bucket):
+    """
+    Returns the catalog the extract function saved in the raw bucket, for functions
+    that don't connect to the database themselves, falling back to default_catalog.
+    It's kept for catalog_ttl seconds in the warm container.
+    """
+    return get_or_create(
+        f"schema_catalog_{bucket}", lambda: _read_catalog_from_bucket(client, bucket) or default_catalog(), catalog_ttl
+    )
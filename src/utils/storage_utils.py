@@ -0,0 +1,399 @@
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError, BotoCoreError
+from src.utils.cache_utils import get_or_create, get_s3_client, s3_max_pool_connections
+from src.utils.s3_utils import S3MultipartWriter
+
+# "s3" (default) or "local", which keeps every bucket as a directory under
+# STORAGE_ROOT, for tests and benchmarks without S3
+default_backend = "s3"
+default_root = "/tmp/totesys_storage"
+default_max_concurrency = s3_max_pool_connections
+# Worker threads of the event loop the storages share, enough for every storage's
+# requests to run at once
+loop_max_workers = 64
+
+# Retries of throttled, failed or timed out requests, with full jitter: each wait
+# is a random time up to base_delay doubled for every attempt, capped at max_delay
+max_attempts = 5
+base_delay = 0.1
+max_delay = 5
+retryable_error_codes = {
+    "SlowDown", "Throttling", "ThrottlingException", "RequestTimeout", "RequestTimeTooSkewed",
+    "InternalError", "ServiceUnavailable", "500", "502", "503", "504",
+}
+
+
+def is_retryable(error):
+    if isinstance(error, ClientError):
+        return error.response["Error"]["Code"] in retryable_error_codes
+    return isinstance(error, BotoCoreError)
+
+
+def backoff_delay(attempt):
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def call_with_retries(function, **kwargs):
+    """
+    Blocking counterpart of the storage's retries, for the requests of the
+    multipart uploads made by S3Storage.writer.
+    """
+    for attempt in range(max_attempts):
+        try:
+            return function(**kwargs)
+        except (ClientError, BotoCoreError) as e:
+            if not is_retryable(e) or attempt == max_attempts - 1:
+                raise
+            logging.warning(f"Retrying {function.__name__} after {e}")
+        time.sleep(backoff_delay(attempt))
+
+
+class Storage:
+    """
+    Async object storage. Every request runs in a worker thread, at most
+    max_concurrency at a time, and is retried with jittered backoff when it fails
+    for a reason that may go away. Objects are read as dicts with their body and
+    last_modified time, None when they don't exist.
+
+    Subclasses implement the blocking _get, _head, _put, _copy, _list, _delete and
+    _list_buckets, and writer. Storages are shared by the whole container, see
+    get_storage, and their coroutines always run on the same event loop, see run.
+    """
+
+    def __init__(self, max_concurrency=default_max_concurrency):
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+
+    async def _call(self, function, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            for attempt in range(max_attempts):
+                try:
+                    return await asyncio.to_thread(function, *args)
+                except (ClientError, BotoCoreError) as e:
+                    if not is_retryable(e) or attempt == max_attempts - 1:
+                        raise
+                    logging.warning(f"Retrying {function.__name__} after {e}")
+                await asyncio.sleep(backoff_delay(attempt))
+
+    async def get(self, bucket, key):
+        try:
+            return await self._call(self._get, bucket, key)
+        except (ClientError, BotoCoreError) as e:
+            logging.error(e)
+            raise Exception(f"Failed to read {key}")
+
+    async def head(self, bucket, key):
+        """
+        Returns:
+            dict: the object's size, etag (a hash of its content) and last_modified
+                time without its body, None if it doesn't exist
+        """
+        try:
+            return await self._call(self._head, bucket, key)
+        except (ClientError, BotoCoreError) as e:
+            logging.error(e)
+            raise Exception(f"Failed to read {key}")
+
+    async def put(self, bucket, key, body):
+        """
+        Returns:
+            int: bytes written
+        """
+        try:
+            await self._call(self._put, bucket, key, body)
+        except (ClientError, BotoCoreError) as e:
+            logging.error(e)
+            raise Exception(f"Failed to write {key}")
+        return len(body)
+
+    async def copy(self, bucket, key, to_bucket, to_key):
+        try:
+            await self._call(self._copy, bucket, key, to_bucket, to_key)
+        except (ClientError, BotoCoreError, FileNotFoundError) as e:
+            logging.error(e)
+            raise Exception(f"Failed to copy {key} to {to_key}")
+
+    async def list(self, bucket, prefix=""):
+        """
+        Returns:
+            list: every key starting with prefix, sorted
+        """
+        try:
+            return await self._call(self._list, bucket, prefix)
+        except (ClientError, BotoCoreError) as e:
+            logging.error(e)
+            raise Exception(f"Failed to list {bucket}")
+
+    async def delete(self, bucket, keys):
+        try:
+            await self._call(self._delete, bucket, list(keys))
+        except (ClientError, BotoCoreError) as e:
+            logging.error(e)
+            raise Exception(f"Failed to delete from {bucket}")
+
+    async def list_buckets(self):
+        """
+        Returns:
+            list: the name of every bucket, sorted
+        """
+        try:
+            return await self._call(self._list_buckets)
+        except (ClientError, BotoCoreError) as e:
+            logging.error(e)
+            raise Exception("Failed to list buckets")
+
+    async def get_many(self, bucket, keys):
+        """
+        Reads several objects at once.
+
+        Returns:
+            dict: key -> object, None for the keys that don't exist
+        """
+        objects = await asyncio.gather(*(self.get(bucket, key) for key in keys))
+        return dict(zip(keys, objects))
+
+    async def put_many(self, bucket, bodies):
+        """
+        Writes several objects at once, from a dict of key -> body.
+
+        Returns:
+            int: bytes written
+        """
+        return sum(await asyncio.gather(*(self.put(bucket, key, body) for key, body in bodies.items())))
+
+
+class S3Storage(Storage):
+    """
+    Storage over an S3 client, by default the shared one from get_s3_client.
+    boto3 clients are thread safe, so the worker threads share it and its
+    connection pool.
+    """
+
+    def __init__(self, client=None, max_concurrency=default_max_concurrency):
+        super().__init__(max_concurrency)
+        self.client = client or get_s3_client()
+
+    def _get(self, bucket, key):
+        try:
+            res = self.client.get_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return None
+            raise
+        return {"body": res["Body"].read(), "last_modified": res["LastModified"]}
+
+    def _head(self, bucket, key):
+        try:
+            res = self.client.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return {"size": res["ContentLength"], "etag": res["ETag"], "last_modified": res["LastModified"]}
+
+    def _put(self, bucket, key, body):
+        self.client.put_object(Body=body, Bucket=bucket, Key=key)
+
+    def _copy(self, bucket, key, to_bucket, to_key):
+        self.client.copy_object(CopySource={"Bucket": bucket, "Key": key}, Bucket=to_bucket, Key=to_key)
+
+    def _list(self, bucket, prefix):
+        pages = self.client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix)
+        return sorted(obj["Key"] for page in pages for obj in page.get("Contents", []))
+
+    def _delete(self, bucket, keys):
+        for offset in range(0, len(keys), 1000):
+            self.client.delete_objects(
+                Bucket=bucket, Delete={"Objects": [{"Key": key} for key in keys[offset:offset + 1000]]}
+            )
+
+    def _list_buckets(self):
+        return sorted(bucket["Name"] for bucket in self.client.list_buckets()["Buckets"])
+
+    def writer(self, bucket, key):
+        """
+        Returns a blocking file-like object uploading what's written to it to key,
+        see S3MultipartWriter. Its requests are retried like the storage's.
+        """
+        return S3MultipartWriter(self.client, bucket, key, call=call_with_retries)
+
+
+class LocalStorage(Storage):
+    """
+    Storage in a local directory, each bucket a directory under root. Keys keep
+    their slashes, so /state/watermarks.json is {root}/{bucket}/state/watermarks.json.
+    """
+
+    def __init__(self, root=None, max_concurrency=default_max_concurrency):
+        super().__init__(max_concurrency)
+        self.root = root or os.getenv("STORAGE_ROOT", default_root)
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key.lstrip("/"))
+
+    def _key(self, bucket, path):
+        # Keys in this pipeline start with a slash, the directory layout drops it
+        return "/" + os.path.relpath(path, os.path.join(self.root, bucket))
+
+    def _get(self, bucket, key):
+        path = self._path(bucket, key)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            body = f.read()
+        return {"body": body, "last_modified": datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)}
+
+    def _head(self, bucket, key):
+        path = self._path(bucket, key)
+        if not os.path.isfile(path):
+            return None
+        # Like an S3 ETag, the md5 of the content in quotes
+        with open(path, "rb") as f:
+            etag = f'"{hashlib.file_digest(f, "md5").hexdigest()}"'
+        return {
+            "size": os.path.getsize(path),
+            "etag": etag,
+            "last_modified": datetime.fromtimestamp(os.path.getmtime(path), timezone.utc),
+        }
+
+    def _put(self, bucket, key, body):
+        with self.writer(bucket, key) as writer:
+            writer.write(body)
+
+    def _copy(self, bucket, key, to_bucket, to_key):
+        obj = self._get(bucket, key)
+        if obj is None:
+            raise FileNotFoundError(self._path(bucket, key))
+        self._put(to_bucket, to_key, obj["body"])
+
+    def _list(self, bucket, prefix):
+        keys = []
+        for directory, _, files in os.walk(os.path.join(self.root, bucket)):
+            keys += [self._key(bucket, os.path.join(directory, name)) for name in files if not name.endswith(".tmp")]
+        return sorted(key for key in keys if key.startswith(prefix))
+
+    def _delete(self, bucket, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(bucket, key))
+            except FileNotFoundError:
+                pass
+
+    def _list_buckets(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name)))
+
+    def writer(self, bucket, key):
+        """
+        Returns a blocking file-like object writing to key, see LocalWriter.
+        """
+        return LocalWriter(self._path(bucket, key))
+
+
+class LocalWriter:
+    """
+    The local storage's counterpart of S3MultipartWriter. It's written next to the
+    object and renamed when it's closed, so readers never see half of it, and
+    removed if the block it's used in raises.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.bytes_written = 0
+        self.closed = False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._temporary = f"{path}.{threading.get_ident()}.tmp"
+        self._file = open(self._temporary, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed LocalWriter")
+        self._file.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self.bytes_written
+
+    def close(self):
+        if self.closed:
+            return
+        self._file.close()
+        os.replace(self._temporary, self.path)
+        self.closed = True
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._file.close()
+        os.remove(self._temporary)
+
+
+def get_storage(client=None, max_concurrency=default_max_concurrency):
+    """
+    Returns the storage picked by the STORAGE_BACKEND environment variable. The S3
+    storage uses client if given, e.g. a mocked one in tests, otherwise the one
+    from get_s3_client. Storages are kept for the life of the container, so every
+    caller of the same backend shares its concurrency limit.
+    """
+    backend = os.getenv("STORAGE_BACKEND", default_backend)
+    if backend == "local":
+        root = os.getenv("STORAGE_ROOT", default_root)
+        return get_or_create(("storage", backend, root, max_concurrency), lambda: LocalStorage(root, max_concurrency))
+    if backend != "s3":
+        raise Exception(f"Unknown storage backend: {backend}")
+    client = client or get_s3_client()
+    return get_or_create(("storage", backend, client, max_concurrency), lambda: S3Storage(client, max_concurrency))
+
+
+# One event loop per container, in a thread of its own, which every run call
+# hands its coroutine to
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop.set_default_executor(ThreadPoolExecutor(max_workers=loop_max_workers))
+            threading.Thread(target=_loop.run_forever, name="storage-event-loop", daemon=True).start()
+    return _loop
+
+
+def run(coroutine):
+    """
+    Runs storage coroutines from the synchronous lambda handlers and worker threads.
+    They all run on the container's one event loop, so a storage's max_concurrency
+    holds across every call and thread, not just within one run call. Blocks until
+    the coroutine is done, and must not be called from a coroutine on that loop.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result()
@@ -1,8 +1,88 @@
-import boto3
+import hashlib
+import json
 import logging
-from io import StringIO, BytesIO
+from datetime import datetime
+from io import BytesIO
 import polars as pl
-from botocore.exceptions import ClientError
+from src.utils.cache_utils import get_or_create, get_s3_client, invalidate
+from src.utils.schema_utils import default_catalog, get_cached_catalog
+from src.utils.storage_utils import get_storage, run
+
+# Each table's content hashes are kept in their own state object, so tables
+# transformed by separate invocations at the same time don't overwrite each other's
+hash_file_prefix = "/state/transform_hashes/"
+
+# Time prefix given to each run by the extract function, e.g. 2024_08_05_09:03:07
+time_prefix_format = "%Y_%m_%d_%H:%M:%S"
+
+# Small files in a day's partition are merged into files of about this size once
+# the day is over, see compact_files. A merge holds its files encoded in memory, so
+# this also bounds the memory the compaction needs; the compact stage can take a
+# smaller target_bytes, see compact_tables
+compacted_file_bytes = 128 * 1024 * 1024
+compacted_row_group_size = 250000
+
+# How parquet files are written, see parquet_options. dictionary lists the only
+# columns that are dictionary encoded, which needs pyarrow's writer. None leaves it
+# to polars, which dictionary encodes the columns where it pays off.
+parquet_profiles = {
+    # Files read a few times before they're compacted
+    "balanced": {
+        "compression": "zstd", "compression_level": 3, "row_group_size": 100000, "statistics": True, "dictionary": None,
+    },
+    # Cheapest to write, for files that are rewritten soon anyway
+    "fast": {
+        "compression": "lz4", "compression_level": None, "row_group_size": 100000, "statistics": False, "dictionary": None,
+    },
+    # Smallest and quickest to scan with predicates, for files kept for good
+    "compact": {
+        "compression": "zstd", "compression_level": 12, "row_group_size": compacted_row_group_size,
+        "statistics": "full", "dictionary": None,
+    },
+}
+default_parquet_profile = "balanced"
+# Profile writing each table with its own entry in table_parquet_profiles, the
+# default for parquet_options
+tables_parquet_profile = "tables"
+# Tables written with another profile, or with their low cardinality columns
+# dictionary encoded
+table_parquet_profiles = {
+    "currency": {"dictionary": ["currency_code"]},
+    "address": {"dictionary": ["city", "country"]},
+    "department": {"dictionary": ["location"]},
+    "dim_currency": {"profile": "compact", "dictionary": ["currency_code", "currency_name"]},
+    "dim_location": {"profile": "compact", "dictionary": ["city", "country"]},
+    "dim_staff": {"profile": "compact", "dictionary": ["department_name", "location"]},
+    "dim_counterparty": {"profile": "compact", "dictionary": ["counterparty_legal_city", "counterparty_legal_country"]},
+    "dim_design": {"profile": "compact"},
+    "dim_payment_type": {"profile": "compact"},
+    "dim_transaction": {"profile": "compact"},
+    "dim_date": {"profile": "compact"},
+}
+
+# Columns recorded in the manifest as the range of updates a file holds, the
+# first one a table has is used
+updated_columns = ["last_updated", "valid_from"]
+
+# Polars types of the Postgres types named by information_schema, matching the
+# parquet extract's arrow_type. Anything not listed is read as a string. Numbers
+# are parsed by the csv reader, while dates and timestamps are read as strings and
+# parsed afterwards, which is several times faster than the reader's own parsing.
+# Booleans are mapped with boolean_values, as COPY writes them as t/f.
+polars_types = {
+    "smallint": pl.Int16,
+    "integer": pl.Int32,
+    "bigint": pl.Int64,
+    "numeric": pl.Decimal(38, 10),
+    "real": pl.Float32,
+    "double precision": pl.Float64,
+}
+parsed_types = {
+    "date": lambda column: pl.col(column).str.to_date(),
+    "timestamp without time zone": lambda column: pl.col(column).str.to_datetime(time_unit="us"),
+    "boolean": lambda column: pl.col(column).str.to_lowercase().replace_strict(boolean_values, return_dtype=pl.Boolean),
+}
+boolean_values = {"t": True, "true": True, "f": False, "false": False}
 
 
 def finds_data_buckets():
@@ -15,17 +95,16 @@ def finds_data_buckets():
         raw_data_bucket (string): string containing full name of the raw data bucket
         processed_data_bucket (string): string containing full name of the processed data bucket
     """
-    s3_client = boto3.client("s3")
-    buckets = s3_client.list_buckets()
+    buckets = run(get_storage().list_buckets())
     found_processed = False
     found_raw = False
 
-    for bucket in buckets["Buckets"]:
-        if bucket["Name"].startswith("totesys-raw-data-"):
-            raw_data_bucket = bucket["Name"]
+    for bucket in buckets:
+        if bucket.startswith("totesys-raw-data-"):
+            raw_data_bucket = bucket
             found_raw = True
-        if bucket["Name"].startswith("totesys-processed-data-"):
-            processed_data_bucket = bucket["Name"]
+        if bucket.startswith("totesys-processed-data-"):
+            processed_data_bucket = bucket
             found_processed = True
         if found_raw and found_processed:
             break
@@ -43,10 +122,78 @@ def finds_data_buckets():
     return raw_data_bucket, processed_data_bucket
 
 
+def get_data_buckets():
+    """
+    Returns the result of finds_data_buckets, memoized in the warm container so the
+    buckets are listed once rather than once per file. Error messages aren't cached.
+    """
+    buckets = get_or_create("data_buckets", finds_data_buckets)
+    if isinstance(buckets, str):
+        invalidate("data_buckets")
+    return buckets
+
+
+def raw_table_schema(catalog, table_name):
+    """
+    Returns the polars types to read a raw table's columns as, the types of the
+    columns parsed afterwards and its NOT NULL columns, or None if the table isn't
+    in the catalog.
+    """
+    if table_name not in catalog["tables"]:
+        return None
+    columns = catalog["tables"][table_name]["columns"]
+    return {
+        "types": {column["name"]: polars_types[column["data_type"]] for column in columns if column["data_type"] in polars_types},
+        "parsed": {column["name"]: column["data_type"] for column in columns if column["data_type"] in parsed_types},
+        "not_null": [column["name"] for column in columns if not column["nullable"]],
+    }
+
+
+def read_typed_csv(csv_data, table_name, catalog=None):
+    """
+    Parses a raw csv with the column types of its table from the schema catalog
+    instead of inferring them, so prices stay exact decimals, text that looks like
+    a date or number stays text and the file is parsed in a single pass. Columns
+    the catalog doesn't know, like change_type, are read as strings. Tables that
+    aren't in the catalog are read with inference.
+
+    Returns:
+        DataFrame: the typed rows, checked by validate_typed_table
+    """
+    schema = raw_table_schema(catalog or default_catalog(), table_name)
+    if schema is None:
+        return pl.read_csv(csv_data)
+    try:
+        df = pl.read_csv(csv_data, schema_overrides=schema["types"], infer_schema=False)
+        df = df.with_columns(
+            parsed_types[data_type](column) for column, data_type in schema["parsed"].items() if column in df.columns
+        )
+    except pl.exceptions.PolarsError as e:
+        logging.error(e)
+        raise Exception(f"Failed to parse {table_name} with its schema: {e}")
+    validate_typed_table(df, table_name, schema)
+    return df
+
+
+def validate_typed_table(df, table_name, schema):
+    """
+    Checks in one pass that none of a table's NOT NULL columns has nulls, which
+    would mean the file doesn't match the table's schema.
+    """
+    not_null = [column for column in schema["not_null"] if column in df.columns]
+    if not not_null or df.is_empty():
+        return
+    null_counts = df.select(pl.col(not_null).null_count()).row(0, named=True)
+    nulls = {column: count for column, count in null_counts.items() if count}
+    if nulls:
+        raise Exception(f"{table_name} has nulls in NOT NULL columns: {nulls}")
+
+
 def convert_csv_to_parquet(csv):
     """
     This takes in a csv file name, finds this file within the raw data bucket then
-    converts it to a parquet file in buffer storage.
+    converts it to a parquet file in buffer storage. Files under a raw table's
+    directory, e.g. /history/sales_order/..., are read with the table's types.
 
     Args:
         csv (string): Name of csv file
@@ -57,24 +204,814 @@ def convert_csv_to_parquet(csv):
     if csv[-4:] != ".csv":
         return f"{csv} is not a .csv file."
 
-    s3_client = boto3.client("s3")
+    s3_client = get_s3_client()
 
-    raw_data_bucket, _ = finds_data_buckets()
-    try:
-        res = s3_client.get_object(
-            Bucket=raw_data_bucket, Key=f"{csv}"
-        )  # change f string for when we finalise extract structure
-        csv_data = res["Body"].read().decode("utf-8")
-    except ClientError:
+    raw_data_bucket, _ = get_data_buckets()
+    obj = run(get_storage(s3_client).get(raw_data_bucket, f"{csv}"))  # change f string for when we finalise extract structure
+    if obj is None:
         return "csv file not found"
+    csv_data = obj["body"]
 
-    data_buffer_csv = StringIO(csv_data)
-    df = pl.read_csv(data_buffer_csv)
+    # polars parses the raw bytes itself, so they aren't decoded into a str first
+    catalog = get_cached_catalog(s3_client, raw_data_bucket)
+    table_name = next((part for part in csv.split("/") if part in catalog["tables"]), None)
+    df = read_typed_csv(csv_data, table_name, catalog)
 
     data_buffer_parquet = BytesIO()
-    parquet = df.write_parquet(data_buffer_parquet)
-    data_buffer_parquet.seek(0)
+    df.write_parquet(data_buffer_parquet, **parquet_options(table_name))
+
+    return data_buffer_parquet.getvalue()
+
+
+def read_raw_parquet(parquet):
+    """
+    This takes in a parquet file name written by the extract parquet output format
+    and returns it from the raw data bucket. These files are already typed and
+    compressed, so they are returned as they are without being parsed.
+
+    Args:
+        parquet (string): Name of parquet file
+
+    Returns:
+        parquet (bytes): parquet file data
+    """
+    if parquet[-8:] != ".parquet":
+        return f"{parquet} is not a .parquet file."
+
+    s3_client = get_s3_client()
+
+    raw_data_bucket, _ = get_data_buckets()
+    obj = run(get_storage(s3_client).get(raw_data_bucket, f"{parquet}"))
+    if obj is None:
+        return "parquet file not found"
+
+    return obj["body"]
+
+
+def scan_parquet_from_bucket(client, bucket, key):
+    """
+    Reads a parquet file from a bucket as a LazyFrame, so a query over it only
+    decodes the columns and row groups it needs.
+
+    Returns:
+        LazyFrame: the file's rows, None if the file doesn't exist
+    """
+    obj = run(get_storage(client).get(bucket, key))
+    if obj is None:
+        return None
+    return pl.scan_parquet(BytesIO(obj["body"]))
+
+
+def parquet_options(table_name=None, profile=None):
+    """
+    Works out how a table's parquet files are written. With the "tables" profile,
+    the default, that's from the table's entry in table_parquet_profiles: its
+    profile and its own settings on top. Any other profile is used as it is.
+
+    Returns:
+        dict: keyword arguments for DataFrame.write_parquet
+    """
+    table_settings = {}
+    if profile in (None, tables_parquet_profile):
+        table_settings = dict(table_parquet_profiles.get(table_name, {}))
+        profile = table_settings.pop("profile", default_parquet_profile)
+    if profile not in parquet_profiles:
+        raise Exception(f"Unknown parquet profile: {profile}")
+    settings = {**parquet_profiles[profile], **table_settings}
+    options = {
+        option: settings[option]
+        for option in ["compression", "compression_level", "row_group_size", "statistics"]
+        if settings[option] is not None
+    }
+    if settings["dictionary"] is not None:
+        # pyarrow only takes statistics on or off
+        options["statistics"] = bool(options["statistics"])
+        options["use_pyarrow"] = True
+        options["pyarrow_options"] = {"use_dictionary": settings["dictionary"]}
+    return options
+
+
+def write_parquet_to_bucket(df, client, bucket, key, **parquet_options):
+    """
+    Writes a data frame as parquet straight into the storage's writer, a multipart
+    upload on S3, so the encoded file is never held in memory as a whole. Any
+    parquet_options are passed on to DataFrame.write_parquet, see the
+    parquet_options function.
+
+    Returns:
+        int: size of the uploaded parquet file in bytes
+    """
+    with get_storage(client).writer(bucket, key) as writer:
+        df.write_parquet(writer, **parquet_options)
+    return writer.bytes_written
+
+
+# Source columns holding timestamps, which are plain strings when the raw file
+# was a csv
+timestamp_columns = ["created_at", "last_updated"]
+
+currency_names = {
+    "GBP": "British Pound",
+    "USD": "US Dollar",
+    "EUR": "Euro",
+}
+
+
+def with_timestamps(lf):
+    """
+    Parses the created_at and last_updated columns of a raw table into datetimes
+    if they were read as strings, so csv and parquet extracts look the same.
+    """
+    schema = lf.collect_schema()
+    return lf.with_columns(
+        pl.col(column).str.to_datetime(time_unit="us")
+        for column in timestamp_columns
+        if schema.get(column) == pl.String
+    )
+
+
+def to_date(column):
+    """
+    Expression turning a date stored as text in totesys (e.g. agreed_delivery_date)
+    into a date.
+    """
+    return pl.col(column).cast(pl.String).str.to_date()
+
+
+def build_dim_staff(staff, department):
+    return staff.join(department, on="department_id", how="left").select(
+        "staff_id", "first_name", "last_name", "department_name", "location", "email_address"
+    )
+
+
+def build_dim_location(address):
+    return address.select(
+        pl.col("address_id").alias("location_id"),
+        "address_line_1", "address_line_2", "district", "city", "postal_code", "country", "phone",
+    )
+
+
+def build_dim_design(design):
+    return design.select("design_id", "design_name", "file_location", "file_name")
+
+
+def build_dim_currency(currency):
+    return currency.select(
+        "currency_id",
+        "currency_code",
+        pl.col("currency_code")
+        .replace_strict(currency_names, default=pl.col("currency_code"))
+        .alias("currency_name"),
+    )
+
+
+def build_dim_counterparty(counterparty, address):
+    return counterparty.join(
+        address, left_on="legal_address_id", right_on="address_id", how="left"
+    ).select(
+        "counterparty_id",
+        "counterparty_legal_name",
+        pl.col("address_line_1").alias("counterparty_legal_address_line_1"),
+        pl.col("address_line_2").alias("counterparty_legal_address_line_2"),
+        pl.col("district").alias("counterparty_legal_district"),
+        pl.col("city").alias("counterparty_legal_city"),
+        pl.col("postal_code").alias("counterparty_legal_postal_code"),
+        pl.col("country").alias("counterparty_legal_country"),
+        pl.col("phone").alias("counterparty_legal_phone_number"),
+    )
+
+
+def dates_used(*frames):
+    """
+    Every date the columns of the frames refer to, as a single date_id column.
+    Each column is either a timestamp or a date stored as text.
+    """
+    return pl.concat(
+        [
+            frame.select(
+                (pl.col(column).dt.date() if isinstance(dtype, pl.Datetime) else to_date(column)).alias("date_id")
+            )
+            for frame in frames
+            for column, dtype in frame.collect_schema().items()
+        ]
+    )
+
+
+def build_dim_date(cached_range=None, **sources):
+    """
+    Generates dim_date as one row per calendar day, computed column by column over
+    a date range rather than row by row. The range covers whole years, so the
+    dates of later changes are usually already there.
+
+    Args:
+        cached_range (tuple): first and last date_id of the dim_date built so far,
+            None if it hasn't been built yet
+        sources (LazyFrame): the date columns of every fact's source table, see
+            star_schema. Sources without changes in this run are left out.
+
+    Returns:
+        LazyFrame: the days missing from the cached range, which together with it
+            make one continuous range covering every date used
+    """
+    dates = dates_used(*sources.values())
+    if cached_range is not None:
+        dates = pl.concat([dates, pl.LazyFrame({"date_id": list(cached_range)}, schema={"date_id": pl.Date})])
+    days = dates.select(
+        pl.date_range(
+            pl.col("date_id").min().dt.truncate("1y"),
+            pl.col("date_id").max().dt.offset_by("1y").dt.truncate("1y").dt.offset_by("-1d"),
+        ).alias("date_id")
+    )
+    if cached_range is not None:
+        days = days.filter(~pl.col("date_id").is_between(*cached_range))
+    return days.select(
+        "date_id",
+        pl.col("date_id").dt.year().alias("year"),
+        pl.col("date_id").dt.month().alias("month"),
+        pl.col("date_id").dt.day().alias("day"),
+        pl.col("date_id").dt.weekday().alias("day_of_week"),
+        pl.col("date_id").dt.strftime("%A").alias("day_name"),
+        pl.col("date_id").dt.strftime("%B").alias("month_name"),
+        pl.col("date_id").dt.quarter().alias("quarter"),
+    )
+
+
+def with_change_type(lf):
+    """
+    Adds the change_type column to changed rows extracted incrementally, which
+    don't have one. totesys sets created_at and last_updated to the same time when
+    a row is inserted, so any other row is an update.
+    """
+    if "change_type" in lf.collect_schema():
+        return lf
+    return lf.with_columns(
+        pl.when(pl.col("created_at") == pl.col("last_updated"))
+        .then(pl.lit("insert"))
+        .otherwise(pl.lit("update"))
+        .alias("change_type")
+    )
+
+
+# Columns added to every fact row by assign_versions
+history_columns = ["version", "valid_from", "valid_to", "is_deleted"]
+
+
+def assign_versions(changes, key, previous_versions=None, deleted_at=None):
+    """
+    Turns a batch of changes to a fact's source table into versions of its rows.
+    Each change gets the next version number of its key and is valid from its
+    last_updated time until the next change to the same key in the batch. Versions
+    are numbered with a sort and window functions over the whole batch, so several
+    changes to one key in the same batch are ordered correctly.
+
+    A deleted row still has the last_updated of the version before it, so deletes
+    are valid from deleted_at (the time of the run) instead and sort after the other
+    changes to the key.
+
+    Args:
+        changes (LazyFrame): changed rows with last_updated and change_type columns
+        key (string): primary key column
+        previous_versions (LazyFrame): latest version of every key seen so far, None
+            on the first run
+        deleted_at (datetime): when deletes in this batch were noticed
+
+    Returns:
+        LazyFrame: the changes in version order with the history_columns added.
+            valid_to is null for the latest version of a key in the batch.
+    """
+    is_deleted = pl.col("change_type") == "delete"
+    valid_from = pl.col("last_updated")
+    if deleted_at is not None:
+        valid_from = pl.when(is_deleted).then(pl.lit(deleted_at, dtype=pl.Datetime("us"))).otherwise(valid_from)
+    versions = (
+        changes.with_row_index("file_order")
+        .with_columns(valid_from.alias("valid_from"), is_deleted.alias("is_deleted"))
+        .sort([key, "valid_from", "is_deleted", "file_order"])
+        .with_columns(
+            pl.int_range(1, pl.len() + 1).over(key).alias("version"),
+            pl.col("valid_from").shift(-1).over(key).alias("valid_to"),
+        )
+    )
+    if previous_versions is not None:
+        versions = versions.join(
+            previous_versions.select(key, pl.col("version").alias("previous_version")), on=key, how="left"
+        ).with_columns(
+            (pl.col("version") + pl.col("previous_version").fill_null(0)).alias("version")
+        )
+    return versions.drop("file_order", "previous_version", strict=False)
+
+
+def latest_versions(previous_versions, versions, key):
+    """
+    Returns the latest version of every key, to be passed to assign_versions as
+    previous_versions on the next run.
+    """
+    latest = versions.group_by(key).agg(pl.col("version").max())
+    if previous_versions is None:
+        return latest
+    return pl.concat([previous_versions.select(key, "version"), latest]).group_by(key).agg(pl.col("version").max())
+
 
-    parquet = data_buffer_parquet.read()
+def timestamp_parts(column, name):
+    """
+    Splits a timestamp column into {name}_date and {name}_time columns.
+    """
+    return [
+        pl.col(column).dt.date().alias(f"{name}_date"),
+        pl.col(column).dt.time().alias(f"{name}_time"),
+    ]
+
+
+def build_fact_sales_order(sales_order):
+    return sales_order.select(
+        "sales_order_id",
+        *timestamp_parts("created_at", "created"),
+        *timestamp_parts("last_updated", "last_updated"),
+        pl.col("staff_id").alias("sales_staff_id"),
+        "counterparty_id",
+        "units_sold",
+        pl.col("unit_price").cast(pl.Float64).round(2).alias("unit_price"),
+        "currency_id",
+        "design_id",
+        to_date("agreed_payment_date").alias("agreed_payment_date"),
+        to_date("agreed_delivery_date").alias("agreed_delivery_date"),
+        "agreed_delivery_location_id",
+        *history_columns,
+    )
+
+
+def build_fact_purchase_orders(purchase_order):
+    return purchase_order.select(
+        "purchase_order_id",
+        *timestamp_parts("created_at", "created"),
+        *timestamp_parts("last_updated", "last_updated"),
+        "staff_id",
+        "counterparty_id",
+        "item_code",
+        "item_quantity",
+        pl.col("item_unit_price").cast(pl.Float64).round(2).alias("item_unit_price"),
+        "currency_id",
+        to_date("agreed_delivery_date").alias("agreed_delivery_date"),
+        to_date("agreed_payment_date").alias("agreed_payment_date"),
+        "agreed_delivery_location_id",
+        *history_columns,
+    )
+
+
+def build_fact_payment(payment):
+    return payment.select(
+        "payment_id",
+        *timestamp_parts("created_at", "created"),
+        *timestamp_parts("last_updated", "last_updated"),
+        "transaction_id",
+        "counterparty_id",
+        pl.col("payment_amount").cast(pl.Float64).round(2).alias("payment_amount"),
+        "currency_id",
+        "payment_type_id",
+        "paid",
+        to_date("payment_date").alias("payment_date"),
+        "company_ac_number",
+        "counterparty_ac_number",
+        *history_columns,
+    )
+
+
+# How every warehouse table is built. sources lists the raw tables a table is made
+# from and the only columns read from each of them, build joins and reshapes those
+# lazy frames (keyword arguments named after the sources) into the warehouse table.
+# Dimensions hold the latest version of each row, so they're built from the current
+# snapshot of their sources. Facts keep every change, so they're built from the rows
+# that changed in this run, and only from the sources that changed. Tables with extends are cached in full and only extended:
+# build is given the cached range of that column and returns the rows to add to it.
+# Tables with history keep every version of their source's rows, numbered per key
+# by assign_versions before build is called. references lists the dimensions a
+# table's rows point at, which have to be loaded into the warehouse before it.
+star_schema = {
+    "dim_staff": {
+        "sources": {
+            "staff": ["staff_id", "first_name", "last_name", "department_id", "email_address"],
+            "department": ["department_id", "department_name", "location"],
+        },
+        "build": build_dim_staff,
+        "from": "current",
+    },
+    "dim_location": {
+        "sources": {
+            "address": [
+                "address_id", "address_line_1", "address_line_2", "district", "city",
+                "postal_code", "country", "phone",
+            ],
+        },
+        "build": build_dim_location,
+        "from": "current",
+    },
+    "dim_design": {
+        "sources": {"design": ["design_id", "design_name", "file_location", "file_name"]},
+        "build": build_dim_design,
+        "from": "current",
+    },
+    "dim_currency": {
+        "sources": {"currency": ["currency_id", "currency_code"]},
+        "build": build_dim_currency,
+        "from": "current",
+    },
+    "dim_counterparty": {
+        "sources": {
+            "counterparty": ["counterparty_id", "counterparty_legal_name", "legal_address_id"],
+            "address": [
+                "address_id", "address_line_1", "address_line_2", "district", "city",
+                "postal_code", "country", "phone",
+            ],
+        },
+        "build": build_dim_counterparty,
+        "from": "current",
+    },
+    "dim_date": {
+        # Every date column of every fact, as they all reference dim_date
+        "sources": {
+            "sales_order": ["created_at", "last_updated", "agreed_delivery_date", "agreed_payment_date"],
+            "purchase_order": ["created_at", "last_updated", "agreed_delivery_date", "agreed_payment_date"],
+            "payment": ["created_at", "last_updated", "payment_date"],
+        },
+        "build": build_dim_date,
+        "from": "changes",
+        "extends": "date_id",
+    },
+    "fact_sales_order": {
+        "sources": {
+            "sales_order": [
+                "sales_order_id", "created_at", "last_updated", "staff_id", "counterparty_id",
+                "units_sold", "unit_price", "currency_id", "design_id", "agreed_payment_date",
+                "agreed_delivery_date", "agreed_delivery_location_id",
+            ],
+        },
+        "build": build_fact_sales_order,
+        "from": "changes",
+        "history": "sales_order_id",
+        "references": ["dim_date", "dim_staff", "dim_counterparty", "dim_currency", "dim_design", "dim_location"],
+    },
+    "fact_purchase_orders": {
+        "sources": {
+            "purchase_order": [
+                "purchase_order_id", "created_at", "last_updated", "staff_id", "counterparty_id",
+                "item_code", "item_quantity", "item_unit_price", "currency_id", "agreed_delivery_date",
+                "agreed_payment_date", "agreed_delivery_location_id",
+            ],
+        },
+        "build": build_fact_purchase_orders,
+        "from": "changes",
+        "history": "purchase_order_id",
+        "references": ["dim_date", "dim_staff", "dim_counterparty", "dim_currency", "dim_location"],
+    },
+    "fact_payment": {
+        "sources": {
+            "payment": [
+                "payment_id", "created_at", "last_updated", "transaction_id", "counterparty_id",
+                "payment_amount", "currency_id", "payment_type_id", "paid", "payment_date",
+                "company_ac_number", "counterparty_ac_number",
+            ],
+        },
+        "build": build_fact_payment,
+        "from": "changes",
+        "history": "payment_id",
+        "references": ["dim_date", "dim_counterparty", "dim_currency"],
+    },
+}
+
+
+def build_star_table(table_name, frames, **options):
+    """
+    Builds a warehouse table from its spec in star_schema.
+
+    Args:
+        table_name (string): name of the warehouse table
+        frames (dict): raw table name to LazyFrame, holding the spec's sources. For
+            tables built from changes, sources that didn't change are left out
+        options: passed on to assign_versions for tables with history
+            (previous_versions, deleted_at), otherwise to the spec's build
+            function, e.g. cached_range
+
+    Returns:
+        LazyFrame: the warehouse table. Nothing is computed until it's collected,
+            so only the columns and rows the spec needs are read from the sources.
+    """
+    spec = star_schema[table_name]
+    if "history" in spec:
+        (source, columns), = spec["sources"].items()
+        changes = with_change_type(with_timestamps(frames[source])).select(*columns, "change_type")
+        return spec["build"](**{source: assign_versions(changes, spec["history"], **options)})
+
+    inputs = {
+        source: with_timestamps(frames[source]).select(columns)
+        for source, columns in spec["sources"].items()
+        if source in frames
+    }
+    return spec["build"](**inputs, **options)
+
+
+def update_current_snapshot(current, changes, key):
+    """
+    Applies a run's changed rows to the current snapshot of a raw table: the latest
+    version of each key is kept and keys whose last change is a delete are dropped.
+
+    Args:
+        current (LazyFrame): current snapshot, None on the first run
+        changes (LazyFrame): changed rows, with an optional change_type column
+        key (string): primary key column
+
+    Returns:
+        LazyFrame: the new current snapshot, without a change_type column
+    """
+    changes = with_timestamps(changes)
+    if "change_type" not in changes.collect_schema():
+        changes = changes.with_columns(pl.lit("update").alias("change_type"))
+    frames = [changes] if current is None else [current.with_columns(pl.lit("update").alias("change_type")), changes]
+    return (
+        pl.concat(frames, how="diagonal_relaxed")
+        .unique(subset=key, keep="last", maintain_order=True)
+        .filter(pl.col("change_type") != "delete")
+        .drop("change_type")
+    )
+
+
+def get_hashes(client, bucket, table_names=None):
+    """
+    Retrieves the content hashes saved by previous transform runs.
+
+    Args:
+        table_names (list): tables to retrieve the hashes of, every table with saved
+            hashes if None
+
+    Returns:
+        dict: {"raw": {...}, "current": {...}, "tables": {...}} mapping table names
+        to the hash of their last raw file, current snapshot and warehouse table
+        inputs. Empty dicts on the first run.
+    """
+    async def read_hashes(storage):
+        keys = (
+            await storage.list(bucket, hash_file_prefix) if table_names is None
+            else [f"{hash_file_prefix}{table_name}.json" for table_name in table_names]
+        )
+        # One object per table, all read at once
+        return await storage.get_many(bucket, keys)
+
+    hashes = {"raw": {}, "current": {}, "tables": {}}
+    try:
+        objects = run(read_hashes(get_storage(client)))
+    except Exception as e:
+        logging.error(e)
+        raise Exception(f"Can't retrieve hashes due to {e}")
+    for key, obj in objects.items():
+        if obj is None:
+            continue
+        table_name = key[len(hash_file_prefix):-len(".json")]
+        for kind, table_hash in json.loads(obj["body"]).items():
+            hashes[kind][table_name] = table_hash
+    return hashes
+
+
+def save_hashes(client, bucket, hashes, previous=None):
+    """
+    Saves the content hashes as one JSON state object per table. Only the tables
+    whose hashes differ from previous are saved, every table if it's None.
+    """
+    def table_hashes(hashes, table_name):
+        return {kind: hashes[kind][table_name] for kind in hashes if table_name in hashes[kind]}
+
+    for table_name in sorted({table_name for kind in hashes.values() for table_name in kind}):
+        saved = table_hashes(hashes, table_name)
+        if previous is not None and saved == table_hashes(previous, table_name):
+            continue
+        try:
+            run(get_storage(client).put(
+                bucket, f"{hash_file_prefix}{table_name}.json", json.dumps(saved, sort_keys=True).encode()
+            ))
+        except Exception as e:
+            logging.error(e)
+            raise Exception("Failed to save hashes")
+
+
+def content_hash(df):
+    """
+    Hashes the rows of a data frame regardless of their order. polars row hashes
+    are only stable for one polars version, so upgrading it makes every table look
+    changed once.
+    """
+    row_hashes = df.hash_rows(seed=0).sort().to_numpy()
+    return hashlib.blake2b(
+        json.dumps(df.columns).encode() + row_hashes.tobytes(), digest_size=16
+    ).hexdigest()
+
+
+def combine_hashes(hashes):
+    """
+    Hashes a list of hashes, e.g. those of the sources a warehouse table is built from.
+    """
+    return hashlib.blake2b("|".join(hashes).encode(), digest_size=16).hexdigest()
+
+
+def changed_rows(new, old):
+    """
+    Returns the rows of new that aren't in old exactly as they are, i.e. the rows
+    inserted or updated since old was written.
+    """
+    if old is None or new.columns != old.columns:
+        return new
+    return new.filter(~new.hash_rows(seed=0).is_in(old.hash_rows(seed=0).implode()))
+
+
+def parse_time_prefix(prefix):
+    """
+    Reads the time a run started from its time prefix. Prefixes written before
+    the month, day and hour were zero padded are read too.
+    """
+    return datetime.strptime(prefix.strip("/"), time_prefix_format)
+
+
+def processed_key(table_name, prefix):
+    """
+    Key of the parquet file written for a table in the run with this time prefix.
+    Files are partitioned by table and day, hive style, and named after the time
+    the run started so they sort in the order they were written, e.g.
+    /history/table=sales_order/date=2024-08-05/20240805T090307.parquet
+    """
+    run_time = parse_time_prefix(prefix)
+    return f"/history/table={table_name}/date={run_time:%Y-%m-%d}/{run_time:%Y%m%dT%H%M%S}.parquet"
+
+
+def manifest_key(table_name):
+    return f"/history/table={table_name}/_manifest.json"
+
+
+def get_manifest(client, bucket, table_name):
+    """
+    Retrieves the manifest of a table's processed files, so readers know which
+    files there are without listing the bucket.
+
+    Returns:
+        dict: {"files": [...]} with a dict per file holding its key, date
+        partition, rows, bytes and min/max last update, in key order. No files
+        if the table has never been written.
+    """
+    try:
+        obj = run(get_storage(client).get(bucket, manifest_key(table_name)))
+    except Exception as e:
+        logging.error(e)
+        raise Exception(f"Can't retrieve manifest for {table_name} due to {e}")
+    return {"files": []} if obj is None else json.loads(obj["body"])
+
+
+def save_manifest(client, bucket, table_name, manifest):
+    """
+    Saves a table's manifest, with its files sorted by key.
+    """
+    manifest["files"].sort(key=lambda file: file["key"])
+    try:
+        run(get_storage(client).put(bucket, manifest_key(table_name), json.dumps(manifest, sort_keys=True).encode()))
+    except Exception as e:
+        logging.error(e)
+        raise Exception(f"Failed to save manifest for {table_name}")
+
+
+def merge_parquet_files(client, bucket, keys, key):
+    """
+    Merges parquet files into one written with the compact profile. Only the
+    encoded files are held whole; they're decoded one at a time and written out a
+    row group at a time, so a merge needs little more memory than its files' size
+    on disk. Columns missing from some of the files are filled with nulls.
+
+    Returns:
+        int: size of the merged parquet file in bytes
+    """
+    import pyarrow.parquet as pq
+
+    bodies = [obj["body"] for obj in (run(get_storage(client).get(bucket, file_key)) for file_key in keys) if obj is not None]
+    schema = pl.concat(
+        [pl.DataFrame(schema=pl.read_parquet_schema(BytesIO(body))) for body in bodies], how="diagonal_relaxed"
+    )
+    settings = parquet_profiles["compact"]
+    with get_storage(client).writer(bucket, key) as writer:
+        parquet_writer = pq.ParquetWriter(
+            writer,
+            schema.to_arrow().schema,
+            compression=settings["compression"],
+            compression_level=settings["compression_level"],
+            write_statistics=bool(settings["statistics"]),
+        )
+        pending = []
+        for body in bodies:
+            pending.append(pl.concat([schema, pl.read_parquet(BytesIO(body))], how="diagonal_relaxed"))
+            if sum(frame.height for frame in pending) >= settings["row_group_size"]:
+                parquet_writer.write_table(pl.concat(pending).to_arrow(), row_group_size=settings["row_group_size"])
+                pending = []
+        if pending or not bodies:
+            parquet_writer.write_table(pl.concat([schema, *pending]).to_arrow(), row_group_size=settings["row_group_size"])
+        parquet_writer.close()
+    return writer.bytes_written
+
+
+def merged_entry(group, key, parquet_bytes):
+    """
+    Describes a file merged from the files in group for the manifest, from their
+    own entries rather than the merged rows.
+    """
+    mins = [file["min_last_updated"] for file in group if file["min_last_updated"] is not None]
+    maxes = [file["max_last_updated"] for file in group if file["max_last_updated"] is not None]
+    return {
+        "key": key,
+        "date": group[0]["date"],
+        "rows": sum(file["rows"] for file in group),
+        "bytes": parquet_bytes,
+        "min_last_updated": min(mins) if mins else None,
+        "max_last_updated": max(maxes) if maxes else None,
+    }
+
+
+def manifest_entry(df, key, parquet_bytes):
+    """
+    Describes a processed file for the manifest. The update range is taken from
+    the first of updated_columns the data frame has, and is None for tables
+    without one, e.g. dimensions.
+    """
+    column = next((column for column in updated_columns if column in df.columns), None)
+    updated = [None, None]
+    if column is not None and not df.is_empty():
+        updated = [str(value) for value in df.select(pl.col(column).min().alias("min"), pl.col(column).max().alias("max")).row(0)]
+    return {
+        "key": key,
+        "date": key.split("/date=")[1].split("/")[0],
+        "rows": df.height,
+        "bytes": parquet_bytes,
+        "min_last_updated": updated[0],
+        "max_last_updated": updated[1],
+    }
+
+
+def add_to_manifest(manifest, entry):
+    """
+    Adds a file to a manifest, replacing the entry for the same key if the run that
+    wrote it is retried.
+    """
+    manifest["files"] = [file for file in manifest["files"] if file["key"] != entry["key"]] + [entry]
+
+
+def compaction_groups(files, before_date, target_bytes=compacted_file_bytes):
+    """
+    Picks which files of a manifest to merge: consecutive small files in the same
+    date partition, for days before before_date, grouped until they would add up to
+    more than target_bytes. Today's partition is still being written, so it's left
+    alone.
+
+    Returns:
+        list: lists of at least two manifest entries, each to be merged into one file
+    """
+    groups = []
+    group = []
+    for file in sorted(files, key=lambda file: file["key"]):
+        small = file["date"] < before_date and file["bytes"] < target_bytes
+        fits = group and file["date"] == group[0]["date"] and sum(f["bytes"] for f in group) + file["bytes"] <= target_bytes
+        if not (small and fits):
+            if len(group) > 1:
+                groups.append(group)
+            group = []
+        if small:
+            group.append(file)
+    if len(group) > 1:
+        groups.append(group)
+    return groups
+
+
+def compact_files(client, bucket, table_name, before_date, target_bytes=compacted_file_bytes):
+    """
+    Merges the small files of a table's closed date partitions into files of about
+    target_bytes, written with the compact parquet profile, one group at a time.
+
+    Runs apart from the transform, so the manifest is read again just before it's
+    saved and only the merged files are swapped in it, keeping any file the
+    transform added meanwhile. It's saved before the merged files are deleted so
+    it never lists a file that isn't there.
+
+    Returns:
+        int: how many files were merged away
+    """
+    groups = compaction_groups(get_manifest(client, bucket, table_name)["files"], before_date, target_bytes)
+    merged = []
+    for group in groups:
+        # Named after the runs the merged files came from, so the keys still sort in
+        # time order
+        partition, first_name = group[0]["key"].rsplit("/", 1)
+        last_name = group[-1]["key"].rsplit("/", 1)[1]
+        key = f"{partition}/{first_name.split('-')[0].removesuffix('.parquet')}-{last_name.split('-')[-1]}"
+        parquet_bytes = merge_parquet_files(client, bucket, [file["key"] for file in group], key)
+        merged.append((group, merged_entry(group, key, parquet_bytes)))
+    if not merged:
+        return 0
 
-    return parquet
+    manifest = get_manifest(client, bucket, table_name)
+    merged_keys = [file["key"] for group, _ in merged for file in group]
+    manifest["files"] = [file for file in manifest["files"] if file["key"] not in merged_keys]
+    for _, entry in merged:
+        add_to_manifest(manifest, entry)
+    save_manifest(client, bucket, table_name, manifest)
+    run(get_storage(client).delete(bucket, merged_keys))
+    return len(merged_keys)
@@ -177,7 +177,13 @@ data "aws_iam_policy_document" "scheduler_document" {
 
     resources = ["*"]
   }
-} # Scheduler - Step func execution
+
+  statement {
+    actions = ["lambda:InvokeFunction"]
+
+    resources = [aws_lambda_function.transform_lambda.arn]
+  }
+} # Scheduler - Step func execution, Lambda - compaction
 
 
 resource "aws_iam_policy" "s3_read_write_object_policy" {
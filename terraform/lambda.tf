@@ -11,14 +11,98 @@ data "archive_file" "extract_lambda" {
     filename = "src/utils/extract_utils.py"
   }
 
+  source {
+    content  = file("${path.module}/../src/utils/diff_utils.py")
+    filename = "src/utils/diff_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/s3_utils.py")
+    filename = "src/utils/s3_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/schema_utils.py")
+    filename = "src/utils/schema_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/cache_utils.py")
+    filename = "src/utils/cache_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/storage_utils.py")
+    filename = "src/utils/storage_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/metrics_utils.py")
+    filename = "src/utils/metrics_utils.py"
+  }
+
   output_path = "${path.module}/../zip_code/extract.zip"
 }
 
 data "archive_file" "load_lambda" {
   type             = "zip"
   output_file_mode = "0666"
-  source_file      = "${path.module}/../src/lambda_functions/load.py"
-  output_path      = "${path.module}/../zip_code/load.zip"
+  source {
+    content  = file("${path.module}/../src/lambda_functions/load.py")
+    filename = "load.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/load_utils.py")
+    filename = "src/utils/load_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/freshness_utils.py")
+    filename = "src/utils/freshness_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/extract_utils.py")
+    filename = "src/utils/extract_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/diff_utils.py")
+    filename = "src/utils/diff_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/s3_utils.py")
+    filename = "src/utils/s3_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/transform_utils.py")
+    filename = "src/utils/transform_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/schema_utils.py")
+    filename = "src/utils/schema_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/cache_utils.py")
+    filename = "src/utils/cache_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/storage_utils.py")
+    filename = "src/utils/storage_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/metrics_utils.py")
+    filename = "src/utils/metrics_utils.py"
+  }
+
+  output_path = "${path.module}/../zip_code/load.zip"
 }
 
 data "archive_file" "transform_lambda" {
@@ -34,6 +118,41 @@ data "archive_file" "transform_lambda" {
     filename = "src/utils/transform_utils.py"
   }
 
+  source {
+    content  = file("${path.module}/../src/utils/schema_utils.py")
+    filename = "src/utils/schema_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/cache_utils.py")
+    filename = "src/utils/cache_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/storage_utils.py")
+    filename = "src/utils/storage_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/metrics_utils.py")
+    filename = "src/utils/metrics_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/s3_utils.py")
+    filename = "src/utils/s3_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/diff_utils.py")
+    filename = "src/utils/diff_utils.py"
+  }
+
+  source {
+    content  = file("${path.module}/../src/utils/pipeline_utils.py")
+    filename = "src/utils/pipeline_utils.py"
+  }
+
   output_path = "${path.module}/../zip_code/transform.zip"
 }
 
@@ -101,4 +220,5 @@ resource "aws_lambda_function" "transform_lambda" { #Provision the lambda
   runtime          = var.python_runtime
   handler          = "transform.lambda_handler"
   timeout          = 120
+  memory_size      = 1024 # the daily compaction holds a merge's ~128MB of encoded files and one row group decoded
 }
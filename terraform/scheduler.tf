@@ -11,5 +11,25 @@ resource "aws_scheduler_schedule" "scheduler" {
   target {
     arn      = aws_sfn_state_machine.sfn_state_machine.arn
     role_arn = aws_iam_role.iam_for_scheduler.arn
+    input    = jsonencode({ mode = "incremental", max_concurrency = 4, db_pool_size = 2, engine = "cursor" })
   }
-}
\ No newline at end of file
+}
+
+resource "aws_scheduler_schedule" "compaction_scheduler" {
+  name       = "daily-compaction-scheduler"
+  group_name = "default"
+
+  flexible_time_window {
+    mode = "OFF"
+  }
+
+  # Merges the small processed files of the days that are over, apart from the
+  # pipeline runs so they don't hold a day's files in memory
+  schedule_expression = "cron(30 0 * * ? *)"
+
+  target {
+    arn      = aws_lambda_function.transform_lambda.arn
+    role_arn = aws_iam_role.iam_for_scheduler.arn
+    input    = jsonencode({ stage = "compact" })
+  }
+}
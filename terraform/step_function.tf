@@ -4,7 +4,7 @@ resource "aws_sfn_state_machine" "sfn_state_machine" {
 
   definition = <<EOF
 {
-  "Comment": "ETL Pipeline (DAG) to get data from totesys and load it as parquet format",
+  "Comment": "ETL Pipeline (DAG) to get data from totesys and load it as parquet format. Extract reports the tables that changed, Plan turns them into waves of per-table steps (each wave only depends on the waves before it) and every step of a wave runs in parallel in its own Lambda invocation",
   "StartAt": "Extract Invoke",
   "States": {
     "Extract Invoke": {
@@ -39,14 +39,20 @@ resource "aws_sfn_state_machine" "sfn_state_machine" {
         "Next": "SnsNotification"
         } 
       ],
-      "Next": "Transform Invoke"
+      "Next": "Plan Invoke"
     },
-    "Transform Invoke": {
+    "Plan Invoke": {
       "Type": "Task",
       "Resource": "arn:aws:states:::lambda:invoke",
       "OutputPath": "$.Payload",
       "Parameters": {
-        "Payload.$": "$",
+        "Payload": {
+          "stage": "plan",
+          "time_prefix.$": "$.time_prefix",
+          "output_format.$": "$.output_format",
+          "changed_tables.$": "$.changed_tables",
+          "source_last_updated.$": "$.source_last_updated"
+        },
         "FunctionName": "arn:aws:lambda:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:function:${var.transform_lambda}:$LATEST"
       },
       "Retry": [
@@ -73,29 +79,99 @@ resource "aws_sfn_state_machine" "sfn_state_machine" {
         "Next": "SnsNotification"
         } 
       ],
-      "Next": "Load Invoke"
+      "Next": "Run Waves"
     },
-    "Load Invoke": {
-      "Type": "Task",
-      "Resource": "arn:aws:states:::lambda:invoke",
-      "OutputPath": "$.Payload",
-      "Parameters": {
-        "Payload.$": "$",
-        "FunctionName": "arn:aws:lambda:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:function:${var.load_lambda}:$LATEST"
+    "Run Waves": {
+      "Type": "Map",
+      "ItemsPath": "$.waves",
+      "MaxConcurrency": 1,
+      "ItemSelector": {
+        "wave.$": "$$.Map.Item.Value",
+        "time_prefix.$": "$.time_prefix",
+        "output_format.$": "$.output_format",
+        "changed_tables.$": "$.changed_tables",
+        "source_last_updated.$": "$.source_last_updated"
       },
-      "Retry": [
-        {
-          "ErrorEquals": [
-            "Lambda.ServiceException",
-            "Lambda.AWSLambdaException",
-            "Lambda.SdkClientException",
-            "Lambda.TooManyRequestsException"
-          ],
-          "IntervalSeconds": 1,
-          "MaxAttempts": 3,
-          "BackoffRate": 2
+      "ItemProcessor": {
+        "ProcessorConfig": {"Mode": "INLINE"},
+        "StartAt": "Run Tables",
+        "States": {
+          "Run Tables": {
+            "Type": "Map",
+            "ItemsPath": "$.wave",
+            "MaxConcurrency": 0,
+            "ItemSelector": {
+              "stage.$": "$$.Map.Item.Value.stage",
+              "table_name.$": "$$.Map.Item.Value.table_name",
+              "time_prefix.$": "$.time_prefix",
+              "output_format.$": "$.output_format",
+              "changed_tables.$": "$.changed_tables",
+              "source_last_updated.$": "$.source_last_updated"
+            },
+            "ItemProcessor": {
+              "ProcessorConfig": {"Mode": "INLINE"},
+              "StartAt": "Choose Stage",
+              "States": {
+                "Choose Stage": {
+                  "Type": "Choice",
+                  "Choices": [
+                    {"Variable": "$.stage", "StringEquals": "load", "Next": "Load Table Invoke"}
+                  ],
+                  "Default": "Transform Table Invoke"
+                },
+                "Transform Table Invoke": {
+                  "Type": "Task",
+                  "Resource": "arn:aws:states:::lambda:invoke",
+                  "OutputPath": "$.Payload",
+                  "Parameters": {
+                    "Payload.$": "$",
+                    "FunctionName": "arn:aws:lambda:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:function:${var.transform_lambda}:$LATEST"
+                  },
+                  "Retry": [
+                    {
+                      "ErrorEquals": [
+                        "Lambda.ServiceException",
+                        "Lambda.AWSLambdaException",
+                        "Lambda.SdkClientException",
+                        "Lambda.TooManyRequestsException"
+                      ],
+                      "IntervalSeconds": 1,
+                      "MaxAttempts": 3,
+                      "BackoffRate": 2
+                    }
+                  ],
+                  "End": true
+                },
+                "Load Table Invoke": {
+                  "Type": "Task",
+                  "Resource": "arn:aws:states:::lambda:invoke",
+                  "OutputPath": "$.Payload",
+                  "Parameters": {
+                    "Payload.$": "$",
+                    "FunctionName": "arn:aws:lambda:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:function:${var.load_lambda}:$LATEST"
+                  },
+                  "Retry": [
+                    {
+                      "ErrorEquals": [
+                        "Lambda.ServiceException",
+                        "Lambda.AWSLambdaException",
+                        "Lambda.SdkClientException",
+                        "Lambda.TooManyRequestsException"
+                      ],
+                      "IntervalSeconds": 1,
+                      "MaxAttempts": 3,
+                      "BackoffRate": 2
+                    }
+                  ],
+                  "End": true
+                }
+              }
+            },
+            "End": true
+          }
         }
-      ],
+      },
+      "ResultPath": null,
       "Catch": [ {
         "ErrorEquals": [
             "Lambda.ServiceException",
@@ -0,0 +1,48 @@
+import pytest
+from src.utils import cache_utils
+from src.utils.cache_utils import get_or_create, peek, invalidate, clear_cache
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    clear_cache()
+    yield
+    clear_cache()
+
+
+class Counter:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.calls
+
+
+class TestGetOrCreate:
+    @pytest.mark.it("creates the value once and then reuses it")
+    def test_reuses_value(self):
+        factory = Counter()
+        assert get_or_create("key", factory) == 1
+        assert get_or_create("key", factory) == 1
+        assert factory.calls == 1
+
+    @pytest.mark.it("creates the value again once its ttl has expired")
+    def test_ttl(self, monkeypatch):
+        now = [100.0]
+        monkeypatch.setattr(cache_utils.time, "monotonic", lambda: now[0])
+        factory = Counter()
+        get_or_create("key", factory, ttl=60)
+        now[0] += 59
+        assert get_or_create("key", factory, ttl=60) == 1
+        now[0] += 2
+        assert get_or_create("key", factory, ttl=60) == 2
+        assert peek("key") == 2
+
+    @pytest.mark.it("invalidated values are created again")
+    def test_invalidate(self):
+        factory = Counter()
+        get_or_create("key", factory)
+        invalidate("key")
+        assert peek("key") is None
+        assert get_or_create("key", factory) == 2
@@ -0,0 +1,131 @@
+import pytest
+import csv
+import polars as pl
+import numpy as np
+from src.utils.diff_utils import diff_snapshots, diff_parquet_snapshots, hash_row, primary_keys
+from src.utils.diff_utils import index_rows, build_index, encode_index, decode_index, diff_batch
+
+
+def write_csv(path, rows):
+    with open(path, "w", newline="") as f:
+        csv.writer(f).writerows(rows)
+    return str(path)
+
+
+header = ["sales_order_id", "last_updated", "units_sold", "unit_price"]
+
+old_rows = [
+    header,
+    ["1", "2024-08-16 10:00:00.123", "100", "2.50"],
+    ["2", "2024-08-16 10:00:00.456", "200", "3.75"],
+    ["3", "2024-08-16 10:00:00.789", "300", "2.00"],
+]
+
+new_rows = [
+    header,
+    ["2", "2024-08-17 09:00:00.000", "250", "3.75"],
+    ["1", "2024-08-16 10:00:00.123", "100", "2.50"],
+    ["4", "2024-08-17 09:30:00.000", "400", "3.10"],
+]
+
+
+class TestHashRow:
+    @pytest.mark.it("equal rows have equal hashes")
+    def test_equal_rows(self):
+        assert hash_row(["1", "a b", "2.5"]) == hash_row(["1", "a b", "2.5"])
+
+    @pytest.mark.it("hash does not merge neighbouring fields")
+    def test_field_boundaries(self):
+        assert hash_row(["1", "23"]) != hash_row(["12", "3"])
+
+
+class TestDiffSnapshots:
+    @pytest.mark.it("every table has a primary key")
+    def test_primary_keys(self):
+        assert len(primary_keys) == 11
+
+    @pytest.mark.it("no changes found when snapshots are equal")
+    def test_no_changes(self, tmp_path):
+        old = write_csv(tmp_path / "old.csv", old_rows)
+        assert list(diff_snapshots(old, old, "sales_order_id")) == []
+
+    @pytest.mark.it("emits typed inserts, updates and deletes regardless of row order")
+    def test_typed_changes(self, tmp_path):
+        old = write_csv(tmp_path / "old.csv", old_rows)
+        new = write_csv(tmp_path / "new.csv", new_rows)
+        assert list(diff_snapshots(old, new, "sales_order_id")) == [
+            ("update", ["2", "2024-08-17 09:00:00.000", "250", "3.75"]),
+            ("insert", ["4", "2024-08-17 09:30:00.000", "400", "3.10"]),
+            ("delete", ["3", "2024-08-16 10:00:00.789", "300", "2.00"]),
+        ]
+
+    @pytest.mark.it("partitioned diff finds the same changes")
+    def test_partitioned(self, tmp_path):
+        old = write_csv(tmp_path / "old.csv", old_rows)
+        new = write_csv(tmp_path / "new.csv", new_rows)
+        assert sorted(diff_snapshots(old, new, "sales_order_id", partitions=4)) == sorted(
+            diff_snapshots(old, new, "sales_order_id")
+        )
+
+    @pytest.mark.it("diffs parquet snapshots too")
+    def test_parquet(self, tmp_path):
+        old = tmp_path / "old.parquet"
+        new = tmp_path / "new.parquet"
+        pl.DataFrame({"design_id": [1, 2], "design_name": ["Chair", "Table"]}).write_parquet(old)
+        pl.DataFrame({"design_id": [1, 3], "design_name": ["Chair v2", None]}).write_parquet(new)
+        assert list(diff_snapshots(str(old), str(new), "design_id")) == [
+            ("update", ["1", "Chair v2"]),
+            ("insert", ["3", ""]),
+            ("delete", ["2", "Table"]),
+        ]
+
+    @pytest.mark.it("diffs parquet snapshots into rows of the same types")
+    def test_parquet_typed(self, tmp_path):
+        old = tmp_path / "old.parquet"
+        new = tmp_path / "new.parquet"
+        pl.DataFrame({"design_id": [1, 2, 4], "design_name": ["Chair", "Table", None]}).write_parquet(old)
+        pl.DataFrame({"design_id": [1, 3, 4], "design_name": ["Chair v2", None, None]}).write_parquet(new)
+        changes = pl.from_arrow(diff_parquet_snapshots(str(old), str(new), "design_id"))
+        assert changes.schema == {"design_id": pl.Int64, "design_name": pl.String, "change_type": pl.String}
+        assert changes.rows() == [(3, None, "insert"), (1, "Chair v2", "update"), (2, "Table", "delete")]
+        assert diff_parquet_snapshots(str(new), str(new), "design_id").num_rows == 0
+
+
+class TestSnapshotIndex:
+    def index(self, rows, file_id=0):
+        keys, hashes = index_rows(rows, 0)
+        return build_index(["old.csv"], keys, hashes, np.full(len(rows), file_id))
+
+    @pytest.mark.it("sorts the rows by primary key")
+    def test_build_index(self):
+        index = self.index(new_rows[1:])
+        assert index["keys"].tolist() == [1, 2, 4]
+        assert index["hashes"][0] == hash_row(new_rows[2])
+
+    @pytest.mark.it("round trips through its binary layout at 20 bytes a row")
+    def test_encode(self):
+        index = self.index(old_rows[1:])
+        data = encode_index(index)
+        decoded = decode_index(data)
+        assert decoded["files"] == ["old.csv"]
+        for column in ["keys", "hashes", "file_ids"]:
+            assert np.array_equal(decoded[column], index[column])
+        # 16 byte header, the files JSON padded to 16 bytes, then 3 rows
+        assert len(data) == 16 + 16 + 3 * 20
+
+    @pytest.mark.it("finds inserted, updated and deleted rows with a binary search")
+    def test_diff_batch(self):
+        index = self.index(old_rows[1:])
+        keys, hashes = index_rows(new_rows[1:], 0)
+        seen = np.zeros(3, dtype=bool)
+        positions, changed = diff_batch(index, keys, hashes, seen)
+        assert positions.tolist() == [1, 0, -1]
+        assert changed.tolist() == [True, False, True]
+        assert index["keys"][~seen].tolist() == [3]
+
+    @pytest.mark.it("drops the files no row points at anymore")
+    def test_unused_files(self):
+        keys, hashes = index_rows(old_rows[1:], 0)
+        index = build_index(["a.csv", "b.csv", "c.csv"], keys, hashes, np.array([2, 0, 2]))
+        assert index["files"] == ["a.csv", "c.csv"]
+        assert index["file_ids"].tolist() == [1, 0, 1]
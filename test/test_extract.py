@@ -4,10 +4,15 @@ import os
 import shutil
 import json
 from moto import mock_aws
-from src.lambda_functions.extract import lambda_handler, get_secret
+from src.lambda_functions.extract import lambda_handler, data_tables, get_watermarks, get_watermark_keys, diff_against_original
+from src.utils.cache_utils import clear_cache
+from contextlib import contextmanager
 from datetime import datetime as dt
 from dotenv import load_dotenv, find_dotenv
 import csv
+import polars as pl
+from io import BytesIO
+from itertools import count
 
 env_file = find_dotenv(f'.env.{os.getenv("ENV")}')
 load_dotenv(env_file)
@@ -67,6 +72,14 @@ Switch back to .env.development to use the online database.
 """
 
 
+@pytest.fixture(autouse=True)
+def empty_cache():
+    """Stops resources cached by one test's invocation leaking into the next."""
+    clear_cache()
+    yield
+    clear_cache()
+
+
 @pytest.fixture(scope="function")
 def aws_credentials():
     """Mocked AWS Credentials for S3 bucket."""
@@ -216,3 +229,160 @@ class TestLambdaHandler:
     #     event = {}
     #     context = DummyContext()
     #     assert not lambda_handler(event, context)
+
+
+fingerprint_calls = count()
+
+
+class FakeTableConnection:  # Serves one row per table, failing for broken tables
+    def __init__(self, broken_tables, fingerprint=None):
+        self.broken_tables = broken_tables
+        self.fingerprint = fingerprint
+
+    def run(self, sql, **params):
+        if "count(*)" in sql:
+            # Tables change between runs unless a fixed fingerprint is given
+            return [self.fingerprint or [next(fingerprint_calls), dt(2024, 8, 16, 10, 0, 0), "keys-hash"]]
+        if "md5(" in sql:
+            return [["schema-hash"]]
+        if "is_primary_key" in sql:
+            return [
+                row
+                for table in data_tables
+                for row in (
+                    [table, "id", 1, "integer", False, True],
+                    [table, "last_updated", 2, "timestamp without time zone", False, False],
+                )
+            ]
+        for table in self.broken_tables:
+            if f'"{table}"' in sql:
+                raise Exception(f"relation {table} does not exist")
+        if sql.startswith("FETCH"):
+            # A single batch, then the cursor is exhausted
+            self.fetched = not getattr(self, "fetched", False)
+            return [[1, dt(2024, 8, 16, 10, 0, 0)]] if self.fetched else []
+        return [[1, dt(2024, 8, 16, 10, 0, 0)]]
+
+
+def fake_pool(broken_tables, fingerprint=None):
+    class FakePool:
+        def __init__(self, credentials, size):
+            self.size = size
+
+        @contextmanager
+        def connection(self):
+            yield FakeTableConnection(broken_tables, fingerprint)
+
+        def close(self):
+            pass
+
+    return FakePool
+
+
+class TestConcurrentExtraction:
+    @pytest.mark.it("a failing table is reported without stopping the other tables")
+    def test_failures_isolated(self, s3, secretsmanager, monkeypatch):
+        monkeypatch.setattr("src.utils.extract_utils.ConnectionPool", fake_pool(["payment"]))
+        result = lambda_handler({"max_concurrency": 4}, DummyContext())
+        assert list(result["failed_tables"]) == ["payment"]
+        listing = s3.list_objects_v2(Bucket="totesys-raw-data-000000", Prefix="/source/")
+        assert len(listing["Contents"]) == 10
+
+    @pytest.mark.it("raises an exception when every table fails")
+    def test_every_table_fails(self, s3, secretsmanager, monkeypatch):
+        monkeypatch.setattr("src.utils.extract_utils.ConnectionPool", fake_pool(data_tables))
+        with pytest.raises(Exception):
+            lambda_handler({"max_concurrency": 4}, DummyContext())
+
+    @pytest.mark.it("incremental mode saves a watermark for every extracted table")
+    def test_incremental_watermarks(self, s3, secretsmanager, monkeypatch):
+        monkeypatch.setattr("src.utils.extract_utils.ConnectionPool", fake_pool([]))
+        lambda_handler({"mode": "incremental", "max_concurrency": 4}, DummyContext())
+        watermarks = get_watermarks(s3, "totesys-raw-data-000000")
+        assert watermarks == {table: "2024-08-16T10:00:00" for table in data_tables}
+        assert get_watermark_keys(s3, "totesys-raw-data-000000") == {table: [1] for table in data_tables}
+
+    @pytest.mark.it("incremental mode keeps the keys already extracted at an unchanged watermark")
+    def test_incremental_watermark_keys(self, s3, secretsmanager, monkeypatch):
+        monkeypatch.setattr("src.utils.extract_utils.ConnectionPool", fake_pool([]))
+        s3.put_object(
+            Bucket="totesys-raw-data-000000", Key="/state/watermarks.json",
+            Body=json.dumps({table: "2024-08-16T10:00:00" for table in data_tables}),
+        )
+        s3.put_object(
+            Bucket="totesys-raw-data-000000", Key="/state/watermark_keys.json",
+            Body=json.dumps({table: [7] for table in data_tables}),
+        )
+        lambda_handler({"mode": "incremental", "max_concurrency": 4}, DummyContext())
+        assert get_watermark_keys(s3, "totesys-raw-data-000000") == {table: [7, 1] for table in data_tables}
+
+    @pytest.mark.it("reports the tables whose history got changed rows")
+    def test_changed_tables(self, s3, secretsmanager, monkeypatch):
+        monkeypatch.setattr("src.utils.extract_utils.ConnectionPool", fake_pool([]))
+        # Every row of the first snapshot is new, the second snapshot is unchanged
+        result = lambda_handler({"max_concurrency": 4}, DummyContext())
+        assert result["changed_tables"] == data_tables
+        history = s3.list_objects_v2(Bucket="totesys-raw-data-000000", Prefix="/history/")["Contents"]
+        assert sorted(obj["Key"] for obj in history) == sorted(
+            f"/history/{table}/differences_{result['time_prefix']}.csv" for table in data_tables
+        )
+        assert lambda_handler({"max_concurrency": 4}, DummyContext())["changed_tables"] == []
+
+        lambda_handler({"mode": "incremental", "max_concurrency": 4}, DummyContext())
+        result = lambda_handler({"mode": "incremental", "max_concurrency": 4}, DummyContext())
+        assert result["changed_tables"] == data_tables
+        assert result["source_last_updated"] == {table: "2024-08-16T10:00:00" for table in data_tables}
+
+    @pytest.mark.it("tables whose fingerprint hasn't changed are neither uploaded nor diffed")
+    def test_unchanged_fingerprint_skipped(self, s3, secretsmanager, monkeypatch):
+        fingerprint = [1, dt(2024, 8, 16, 10, 0, 0), "keys-hash"]
+        monkeypatch.setattr("src.utils.extract_utils.ConnectionPool", fake_pool([], fingerprint))
+        assert lambda_handler({"max_concurrency": 4}, DummyContext())["skipped_tables"] == []
+
+        result = lambda_handler({"max_concurrency": 4}, DummyContext())
+        assert result["skipped_tables"] == data_tables
+        assert result["changed_tables"] == []
+        listing = s3.list_objects_v2(Bucket="totesys-raw-data-000000")
+        assert not [obj["Key"] for obj in listing["Contents"] if "_new" in obj["Key"]]
+        # Only the first snapshot's differences
+        assert len([obj["Key"] for obj in listing["Contents"] if "differences" in obj["Key"]]) == len(data_tables)
+        saved = json.loads(s3.get_object(Bucket="totesys-raw-data-000000", Key="/state/fingerprints.json")["Body"].read())
+        assert saved == {table: [1, "2024-08-16T10:00:00", "keys-hash"] for table in data_tables}
+
+    @pytest.mark.it("full_snapshot and a fingerprint of off extract every table")
+    def test_fingerprint_bypassed(self, s3, secretsmanager, monkeypatch):
+        fingerprint = [1, dt(2024, 8, 16, 10, 0, 0), "keys-hash"]
+        monkeypatch.setattr("src.utils.extract_utils.ConnectionPool", fake_pool([], fingerprint))
+        lambda_handler({"max_concurrency": 4}, DummyContext())
+        assert lambda_handler({"max_concurrency": 4, "full_snapshot": True}, DummyContext())["skipped_tables"] == []
+        assert lambda_handler({"max_concurrency": 4, "fingerprint": "off"}, DummyContext())["skipped_tables"] == []
+
+
+class TestDiffAgainstOriginal:
+    original_key = "/source/design/design_original.parquet"
+    new_key = "/source/design/design_new.parquet"
+
+    def put(self, s3, key, df):
+        buffer = BytesIO()
+        df.write_parquet(buffer)
+        s3.put_object(Bucket="totesys-raw-data-000000", Key=key, Body=buffer.getvalue())
+
+    def read(self, s3, key):
+        return pl.read_parquet(BytesIO(s3.get_object(Bucket="totesys-raw-data-000000", Key=key)["Body"].read()))
+
+    @pytest.mark.it("uploads the changed rows as parquet and replaces the original with the new snapshot")
+    def test_parquet_differences(self, s3):
+        self.put(s3, self.original_key, pl.DataFrame({"design_id": [1, 2], "design_name": ["Chair", "Table"]}))
+        self.put(s3, self.new_key, pl.DataFrame({"design_id": [1, 2], "design_name": ["Chair", "Desk"]}))
+        assert diff_against_original(s3, "totesys-raw-data-000000", "design", "first", "parquet")
+        assert self.read(s3, "/history/design/differences_first.parquet").rows() == [(2, "Desk", "update")]
+        assert self.read(s3, self.original_key)["design_name"].to_list() == ["Chair", "Desk"]
+        keys = [obj["Key"] for obj in s3.list_objects_v2(Bucket="totesys-raw-data-000000")["Contents"]]
+        assert self.new_key not in keys
+
+        # The next run only sees what changed since this one
+        self.put(s3, self.new_key, pl.DataFrame({"design_id": [1, 2], "design_name": ["Chair", "Desk"]}))
+        assert not diff_against_original(s3, "totesys-raw-data-000000", "design", "second", "parquet")
+        assert "Contents" not in s3.list_objects_v2(
+            Bucket="totesys-raw-data-000000", Prefix="/history/design/differences_second"
+        )
@@ -4,7 +4,16 @@ import os
 import json
 import csv
 from moto import mock_aws
+from src.utils.cache_utils import clear_cache
+from concurrent.futures import ThreadPoolExecutor
+from pg8000.native import Error
+from contextlib import contextmanager
+from decimal import Decimal
+from io import BytesIO
+import numpy as np
+import polars as pl
 from src.utils.extract_utils import *
+from src.utils.diff_utils import hash_row, build_index, encode_index, legacy_index_magic
 from dotenv import load_dotenv, find_dotenv
 
 
@@ -89,6 +98,19 @@ def secretsmanager_broken(aws_credentials):
         )
         yield secretsmanager
 
+class TestCreateTimePrefix:
+
+    @pytest.mark.it("time prefix is zero padded so prefixes sort in time order")
+    def test_zero_padded_time_prefix(self, monkeypatch):
+        class FixedDatetime(dt):
+            @classmethod
+            def now(cls, tz=None):
+                return cls(2024, 8, 5, 9, 3, 7)
+
+        monkeypatch.setattr("src.utils.extract_utils.dt", FixedDatetime)
+        assert create_time_prefix_for_file() == "2024_08_05_09:03:07"
+
+
 class TestGetSecret:
 
     @pytest.mark.it("get secret returns the correct credentials data")
@@ -135,3 +157,540 @@ class TestGetSecret:
 #             next(reader)
 #             differences = csv.reader(reader)
 #             assert list(differences) == []
+
+
+class FakeConnection:  # Records queries instead of sending them to a database
+    def __init__(self, rows=None):
+        self.rows = rows or []
+        self.queries = []
+
+    def run(self, sql, **params):
+        self.queries.append((sql, params))
+        return self.rows
+
+
+class TestWatermarks:
+
+    @pytest.mark.it("get watermarks returns an empty dict on the first run")
+    def test_get_watermarks_first_run(self, s3):
+        assert get_watermarks(s3, "totesys-raw-data-000000") == {}
+
+    @pytest.mark.it("saved watermarks can be read back")
+    def test_save_and_get_watermarks(self, s3):
+        watermarks = {"sales_order": "2024-08-16T10:00:00.123000"}
+        save_watermarks(s3, "totesys-raw-data-000000", watermarks)
+        assert get_watermarks(s3, "totesys-raw-data-000000") == watermarks
+
+    @pytest.mark.it("save watermarks raises an exception if the bucket is missing")
+    def test_save_watermarks_failed(self, s3):
+        with pytest.raises(Exception):
+            save_watermarks(s3, "imposter-steve", {})
+
+
+class TestFingerprints:
+
+    @pytest.mark.it("counts rows and takes the max last_updated of a table")
+    def test_counts_query(self):
+        assert build_fingerprint_query("sales_order") == 'SELECT count(*), max(last_updated) FROM "sales_order";'
+
+    @pytest.mark.it("hashes the primary keys in order when one is given")
+    def test_keys_query(self):
+        query = build_fingerprint_query("sales_order", "sales_order_id")
+        assert """md5(string_agg("sales_order_id"::text, ',' ORDER BY "sales_order_id"))""" in query
+
+    @pytest.mark.it("returns a JSON ready fingerprint")
+    def test_table_fingerprint(self):
+        conn = FakeConnection([[3, dt(2024, 8, 16, 10, 0, 0), "keys-hash"]])
+        fingerprint = table_fingerprint(conn, "sales_order", "sales_order_id")
+        assert fingerprint == [3, "2024-08-16T10:00:00", "keys-hash"]
+        assert json.loads(json.dumps(fingerprint)) == fingerprint
+
+    @pytest.mark.it("saved fingerprints can be read back")
+    def test_save_and_get_fingerprints(self, s3):
+        assert get_fingerprints(s3, "totesys-raw-data-000000") == {}
+        save_fingerprints(s3, "totesys-raw-data-000000", {"sales_order": [3, None, None]})
+        assert get_fingerprints(s3, "totesys-raw-data-000000") == {"sales_order": [3, None, None]}
+
+
+class TestQueryTable:
+
+    @pytest.mark.it("queries the whole table when no watermark is given")
+    def test_full_query(self):
+        conn = FakeConnection()
+        query_table(conn, "sales_order")
+        assert conn.queries == [('SELECT * FROM "sales_order";', {})]
+
+    @pytest.mark.it("only queries rows updated after the watermark")
+    def test_incremental_query(self):
+        conn = FakeConnection()
+        query_table(conn, "sales_order", "2024-08-16T10:00:00")
+        sql, params = conn.queries[0]
+        assert "WHERE last_updated > :watermark" in sql
+        assert params == {"watermark": "2024-08-16T10:00:00"}
+
+    @pytest.mark.it("queries rows at the watermark again, minus the keys already extracted at it")
+    def test_watermark_keys(self):
+        conn = FakeConnection()
+        query_table(conn, "sales_order", "2024-08-16T10:00:00", "sales_order_id", [3, 7])
+        sql, _ = conn.queries[0]
+        assert sql == (
+            'SELECT * FROM "sales_order" WHERE last_updated >= :watermark '
+            'AND NOT (last_updated = :watermark AND "sales_order_id" IN (3, 7));'
+        )
+        query_table(conn, "sales_order", "2024-08-16T10:00:00", "sales_order_id")
+        assert conn.queries[1][0] == 'SELECT * FROM "sales_order" WHERE last_updated >= :watermark;'
+
+
+class TestFindMaxLastUpdated:
+
+    @pytest.mark.it("returns None when there are no rows")
+    def test_no_rows(self):
+        assert find_max_last_updated(["id", "last_updated"], []) is None
+
+    @pytest.mark.it("returns the latest last_updated value in iso format")
+    def test_returns_latest(self):
+        rows = [
+            [1, dt(2024, 8, 16, 10, 0, 0)],
+            [2, dt(2024, 8, 17, 9, 30, 0, 500)],
+            [3, dt(2024, 8, 15, 23, 59, 59)],
+        ]
+        assert find_max_last_updated(["id", "last_updated"], rows) == "2024-08-17T09:30:00.000500"
+
+
+class TestCompareCsvsByPrimaryKey:
+
+    @pytest.mark.it("writes changed rows with their change type, keeping spaces, dots and dashes")
+    def test_changes_written(self, tmp_path):
+        old, new = tmp_path / "old.csv", tmp_path / "new.csv"
+        old.write_text("design_id,design_name\n1,Wooden chair\n2,Steel-table 2.0\n")
+        new.write_text("design_id,design_name\n1,Wooden chair v2\n3,Bean bag\n")
+        result = compare_csvs(str(old), str(new), "design_id")
+        with open(f"/tmp/{result}", newline="") as reader:
+            assert list(csv.reader(reader)) == [
+                ["design_id", "design_name", "change_type"],
+                ["1", "Wooden chair v2", "update"],
+                ["3", "Bean bag", "insert"],
+                ["2", "Steel-table 2.0", "delete"],
+            ]
+        os.remove(f"/tmp/{result}")
+
+    @pytest.mark.it("writes only the header when both csvs are the same")
+    def test_no_changes(self, tmp_path):
+        old = tmp_path / "old.csv"
+        old.write_text("design_id,design_name\n1,Wooden chair\n")
+        result = compare_csvs(str(old), str(old))
+        with open(f"/tmp/{result}", newline="") as reader:
+            assert list(csv.reader(reader)) == [["design_id", "design_name", "change_type"]]
+        os.remove(f"/tmp/{result}")
+
+
+class ClosableConnection(FakeConnection):
+    def __init__(self):
+        super().__init__()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool:
+
+    @pytest.fixture
+    def opened(self, monkeypatch):
+        opened = []
+
+        def fake_connect_to_db(credentials):
+            opened.append(ClosableConnection())
+            return opened[-1]
+
+        monkeypatch.setattr("src.utils.extract_utils.connect_to_db", fake_connect_to_db)
+        return opened
+
+    @pytest.mark.it("opens the first connection straight away")
+    def test_opens_first_connection(self, opened):
+        ConnectionPool({}, 3)
+        assert len(opened) == 1
+
+    @pytest.mark.it("reuses idle connections instead of opening new ones")
+    def test_reuses_connections(self, opened):
+        pool = ConnectionPool({}, 3)
+        with pool.connection():
+            pass
+        with pool.connection():
+            pass
+        assert len(opened) == 1
+
+    @pytest.mark.it("never opens more connections than the pool size")
+    def test_bounded_size(self, opened):
+        pool = ConnectionPool({}, 2)
+
+        def borrow(_):
+            with pool.connection() as conn:
+                conn.run("SELECT 1;")
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(borrow, range(50)))
+        assert len(opened) <= 2
+        assert sum(len(conn.queries) for conn in opened) == 50
+
+    @pytest.mark.it("discards connections that raised a database error")
+    def test_discards_broken_connections(self, opened):
+        pool = ConnectionPool({}, 1)
+        with pytest.raises(Error):
+            with pool.connection():
+                raise Error("server closed the connection")
+        assert opened[0].closed
+        with pool.connection() as conn:
+            assert conn is opened[1]
+
+    @pytest.mark.it("close closes every idle connection")
+    def test_close(self, opened):
+        pool = ConnectionPool({}, 2)
+        pool.close()
+        assert all(conn.closed for conn in opened)
+
+
+class CursorConnection(ClosableConnection):  # Serves a table through DECLARE / FETCH
+    def __init__(self, rows):
+        super().__init__()
+        self.table_rows = rows
+        self.position = 0
+
+    def run(self, sql, **params):
+        self.queries.append((sql, params))
+        if "information_schema" in sql:
+            return [["id", "integer"], ["last_updated", "timestamp without time zone"]]
+        if sql.startswith("FETCH"):
+            batch_size = int(sql.split()[2])
+            batch = self.table_rows[self.position:self.position + batch_size]
+            self.position += batch_size
+            return batch
+        if sql.startswith("SELECT *"):
+            return self.table_rows
+        return []
+
+
+class CopyConnection(ClosableConnection):  # Answers COPY by writing csv bytes to the stream
+    def __init__(self, csv_bytes, max_last_updated):
+        super().__init__()
+        self.csv_bytes = csv_bytes
+        self.max_last_updated = max_last_updated
+        self.row_count = -1
+
+    def run(self, sql, stream=None, **params):
+        self.queries.append((sql, params))
+        if sql.startswith("COPY"):
+            stream.write(self.csv_bytes)
+            self.row_count = self.csv_bytes.count(b"\n") - 1
+            return None
+        return [[self.max_last_updated]]
+
+
+class SingleConnectionPool:
+    def __init__(self, conn):
+        self.conn = conn
+
+    @contextmanager
+    def connection(self):
+        yield self.conn
+
+
+class TestDiffTable:
+    original_key = "/source/design/design_original.csv"
+
+    @pytest.fixture
+    def original(self, s3):
+        s3.put_object(
+            Bucket="totesys-raw-data-000000", Key=self.original_key,
+            Body="id,last_updated\n1,2024-08-16 10:00:00\n2,2024-08-16 10:00:00\n3,2024-08-16 10:00:00\n",
+        )
+        return s3
+
+    def diff(self, s3, rows, time_prefix):
+        return diff_table(
+            SingleConnectionPool(CursorConnection(rows)), s3, "totesys-raw-data-000000", "design",
+            f"/history/design/differences_{time_prefix}.csv", self.original_key, primary_key="id",
+        )
+
+    def read(self, s3, key):
+        body = s3.get_object(Bucket="totesys-raw-data-000000", Key=key)["Body"].read().decode("utf-8")
+        return list(csv.reader(body.splitlines()))
+
+    @pytest.mark.it("uploads only the inserted, updated and deleted rows, read from the original")
+    def test_changes(self, original):
+        rows = [[1, dt(2024, 8, 16, 10, 0, 0)], [2, dt(2024, 8, 17, 9, 0, 0)], [4, dt(2024, 8, 17, 9, 30, 0)]]
+        result = self.diff(original, rows, "first")
+        assert result["changes"] == 3
+        assert result["max_last_updated"] == "2024-08-17T09:30:00"
+        assert self.read(original, "/history/design/differences_first.csv") == [
+            ["id", "last_updated", "change_type"],
+            ["2", "2024-08-17 09:00:00", "update"],
+            ["4", "2024-08-17 09:30:00", "insert"],
+            ["3", "2024-08-16 10:00:00", "delete"],
+        ]
+        keys = [obj["Key"] for obj in original.list_objects_v2(Bucket="totesys-raw-data-000000")["Contents"]]
+        assert "/state/snapshot_index/design.idx" in keys
+        assert not [key for key in keys if "_new" in key]
+
+    @pytest.mark.it("uploads nothing when nothing changed since the last diff")
+    def test_unchanged(self, original):
+        rows = [[1, dt(2024, 8, 16, 10, 0, 0)], [2, dt(2024, 8, 17, 9, 0, 0)]]
+        self.diff(original, rows, "first")
+        result = self.diff(original, rows, "second")
+        assert result["changes"] == 0
+        assert result["bytes"] == 0
+        assert "Contents" not in original.list_objects_v2(
+            Bucket="totesys-raw-data-000000", Prefix="/history/design/differences_second"
+        )
+
+    @pytest.mark.it("reads deleted rows from the differences csv they were last written to")
+    def test_delete_from_differences(self, original):
+        rows = [[1, dt(2024, 8, 16, 10, 0, 0)], [2, dt(2024, 8, 17, 9, 0, 0)], [3, dt(2024, 8, 16, 10, 0, 0)]]
+        self.diff(original, rows, "first")
+        self.diff(original, rows[:1], "second")
+        assert sorted(self.read(original, "/history/design/differences_second.csv")[1:]) == [
+            ["2", "2024-08-17 09:00:00", "delete"],
+            ["3", "2024-08-16 10:00:00", "delete"],
+        ]
+        index = get_snapshot_index(original, "totesys-raw-data-000000", "design")
+        assert index["files"] == [self.original_key]
+        assert index["keys"].tolist() == [1]
+        assert index["hashes"].tolist() == [hash_row(["1", "2024-08-16 10:00:00"])]
+
+    @pytest.mark.it("diffs new rows against the index of an empty table")
+    def test_empty_index(self, s3):
+        s3.put_object(Bucket="totesys-raw-data-000000", Key=self.original_key, Body="id,last_updated\n")
+        self.diff(s3, [], "first")
+        rows = [[1, dt(2024, 8, 17, 9, 0, 0)], [2, dt(2024, 8, 17, 9, 30, 0)]]
+        result = self.diff(s3, rows, "second")
+        assert result["changes"] == 2
+        assert self.read(s3, "/history/design/differences_second.csv")[1:] == [
+            ["1", "2024-08-17 09:00:00", "insert"],
+            ["2", "2024-08-17 09:30:00", "insert"],
+        ]
+        result = self.diff(s3, rows[:1], "third")
+        assert self.read(s3, "/history/design/differences_third.csv")[1:] == [["2", "2024-08-17 09:30:00", "delete"]]
+
+
+    typed_columns = [("id", "integer"), ("last_updated", "timestamp without time zone"), ("flag", "boolean"), ("price", "numeric")]
+    typed_rows = [[1, dt(2024, 8, 16, 10, 0, 0, 500000), True, Decimal("3.50")], [2, dt(2024, 8, 16, 10, 0, 0), False, None]]
+
+    def typed_diff(self, s3, time_prefix):
+        return diff_table(
+            SingleConnectionPool(CursorConnection(self.typed_rows)), s3, "totesys-raw-data-000000", "design",
+            f"/history/design/differences_{time_prefix}.csv", self.original_key, self.typed_columns, primary_key="id",
+        )
+
+    @pytest.mark.it("rows are hashed the same whichever engine wrote the original")
+    def test_copy_engine_original(self, s3):
+        s3.put_object(
+            Bucket="totesys-raw-data-000000", Key=self.original_key,
+            Body="id,last_updated,flag,price\n1,2024-08-16 10:00:00.5,t,3.5\n2,2024-08-16 10:00:00,f,\n",
+        )
+        assert self.typed_diff(s3, "first")["changes"] == 0
+
+    @pytest.mark.it("indexes hashed before canonical text are hashed again rather than reporting updates")
+    def test_legacy_index(self, s3):
+        s3.put_object(
+            Bucket="totesys-raw-data-000000", Key=self.original_key,
+            Body="id,last_updated,flag,price\n1,2024-08-16 10:00:00.500000,True,3.50\n2,2024-08-16 10:00:00,False,\n",
+        )
+        rows = [["1", "2024-08-16 10:00:00.500000", "True", "3.50"], ["2", "2024-08-16 10:00:00", "False", ""]]
+        legacy = build_index(
+            [self.original_key], np.array([1, 2]), np.array([hash_row(row) for row in rows], dtype=np.uint64),
+            np.zeros(2, dtype=np.uint32),
+        )
+        s3.put_object(
+            Bucket="totesys-raw-data-000000", Key="/state/snapshot_index/design.idx",
+            Body=legacy_index_magic + encode_index(legacy)[4:],
+        )
+
+        assert self.typed_diff(s3, "first")["changes"] == 0
+        index = get_snapshot_index(s3, "totesys-raw-data-000000", "design")
+        assert index["canonical"]
+        assert self.typed_diff(s3, "second")["changes"] == 0
+
+
+class TestStreamTable:
+
+    @pytest.mark.it("yields the table in batches inside a transaction")
+    def test_batches(self):
+        conn = CursorConnection([[i, dt(2024, 8, 16)] for i in range(5)])
+        batches = list(stream_table(conn, "sales_order", batch_size=2))
+        assert [len(batch) for batch in batches] == [2, 2, 1]
+        statements = [sql.split()[0] for sql, _ in conn.queries]
+        assert statements == ["START", "DECLARE", "FETCH", "FETCH", "FETCH", "FETCH", "CLOSE", "COMMIT;"]
+
+    @pytest.mark.it("declares the cursor with the watermark filter")
+    def test_watermark(self):
+        conn = CursorConnection([])
+        list(stream_table(conn, "sales_order", "2024-08-16T10:00:00"))
+        sql, params = conn.queries[1]
+        assert "WHERE last_updated > :watermark" in sql
+        assert params == {"watermark": "2024-08-16T10:00:00"}
+
+
+class TestExtractionEngines:
+
+    @pytest.mark.it("the cursor engine uploads the same csv as the python engine")
+    def test_engines_match(self, s3):
+        rows = [[i, dt(2024, 8, 16, 10, i)] for i in range(7)]
+        python_result = python_engine(
+            SingleConnectionPool(CursorConnection(rows)), s3, "totesys-raw-data-000000", "sales_order", "python.csv"
+        )
+        cursor_result = cursor_engine(
+            SingleConnectionPool(CursorConnection(rows)), s3, "totesys-raw-data-000000", "sales_order", "cursor.csv", batch_size=3
+        )
+        python_csv = s3.get_object(Bucket="totesys-raw-data-000000", Key="python.csv")["Body"].read()
+        cursor_csv = s3.get_object(Bucket="totesys-raw-data-000000", Key="cursor.csv")["Body"].read()
+        assert cursor_csv == python_csv
+        assert cursor_result == python_result == {
+            "rows": 7, "bytes": len(python_csv), "max_last_updated": "2024-08-16T10:06:00", "watermark_keys": [],
+        }
+
+    @pytest.mark.it("incremental extracts with no new rows upload nothing")
+    def test_no_new_rows(self, s3):
+        cursor_engine(
+            SingleConnectionPool(CursorConnection([])), s3, "totesys-raw-data-000000", "sales_order", "c.csv", "2024-08-16"
+        )
+        assert "Contents" not in s3.list_objects_v2(Bucket="totesys-raw-data-000000", Prefix="c.csv")
+
+    @pytest.mark.it("the copy engine streams the csv produced by postgres to the bucket")
+    def test_copy_engine(self, s3):
+        csv_bytes = b"id,last_updated\n1,2024-08-16 10:00:00\n2,2024-08-16 10:05:00.5\n"
+        conn = CopyConnection(csv_bytes, dt(2024, 8, 16, 10, 5, 0, 500000))
+        result = copy_engine(SingleConnectionPool(conn), s3, "totesys-raw-data-000000", "sales_order", "copy.csv")
+        assert s3.get_object(Bucket="totesys-raw-data-000000", Key="copy.csv")["Body"].read() == csv_bytes
+        assert result == {
+            "rows": 2, "bytes": len(csv_bytes), "max_last_updated": "2024-08-16T10:05:00.500000", "watermark_keys": [],
+        }
+        assert "last_updated <= '2024-08-16T10:05:00.500000'" in conn.queries[1][0]
+
+    @pytest.mark.it("the copy engine skips the copy when there are no new rows")
+    def test_copy_engine_no_new_rows(self, s3):
+        conn = CopyConnection(b"", None)
+        result = copy_engine(SingleConnectionPool(conn), s3, "totesys-raw-data-000000", "sales_order", "c.csv", "2024-08-16")
+        assert result == {"rows": 0, "bytes": 0, "max_last_updated": None, "watermark_keys": []}
+        assert len(conn.queries) == 1
+
+    @pytest.mark.it("the engines return the keys of every row at the new watermark")
+    def test_watermark_keys(self, s3):
+        rows = [[1, dt(2024, 8, 16, 10, 5)], [2, dt(2024, 8, 16, 10, 0)], [3, dt(2024, 8, 16, 10, 5)], [4, dt(2024, 8, 16, 9, 0)]]
+        result = cursor_engine(
+            SingleConnectionPool(CursorConnection(rows)), s3, "totesys-raw-data-000000", "sales_order", "c.csv",
+            primary_key="id", batch_size=2,
+        )
+        assert result["watermark_keys"] == [1, 3]
+        result = python_engine(
+            SingleConnectionPool(CursorConnection(rows)), s3, "totesys-raw-data-000000", "sales_order", "p.csv", primary_key="id"
+        )
+        assert result["watermark_keys"] == [1, 3]
+
+        conn = CopyConnection(b"id,last_updated\n", dt(2024, 8, 16, 10, 5))
+        copy_engine(
+            SingleConnectionPool(conn), s3, "totesys-raw-data-000000", "sales_order", "copy.csv", "2024-08-16T10:00:00",
+            primary_key="id", seen_keys=[2],
+        )
+        assert conn.queries[1] == (
+            'SELECT "id" FROM "sales_order" WHERE last_updated = :upper_bound;', {"upper_bound": dt(2024, 8, 16, 10, 5)}
+        )
+        assert "last_updated >= '2024-08-16T10:00:00' AND NOT (last_updated = '2024-08-16T10:00:00' AND \"id\" IN (2))" in (
+            conn.queries[2][0]
+        )
+
+
+class TestBuildCopyQuery:
+
+    @pytest.mark.it("copies the whole table as csv with a header")
+    def test_full_table(self):
+        assert build_copy_query("sales_order") == 'COPY (SELECT * FROM "sales_order") TO STDOUT WITH (FORMAT csv, HEADER)'
+
+    @pytest.mark.it("escapes the watermark bounds")
+    def test_bounds(self):
+        query = build_copy_query("sales_order", "2024-08-16'; DROP TABLE staff; --", "2024-08-17")
+        assert "last_updated > '2024-08-16''; DROP TABLE staff; --'" in query
+        assert "last_updated <= '2024-08-17'" in query
+
+
+class TypedCursorConnection(CursorConnection):  # Also describes its column types
+    def run(self, sql, **params):
+        if "data_type" in sql:
+            self.queries.append((sql, params))
+            return [["id", "integer"], ["unit_price", "numeric"], ["paid", "boolean"], ["last_updated", "timestamp without time zone"]]
+        return super().run(sql, **params)
+
+
+class TestParquetEngine:
+
+    @pytest.mark.it("writes typed parquet to the bucket")
+    def test_typed_parquet(self, s3):
+        rows = [
+            [1, Decimal("2.50"), True, dt(2024, 8, 16, 10, 0)],
+            [2, Decimal("3.75"), False, dt(2024, 8, 16, 10, 5)],
+            [3, Decimal("2.00"), True, dt(2024, 8, 16, 9, 0)],
+        ]
+        result = parquet_engine(
+            SingleConnectionPool(TypedCursorConnection(rows)), s3, "totesys-raw-data-000000", "payment", "p.parquet", batch_size=2
+        )
+        body = s3.get_object(Bucket="totesys-raw-data-000000", Key="p.parquet")["Body"].read()
+        df = pl.read_parquet(BytesIO(body))
+        assert df.schema == {
+            "id": pl.Int32,
+            "unit_price": pl.Decimal(38, 10),
+            "paid": pl.Boolean,
+            "last_updated": pl.Datetime("us"),
+        }
+        assert df["unit_price"].to_list() == [Decimal("2.5"), Decimal("3.75"), Decimal("2")]
+        assert result == {"rows": 3, "bytes": len(body), "max_last_updated": "2024-08-16T10:05:00", "watermark_keys": []}
+
+    @pytest.mark.it("unknown postgres types are kept as strings")
+    def test_unknown_type(self):
+        assert str(arrow_type("character varying")) == "string"
+
+
+class TestWarmContainerResources:
+
+    @pytest.fixture(autouse=True)
+    def empty_cache(self):
+        clear_cache()
+        yield
+        clear_cache()
+
+    @pytest.mark.it("the secret is only fetched once per container")
+    def test_cached_secret(self, secretsmanager):
+        assert get_cached_secret()["user"] == PG_USER
+        secretsmanager.update_secret(SecretId="totesys_database_credentials", SecretString=json.dumps({"user": "new"}))
+        assert get_cached_secret()["user"] == PG_USER
+
+    @pytest.mark.it("the connection pool survives between invocations")
+    def test_pool_reused(self, monkeypatch):
+        monkeypatch.setattr("src.utils.extract_utils.get_cached_secret", lambda secret_name: {})
+        monkeypatch.setattr("src.utils.extract_utils.connect_to_db", lambda credentials: ClosableConnection())
+        assert get_connection_pool(2) is get_connection_pool(2)
+
+    @pytest.mark.it("the secret is refreshed when the database rejects the credentials")
+    def test_refresh_on_auth_failure(self, secretsmanager, monkeypatch):
+        get_cached_secret()
+        secretsmanager.update_secret(SecretId="totesys_database_credentials", SecretString=json.dumps({"user": "rotated"}))
+
+        def fake_connect_to_db(credentials):
+            if credentials["user"] != "rotated":
+                raise Error({"C": "28P01", "M": "password authentication failed"})
+            return ClosableConnection()
+
+        monkeypatch.setattr("src.utils.extract_utils.connect_to_db", fake_connect_to_db)
+        pool = get_connection_pool(1)
+        assert pool.credentials == {"user": "rotated"}
+
+    @pytest.mark.it("connections idle for a while are checked and replaced if dead")
+    def test_liveness_check(self, monkeypatch):
+        class DeadConnection(ClosableConnection):
+            def run(self, sql, **params):
+                raise Error("server closed the connection unexpectedly")
+
+        opened = [DeadConnection(), ClosableConnection()]
+        monkeypatch.setattr("src.utils.extract_utils.connect_to_db", lambda credentials: opened.pop(0))
+        pool = ConnectionPool({}, 1)
+        monkeypatch.setattr("src.utils.extract_utils.liveness_check_after", -1)
+        with pool.connection() as conn:
+            assert not isinstance(conn, DeadConnection)
@@ -0,0 +1,72 @@
+import pytest
+import polars as pl
+from datetime import datetime, timedelta
+from src.utils.freshness_utils import freshness_report, source_last_updated, record_freshness
+
+
+class FreshnessConnection:  # Records the statements run
+    def __init__(self):
+        self.queries = []
+
+    def run(self, sql, **params):
+        self.queries.append((sql, params))
+        return []
+
+
+prefix = "2024_08_16_10:00:00"
+loaded_at = datetime(2024, 8, 16, 10, 5)
+
+
+class TestSourceLastUpdated:
+
+    @pytest.mark.it("takes the latest change of a warehouse table's sources")
+    def test_latest_source(self):
+        latest_updates = {"staff": "2024-08-16T09:50:00", "department": "2024-08-16T09:55:00", "currency": "2024-08-16T09:59:00"}
+        assert source_last_updated("dim_staff", latest_updates) == datetime(2024, 8, 16, 9, 55)
+
+    @pytest.mark.it("is None when no source changed")
+    def test_no_source(self):
+        assert source_last_updated("dim_staff", {"currency": "2024-08-16T09:59:00"}) is None
+
+
+class TestFreshnessReport:
+
+    @pytest.mark.it("splits the lag into the time spent before extract, in transform and in load")
+    def test_stage_lags(self):
+        df = pl.DataFrame({"currency_id": [1]})
+        report = freshness_report(
+            "dim_currency", df, prefix, datetime(2024, 8, 16, 9, 50), datetime(2024, 8, 16, 10, 2), loaded_at
+        )
+        assert report["extract_lag_seconds"] == 600
+        assert report["transform_lag_seconds"] == 120
+        assert report["load_lag_seconds"] == 180
+        assert report["lag_p50_seconds"] == report["lag_max_seconds"] == 900
+
+    @pytest.mark.it("takes lag percentiles over the rows' own last_updated")
+    def test_row_percentiles(self):
+        df = pl.DataFrame({"valid_from": [loaded_at - timedelta(seconds=lag) for lag in range(1, 101)]})
+        report = freshness_report("fact_sales_order", df, prefix, datetime(2024, 8, 16, 9, 59), loaded_at=loaded_at)
+        assert report["rows"] == 100
+        assert report["lag_p50_seconds"] == pytest.approx(50.5)
+        assert report["lag_p99_seconds"] == pytest.approx(99.01)
+        assert report["lag_max_seconds"] == 100
+
+    @pytest.mark.it("is None when nothing tells when the source changed")
+    def test_unknown(self):
+        assert freshness_report("dim_date", pl.DataFrame({"date_id": [1]}), prefix, None, loaded_at=loaded_at) is None
+
+
+class TestRecordFreshness:
+
+    @pytest.mark.it("creates the freshness table and inserts the report")
+    def test_record(self, monkeypatch, capsys):
+        monkeypatch.setenv("METRICS_SINK", "emf")
+        report = freshness_report(
+            "dim_currency", pl.DataFrame({"currency_id": [1]}), prefix, datetime(2024, 8, 16, 9, 50), loaded_at=loaded_at
+        )
+        conn = FreshnessConnection()
+        record_freshness(conn, report)
+
+        assert conn.queries[0][0].startswith('CREATE TABLE IF NOT EXISTS "pipeline_freshness"')
+        assert conn.queries[1][1] == report
+        assert '"LagMax": 900.0' in capsys.readouterr().out
@@ -0,0 +1,142 @@
+import pytest
+import boto3
+import json
+import os
+import polars as pl
+from io import BytesIO
+from moto import mock_aws
+from unittest.mock import patch
+from src.lambda_functions.load import lambda_handler as load
+from src.utils.cache_utils import clear_cache
+from src.utils.transform_utils import processed_key
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    """Stops resources cached by one test's invocation leaking into the next."""
+    clear_cache()
+    yield
+    clear_cache()
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for S3 bucket."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    """Mocked S3 client with both data buckets and the warehouse secret."""
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket="totesys-raw-data-000000",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        s3.create_bucket(
+            Bucket="totesys-processed-data-000000",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        boto3.client("secretsmanager", region_name="eu-west-2").create_secret(
+            Name="totesys_warehouse_credentials",
+            SecretString=json.dumps(
+                {"user": "u", "password": "p", "host": "h", "database": "d", "port": 5432}
+            ),
+        )
+        yield s3
+
+
+class WarehouseConnection:  # Records which tables were copied into
+    def __init__(self):
+        self.copied_tables = []
+        self.queries = []
+        self.closed = False
+
+    def run(self, sql, stream=None, **params):
+        self.queries.append((sql, params))
+        if sql.startswith("COPY"):
+            self.copied_tables.append(sql.split()[1].strip('"'))
+        return []
+
+    def close(self):
+        self.closed = True
+
+
+class DummyContext:  # Dummy context class used for testing
+    pass
+
+
+event = {"time_prefix": "2024_08_16_10:00:00"}
+context = DummyContext()
+
+
+def put_parquet(s3, table_name, df):
+    buffer = BytesIO()
+    df.write_parquet(buffer)
+    s3.put_object(
+        Body=buffer.getvalue(),
+        Bucket="totesys-processed-data-000000",
+        Key=processed_key(table_name, "2024_08_16_10:00:00"),
+    )
+
+
+class TestLoad:
+
+    @pytest.mark.it("loads dimensions before facts and reports rows per table")
+    def test_loads_tables_in_order(self, s3):
+        put_parquet(s3, "fact_sales_order", pl.DataFrame({"sales_order_id": [1, 2, 3]}))
+        put_parquet(s3, "dim_currency", pl.DataFrame({"currency_id": [1], "currency_code": ["GBP"]}))
+        conn = WarehouseConnection()
+
+        with patch("src.lambda_functions.load.connect_to_db", return_value=conn):
+            res = load(event, context)
+
+        assert conn.copied_tables == ["staging_dim_currency", "fact_sales_order"]
+        assert conn.closed
+        assert res["time_prefix"] == "2024_08_16_10:00:00"
+        assert res["loaded"]["fact_sales_order"]["rows"] == 3
+        assert res["loaded"]["dim_currency"]["rows"] == 1
+        assert "dim_staff" not in res["loaded"]
+
+    @pytest.mark.it("connection is closed when a table fails to load")
+    def test_closes_connection_on_failure(self, s3):
+        put_parquet(s3, "dim_design", pl.DataFrame({"design_id": [1]}))
+        conn = WarehouseConnection()
+
+        with patch("src.lambda_functions.load.connect_to_db", return_value=conn), \
+                patch("src.lambda_functions.load.load_table", side_effect=Exception("Failed to load dim_design")):
+            with pytest.raises(Exception, match="Failed to load dim_design"):
+                load(event, context)
+
+        assert conn.closed
+
+    @pytest.mark.it("only the table named in the event is loaded")
+    def test_loads_one_table(self, s3):
+        put_parquet(s3, "fact_sales_order", pl.DataFrame({"sales_order_id": [1, 2, 3]}))
+        put_parquet(s3, "dim_currency", pl.DataFrame({"currency_id": [1], "currency_code": ["GBP"]}))
+        conn = WarehouseConnection()
+
+        with patch("src.lambda_functions.load.connect_to_db", return_value=conn):
+            res = load({**event, "stage": "load", "table_name": "dim_currency"}, context)
+
+        assert conn.copied_tables == ["staging_dim_currency"]
+        assert list(res["loaded"]) == ["dim_currency"]
+
+    @pytest.mark.it("records how far behind its source each loaded table is")
+    def test_records_freshness(self, s3):
+        put_parquet(s3, "dim_currency", pl.DataFrame({"currency_id": [1], "currency_code": ["GBP"]}))
+        conn = WarehouseConnection()
+
+        with patch("src.lambda_functions.load.connect_to_db", return_value=conn):
+            res = load({**event, "source_last_updated": {"currency": "2024-08-16T09:55:00"}}, context)
+
+        inserts = [params for sql, params in conn.queries if sql.startswith('INSERT INTO "pipeline_freshness"')]
+        assert len(inserts) == 1
+        assert inserts[0]["table_name"] == "dim_currency"
+        assert inserts[0]["extract_lag_seconds"] == 300
+        assert res["loaded"]["dim_currency"]["lag_max_seconds"] == inserts[0]["lag_max_seconds"]
@@ -0,0 +1,286 @@
+import pytest
+import boto3
+import os
+import polars as pl
+from io import BytesIO
+from datetime import date, datetime
+from moto import mock_aws
+from pg8000.native import Connection, Error, InterfaceError
+from dotenv import load_dotenv, find_dotenv
+from src.utils.load_utils import (
+    read_processed_parquet,
+    prefetch_processed_files,
+    copy_into,
+    build_upsert_query,
+    upsert_dimension,
+    append_fact,
+    load_table,
+)
+
+env_file = find_dotenv(f'.env.{os.getenv("ENV")}')
+load_dotenv(env_file)
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for S3 bucket."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    """Mocked S3 client with processed data bucket."""
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket="totesys-processed-data-000000",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield s3
+
+
+@pytest.fixture(scope="function")
+def warehouse():
+    """
+    Connection to a local Postgres, for example a docker container started with
+    docker run -e POSTGRES_PASSWORD=... -p 5432:5432 postgres
+    The tests only use temporary tables, so any database will do.
+    """
+    try:
+        conn = Connection(
+            user=os.getenv("PG_USER"),
+            password=os.getenv("PG_PASSWORD"),
+            host=os.getenv("PG_HOST") or "localhost",
+            database=os.getenv("PG_DATABASE"),
+            port=int(os.getenv("PG_PORT") or 5432),
+        )
+    except (Error, InterfaceError, OSError):
+        pytest.skip("no local Postgres to load into")
+    yield conn
+    conn.close()
+
+
+class CopyRecordingConnection:  # Records queries and the csv sent to COPY FROM STDIN
+    def __init__(self, fail_on=None):
+        self.queries = []
+        self.copied = []
+        self.fail_on = fail_on
+
+    def run(self, sql, stream=None, **params):
+        self.queries.append(sql)
+        if self.fail_on and sql.startswith(self.fail_on):
+            raise Error({"M": "boom"})
+        if stream is not None:
+            self.copied.append(stream.read())
+        return []
+
+
+dim_currency = pl.DataFrame(
+    {"currency_id": [1, 2], "currency_code": ["GBP", "USD"], "currency_name": ["Pound", None]}
+)
+
+
+class TestReadProcessedParquet:
+
+    @pytest.mark.it("reads a parquet file into a data frame")
+    def test_reads_parquet(self, s3):
+        buffer = BytesIO()
+        dim_currency.write_parquet(buffer)
+        s3.put_object(Body=buffer.getvalue(), Bucket="totesys-processed-data-000000", Key="dim_currency.parquet")
+
+        df = read_processed_parquet(s3, "totesys-processed-data-000000", "dim_currency.parquet")
+
+        assert df.equals(dim_currency)
+
+    @pytest.mark.it("returns None when the file doesn't exist")
+    def test_missing_file(self, s3):
+        assert read_processed_parquet(s3, "totesys-processed-data-000000", "dim_staff.parquet") is None
+
+    @pytest.mark.it("files are read in order, only a few ahead of the one being loaded")
+    def test_bounded_prefetch(self, monkeypatch):
+        read = []
+        monkeypatch.setattr(
+            "src.utils.load_utils.read_processed_file", lambda client, bucket, key: read.append(key) or (key, None)
+        )
+        keys = [f"table_{i}.parquet" for i in range(6)]
+
+        files = prefetch_processed_files(None, "totesys-processed-data-000000", keys, prefetch=2)
+        first = next(files)
+        assert first == ("table_0.parquet", ("table_0.parquet", None))
+        assert set(read) <= set(keys[:3])
+        assert [key for key, _ in files] == keys[1:]
+
+
+class TestCopyInto:
+
+    @pytest.mark.it("sends the rows as csv in batches")
+    def test_copies_in_batches(self):
+        conn = CopyRecordingConnection()
+        copy_into(conn, "dim_currency", dim_currency, batch_size=1)
+
+        assert conn.queries == [
+            'COPY "dim_currency" ("currency_id", "currency_code", "currency_name") FROM STDIN WITH (FORMAT csv)'
+        ] * 2
+        assert conn.copied == [b"1,GBP,Pound\n", b"2,USD,\n"]
+
+    @pytest.mark.it("empty strings are quoted so COPY doesn't read them as null")
+    def test_empty_strings_are_quoted(self):
+        conn = CopyRecordingConnection()
+        copy_into(conn, "dim_currency", pl.DataFrame({"currency_code": [""]}))
+
+        assert conn.copied == [b'""\n']
+
+    @pytest.mark.it("nothing is sent for an empty data frame")
+    def test_empty_data_frame(self):
+        conn = CopyRecordingConnection()
+        copy_into(conn, "dim_currency", dim_currency.clear())
+
+        assert conn.queries == []
+
+
+class TestUpsert:
+
+    @pytest.mark.it("upsert query keeps the last staged row per key and updates the other columns")
+    def test_build_upsert_query(self):
+        sql = build_upsert_query("dim_currency", "staging_dim_currency", dim_currency.columns, "currency_id")
+
+        assert 'SELECT DISTINCT ON ("currency_id")' in sql
+        assert 'ORDER BY "currency_id", "staged_row" DESC' in sql
+        assert sql.endswith(
+            'ON CONFLICT ("currency_id") DO UPDATE SET "currency_code" = EXCLUDED."currency_code", '
+            '"currency_name" = EXCLUDED."currency_name"'
+        )
+
+    @pytest.mark.it("dimensions go through a staging table in one transaction")
+    def test_upsert_dimension(self):
+        conn = CopyRecordingConnection()
+        upsert_dimension(conn, "dim_currency", dim_currency, "currency_id")
+
+        assert conn.queries[0] == "START TRANSACTION"
+        assert conn.queries[1].startswith('CREATE TEMPORARY TABLE "staging_dim_currency" (LIKE "dim_currency"')
+        assert conn.queries[1].endswith('"staged_row" bigint) ON COMMIT DROP')
+        assert conn.queries[2].startswith('COPY "staging_dim_currency" ("staged_row", "currency_id"')
+        assert conn.copied[0] == b"0,1,GBP,Pound\n1,2,USD,\n"
+        assert conn.queries[3].startswith('INSERT INTO "dim_currency"')
+        assert conn.queries[4] == "COMMIT"
+
+    @pytest.mark.it("a failed upsert is rolled back")
+    def test_upsert_dimension_rolls_back(self):
+        conn = CopyRecordingConnection(fail_on="INSERT")
+        with pytest.raises(Error):
+            upsert_dimension(conn, "dim_currency", dim_currency, "currency_id")
+
+        assert conn.queries[-1] == "ROLLBACK"
+
+
+class TestLoadTable:
+
+    @pytest.mark.it("facts are appended straight into the table")
+    def test_append_fact(self):
+        conn = CopyRecordingConnection()
+        append_fact(conn, "fact_sales_order", pl.DataFrame({"sales_order_id": [1, 2]}))
+
+        assert conn.queries == [
+            "START TRANSACTION",
+            'COPY "fact_sales_order" ("sales_order_id") FROM STDIN WITH (FORMAT csv)',
+            "COMMIT",
+        ]
+
+    @pytest.mark.it("versions left open by previous loads are closed before the new ones are inserted")
+    def test_append_fact_closes_versions(self):
+        conn = CopyRecordingConnection()
+        versions = pl.DataFrame({"sales_order_id": [1], "valid_from": [datetime(2024, 8, 17)], "valid_to": [None]})
+        append_fact(conn, "fact_sales_order", versions, history_key="sales_order_id")
+
+        assert conn.queries[1].startswith('CREATE TEMPORARY TABLE "staging_fact_sales_order" ON COMMIT DROP AS SELECT')
+        assert conn.queries[2].startswith('COPY "staging_fact_sales_order" ("staged_row", "sales_order_id"')
+        assert conn.queries[3] == (
+            'UPDATE "fact_sales_order" SET valid_to = staged.valid_from FROM (SELECT "sales_order_id", '
+            'min(valid_from) AS valid_from FROM "staging_fact_sales_order" GROUP BY "sales_order_id") AS staged '
+            'WHERE "fact_sales_order"."sales_order_id" = staged."sales_order_id" AND "fact_sales_order".valid_to IS NULL'
+        )
+        assert conn.queries[4].startswith('INSERT INTO "fact_sales_order"')
+        assert conn.queries[5] == "COMMIT"
+
+    @pytest.mark.it("reports the rows loaded and rows per second")
+    def test_load_table_report(self):
+        result = load_table(CopyRecordingConnection(), "dim_currency", dim_currency)
+
+        assert result["rows"] == 2
+        assert result["seconds"] >= 0
+        assert "rows_per_sec" in result
+
+    @pytest.mark.it("raises an exception when the warehouse rejects the load")
+    def test_load_table_fails(self):
+        with pytest.raises(Exception, match="Failed to load fact_sales_order"):
+            load_table(CopyRecordingConnection(fail_on="COPY"), "fact_sales_order", pl.DataFrame({"a": [1]}))
+
+
+class TestLocalWarehouse:
+
+    @pytest.mark.it("upserting a dimension updates existing rows and adds new ones")
+    def test_upsert_against_postgres(self, warehouse):
+        warehouse.run(
+            "CREATE TEMPORARY TABLE dim_currency "
+            "(currency_id int PRIMARY KEY, currency_code varchar NOT NULL, currency_name varchar)"
+        )
+        warehouse.run("INSERT INTO dim_currency VALUES (1, 'GBP', 'Old name')")
+
+        changes = pl.DataFrame(
+            {"currency_id": [1, 2, 2], "currency_code": ["GBP", "USD", "USD"], "currency_name": ["Pound", "", None]}
+        )
+        load_table(warehouse, "dim_currency", changes, batch_size=2)
+
+        assert warehouse.run("SELECT * FROM dim_currency ORDER BY currency_id") == [
+            [1, "GBP", "Pound"],
+            [2, "USD", None],
+        ]
+
+    @pytest.mark.it("appending a fact keeps every version of a row")
+    def test_append_against_postgres(self, warehouse):
+        warehouse.run(
+            "CREATE TEMPORARY TABLE fact_sales_order "
+            "(sales_record_id SERIAL PRIMARY KEY, sales_order_id int, units_sold int, created_date date)"
+        )
+        versions = pl.DataFrame(
+            {"sales_order_id": [1, 1], "units_sold": [10, 12], "created_date": [date(2024, 8, 16)] * 2}
+        )
+        load_table(warehouse, "fact_sales_order", versions)
+        load_table(warehouse, "fact_sales_order", versions.tail(1))
+
+        assert warehouse.run("SELECT sales_order_id, units_sold FROM fact_sales_order ORDER BY sales_record_id") == [
+            [1, 10],
+            [1, 12],
+            [1, 12],
+        ]
+
+    @pytest.mark.it("a second load closes the version the first one left open")
+    def test_versions_against_postgres(self, warehouse):
+        warehouse.run(
+            "CREATE TEMPORARY TABLE fact_sales_order (sales_record_id SERIAL PRIMARY KEY, sales_order_id int, "
+            "units_sold int, version int, valid_from timestamp, valid_to timestamp)"
+        )
+        first = pl.DataFrame({
+            "sales_order_id": [1, 1, 2], "units_sold": [10, 11, 20], "version": [1, 2, 1],
+            "valid_from": [datetime(2024, 8, 16, 10), datetime(2024, 8, 16, 11), datetime(2024, 8, 16, 10)],
+            "valid_to": [datetime(2024, 8, 16, 11), None, None],
+        })
+        second = pl.DataFrame({
+            "sales_order_id": [1], "units_sold": [12], "version": [3],
+            "valid_from": [datetime(2024, 8, 17, 9)], "valid_to": [None],
+        }, schema=first.schema)
+        load_table(warehouse, "fact_sales_order", first)
+        load_table(warehouse, "fact_sales_order", second)
+
+        assert warehouse.run(
+            "SELECT sales_order_id, version, valid_to FROM fact_sales_order ORDER BY sales_record_id"
+        ) == [
+            [1, 1, datetime(2024, 8, 16, 11)],
+            [1, 2, datetime(2024, 8, 17, 9)],
+            [2, 1, None],
+            [1, 3, None],
+        ]
@@ -0,0 +1,90 @@
+import pytest
+import json
+from src.utils.metrics_utils import measure, measured, reset_metrics, metrics_summary, emf_line
+
+
+@pytest.fixture(autouse=True)
+def reset():
+    reset_metrics()
+
+
+class TestMeasure:
+
+    @pytest.mark.it("records the rows, bytes, seconds and peak memory of a stage")
+    def test_measure(self, monkeypatch):
+        monkeypatch.setenv("METRICS_SINK", "local")
+        with measure("extract", "sales_order") as record:
+            record["rows"] = 10
+            record["bytes_out"] = 100
+
+        summary = metrics_summary()
+        assert summary["stages"]["extract"] == {
+            "tables": 1, "failed": 0, "seconds": record["seconds"], "rows": 10, "bytes_in": 0, "bytes_out": 100
+        }
+        assert record["peak_rss_mb"] > 0
+        assert summary["peak_rss_mb"] >= record["peak_rss_mb"]
+
+    @pytest.mark.it("records a stage that raised as failed")
+    def test_failed(self, monkeypatch):
+        monkeypatch.setenv("METRICS_SINK", "local")
+        with pytest.raises(ValueError):
+            with measure("load", "dim_date"):
+                raise ValueError("boom")
+        assert metrics_summary()["stages"]["load"]["failed"] == 1
+
+    @pytest.mark.it("the decorator takes the table name argument and copies counts from the result")
+    def test_measured(self, monkeypatch):
+        monkeypatch.setenv("METRICS_SINK", "local")
+
+        @measured("transform")
+        def transform(prefix, table_name):
+            return {"rows": 3, "bytes_in": 50, "parquet_bytes": 20}
+
+        transform("2024_08_16_10:00:00", table_name="sales_order")
+        transform("2024_08_16_10:00:00", "design")
+        assert metrics_summary()["stages"]["transform"] == {
+            "tables": 2, "failed": 0, "seconds": pytest.approx(0, abs=0.1), "rows": 6, "bytes_in": 100, "bytes_out": 40
+        }
+
+    @pytest.mark.it("reset_metrics starts a new summary")
+    def test_reset(self, monkeypatch):
+        monkeypatch.setenv("METRICS_SINK", "local")
+        with measure("extract", "sales_order"):
+            pass
+        reset_metrics()
+        assert metrics_summary()["stages"] == {}
+
+
+class TestEmf:
+
+    @pytest.mark.it("prints every record as an embedded metric format line")
+    def test_emf_output(self, monkeypatch, capsys):
+        monkeypatch.setenv("METRICS_SINK", "emf")
+        with measure("extract", "sales_order") as record:
+            record["rows"] = 10
+
+        line = json.loads(capsys.readouterr().out)
+        metrics = line["_aws"]["CloudWatchMetrics"][0]
+        assert metrics["Namespace"] == "Totesys/Pipeline"
+        assert metrics["Dimensions"] == [["Stage"], ["Stage", "Table"]]
+        assert {metric["Name"] for metric in metrics["Metrics"]} <= set(line)
+        assert line["Stage"] == "extract"
+        assert line["Table"] == "sales_order"
+        assert line["Rows"] == 10
+
+    @pytest.mark.it("the local sink prints nothing")
+    def test_local_sink(self, monkeypatch, capsys):
+        monkeypatch.setenv("METRICS_SINK", "local")
+        with measure("extract", "sales_order"):
+            pass
+        assert capsys.readouterr().out == ""
+
+    @pytest.mark.it("stages without a table are only dimensioned by stage")
+    def test_no_table(self):
+        record = {
+            "stage": "plan", "table_name": None, "rows": 0, "bytes_in": 0, "bytes_out": 0,
+            "failed": False, "seconds": 0.1, "peak_rss_mb": 100,
+        }
+        line = emf_line(record)
+        assert line["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [["Stage"]]
+        assert "Table" not in line
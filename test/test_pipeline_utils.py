@@ -0,0 +1,104 @@
+import pytest
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src.utils.pipeline_utils import pipeline_nodes, pipeline_waves, run_pipeline
+
+
+def record_node(stage, table_name):  # Module level so a process pool can pickle it
+    return f"{stage}:{table_name}"
+
+
+class TestPipelineNodes:
+
+    @pytest.mark.it("only tables built from a changed raw table are run")
+    def test_unchanged_tables_are_left_out(self):
+        nodes = pipeline_nodes(["currency"])
+        assert sorted(nodes) == ["load:dim_currency", "star:dim_currency", "transform:currency"]
+
+    @pytest.mark.it("a warehouse table waits for every changed raw table it's built from")
+    def test_star_needs_its_sources(self):
+        nodes = pipeline_nodes(["staff", "department", "address"])
+        assert sorted(nodes["star:dim_staff"]["needs"]) == ["transform:department", "transform:staff"]
+        assert nodes["star:dim_location"]["needs"] == ["transform:address"]
+
+    @pytest.mark.it("a fact is loaded after the dimensions it references that are loaded in the same run")
+    def test_facts_need_dimensions(self):
+        nodes = pipeline_nodes(["sales_order", "currency"])
+        assert sorted(nodes["load:fact_sales_order"]["needs"]) == [
+            "load:dim_currency", "load:dim_date", "star:fact_sales_order"
+        ]
+        # Payment dates are in dim_date too
+        assert sorted(pipeline_nodes(["payment"])["load:fact_payment"]["needs"]) == ["load:dim_date", "star:fact_payment"]
+        assert pipeline_nodes(["currency"])["load:dim_currency"]["needs"] == ["star:dim_currency"]
+
+    @pytest.mark.it("waves only depend on the waves before them")
+    def test_pipeline_waves(self):
+        waves = pipeline_waves(pipeline_nodes(["sales_order", "currency"]))
+        assert [[f"{node['stage']}:{node['table_name']}" for node in wave] for wave in waves] == [
+            ["transform:currency", "transform:sales_order"],
+            ["star:dim_currency", "star:dim_date", "star:fact_sales_order"],
+            ["load:dim_currency", "load:dim_date"],
+            ["load:fact_sales_order"],
+        ]
+
+    @pytest.mark.it("nothing is run when no table changed")
+    def test_nothing_changed(self):
+        assert pipeline_waves(pipeline_nodes([])) == []
+
+    @pytest.mark.it("raises an exception for a dependency cycle")
+    def test_cycle(self):
+        nodes = {
+            "a": {"stage": "star", "table_name": "a", "needs": ["b"]},
+            "b": {"stage": "star", "table_name": "b", "needs": ["a"]},
+        }
+        with pytest.raises(Exception, match="dependency cycle"):
+            pipeline_waves(nodes)
+
+
+class TestRunPipeline:
+
+    @pytest.mark.it("every node runs after the nodes it needs")
+    def test_runs_in_dependency_order(self):
+        finished = []
+
+        def run_node(stage, table_name):
+            time.sleep(0.01 if table_name == "currency" else 0)
+            finished.append(f"{stage}:{table_name}")
+
+        nodes = pipeline_nodes(["sales_order", "currency", "staff", "department"])
+        report = run_pipeline(nodes, run_node, max_workers=4, executor_class=ThreadPoolExecutor)
+
+        assert sorted(report["results"]) == sorted(nodes)
+        for node, spec in nodes.items():
+            assert all(finished.index(need) < finished.index(node) for need in spec["needs"])
+
+    @pytest.mark.it("a slow table doesn't hold up tables that don't depend on it")
+    def test_slow_table_runs_alongside_others(self):
+        finished = []
+
+        def run_node(stage, table_name):
+            time.sleep(0.2 if table_name == "sales_order" else 0)
+            finished.append(f"{stage}:{table_name}")
+
+        run_pipeline(pipeline_nodes(["sales_order", "currency"]), run_node, max_workers=4, executor_class=ThreadPoolExecutor)
+
+        assert finished.index("load:dim_currency") < finished.index("transform:sales_order")
+
+    @pytest.mark.it("nodes depending on a failed node are skipped")
+    def test_failures_skip_dependents(self):
+        def run_node(stage, table_name):
+            if table_name == "currency":
+                raise Exception("boom")
+
+        report = run_pipeline(
+            pipeline_nodes(["sales_order", "currency"]), run_node, max_workers=2, executor_class=ThreadPoolExecutor
+        )
+
+        assert report["failed"] == {"transform:currency": "boom"}
+        assert report["skipped"] == ["load:dim_currency", "load:fact_sales_order", "star:dim_currency"]
+        assert "load:dim_date" in report["results"]
+
+    @pytest.mark.it("runs the nodes on a process pool")
+    def test_process_pool(self):
+        report = run_pipeline(pipeline_nodes(["currency"]), record_node, max_workers=2)
+        assert report["results"] == {node: node for node in pipeline_nodes(["currency"])}
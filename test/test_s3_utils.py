@@ -0,0 +1,66 @@
+import pytest
+import boto3
+import os
+from moto import mock_aws
+from src.utils.s3_utils import S3MultipartWriter, minimum_part_size
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for S3 bucket."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    """Mocked S3 client with raw data bucket."""
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket="totesys-raw-data-000000",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield s3
+
+
+def read_object(s3, key):
+    return s3.get_object(Bucket="totesys-raw-data-000000", Key=key)["Body"].read()
+
+
+class TestS3MultipartWriter:
+    @pytest.mark.it("small objects are uploaded with a single put_object")
+    def test_small_object(self, s3):
+        with S3MultipartWriter(s3, "totesys-raw-data-000000", "small.csv") as writer:
+            writer.write(b"a,b\n")
+            writer.write(b"1,2\n")
+        assert read_object(s3, "small.csv") == b"a,b\n1,2\n"
+        assert s3.list_multipart_uploads(Bucket="totesys-raw-data-000000").get("Uploads") is None
+
+    @pytest.mark.it("large objects are uploaded in parts without holding the whole object")
+    def test_multipart(self, s3):
+        chunk = b"x" * (1024 * 1024)
+        with S3MultipartWriter(s3, "totesys-raw-data-000000", "large.csv") as writer:
+            for _ in range(12):
+                writer.write(chunk)
+                assert len(writer._buffer) < minimum_part_size
+        assert read_object(s3, "large.csv") == chunk * 12
+        assert writer.bytes_written == len(chunk) * 12
+
+    @pytest.mark.it("nothing is uploaded when the block raises")
+    def test_aborts_on_error(self, s3):
+        with pytest.raises(RuntimeError):
+            with S3MultipartWriter(s3, "totesys-raw-data-000000", "broken.csv") as writer:
+                writer.write(b"x" * (6 * 1024 * 1024))
+                raise RuntimeError("query failed")
+        assert "Contents" not in s3.list_objects_v2(Bucket="totesys-raw-data-000000")
+        assert s3.list_multipart_uploads(Bucket="totesys-raw-data-000000").get("Uploads") is None
+
+    @pytest.mark.it("raises an exception when the bucket does not exist")
+    def test_missing_bucket(self, s3):
+        with pytest.raises(Exception):
+            with S3MultipartWriter(s3, "imposter-steve", "small.csv") as writer:
+                writer.write(b"a,b\n")
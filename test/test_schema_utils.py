@@ -0,0 +1,147 @@
+import pytest
+import boto3
+import os
+import json
+from moto import mock_aws
+from src.utils import schema_utils
+from src.utils.schema_utils import (
+    fetch_schema_catalog,
+    load_schema_catalog,
+    table_columns,
+    table_primary_key,
+    catalog_file_path,
+    default_catalog,
+    get_cached_catalog,
+)
+from src.utils.cache_utils import clear_cache
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for S3 bucket."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    """Mocked S3 client with raw data bucket."""
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket="totesys-raw-data-000000",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        clear_cache()
+        yield s3
+        clear_cache()
+
+
+class CatalogConnection:  # Answers the schema hash and catalog queries
+    def __init__(self, schema_hash="hash-1"):
+        self.schema_hash = schema_hash
+        self.catalog_queries = 0
+
+    def run(self, sql, **params):
+        if "md5(" in sql:
+            return [[self.schema_hash]]
+        self.catalog_queries += 1
+        return [
+            ["currency", "currency_id", 1, "integer", False, True],
+            ["currency", "currency_code", 2, "character varying", False, False],
+            ["currency", "last_updated", 4, "timestamp without time zone", False, False],
+            ["staff", "staff_id", 1, "integer", False, True],
+            ["staff", "first_name", 2, "character varying", False, False],
+        ]
+
+
+class TestFetchSchemaCatalog:
+    @pytest.mark.it("builds every table's columns and primary key from one query")
+    def test_catalog(self):
+        conn = CatalogConnection()
+        catalog = fetch_schema_catalog(conn)
+        assert conn.catalog_queries == 1
+        assert catalog["hash"] == "hash-1"
+        assert table_columns(catalog, "currency") == [
+            ("currency_id", "integer"),
+            ("currency_code", "character varying"),
+            ("last_updated", "timestamp without time zone"),
+        ]
+        assert table_primary_key(catalog, "staff") == "staff_id"
+
+    @pytest.mark.it("primary keys are read from pg_index, which the read-only user can see")
+    def test_primary_keys_from_pg_index(self):
+        assert "pg_index" in schema_utils.catalog_query
+        assert "indisprimary" in schema_utils.catalog_query
+        assert "table_constraints" not in schema_utils.catalog_query
+
+    @pytest.mark.it("warns about tables without a primary key")
+    def test_missing_primary_key(self, caplog):
+        class NoKeysConnection(CatalogConnection):
+            def run(self, sql, **params):
+                return [row[:5] + [False] for row in super().run(sql, **params)]
+
+        catalog = fetch_schema_catalog(NoKeysConnection(), "hash-1")
+        assert table_primary_key(catalog, "currency") is None
+        assert "No primary key found for currency" in caplog.text
+
+    @pytest.mark.it("tables missing from the catalog have no columns or primary key")
+    def test_missing_table(self):
+        catalog = fetch_schema_catalog(CatalogConnection())
+        assert table_columns(catalog, "payment") is None
+        assert table_primary_key(catalog, "payment") is None
+
+
+class TestLoadSchemaCatalog:
+    @pytest.mark.it("saves the catalog in the bucket the first time")
+    def test_first_load(self, s3):
+        catalog = load_schema_catalog(CatalogConnection(), s3, "totesys-raw-data-000000")
+        saved = s3.get_object(Bucket="totesys-raw-data-000000", Key=catalog_file_path)
+        assert json.loads(saved["Body"].read()) == catalog
+
+    @pytest.mark.it("reuses the cached catalog while the schema hash is unchanged")
+    def test_container_cache(self, s3):
+        load_schema_catalog(CatalogConnection(), s3, "totesys-raw-data-000000")
+        conn = CatalogConnection()
+        load_schema_catalog(conn, s3, "totesys-raw-data-000000")
+        assert conn.catalog_queries == 0
+
+    @pytest.mark.it("a cold container reads the catalog from the bucket")
+    def test_bucket_cache(self, s3):
+        load_schema_catalog(CatalogConnection(), s3, "totesys-raw-data-000000")
+        clear_cache()
+        conn = CatalogConnection()
+        load_schema_catalog(conn, s3, "totesys-raw-data-000000")
+        assert conn.catalog_queries == 0
+
+    @pytest.mark.it("rebuilds the catalog when the schema hash changes")
+    def test_invalidated(self, s3):
+        load_schema_catalog(CatalogConnection(), s3, "totesys-raw-data-000000")
+        conn = CatalogConnection("hash-2")
+        catalog = load_schema_catalog(conn, s3, "totesys-raw-data-000000")
+        assert conn.catalog_queries == 1
+        assert catalog["hash"] == "hash-2"
+
+
+class TestGetCachedCatalog:
+    @pytest.mark.it("reads the catalog extract saved")
+    def test_saved_catalog(self, s3):
+        clear_cache()
+        catalog = load_schema_catalog(CatalogConnection(), s3, "totesys-raw-data-000000")
+        assert get_cached_catalog(s3, "totesys-raw-data-000000") == catalog
+        clear_cache()
+
+    @pytest.mark.it("falls back to the totesys schema when extract hasn't saved one")
+    def test_default_catalog(self, s3):
+        clear_cache()
+        catalog = get_cached_catalog(s3, "totesys-raw-data-000000")
+        clear_cache()
+        assert catalog == default_catalog()
+        assert table_primary_key(catalog, "payment") == "payment_id"
+        assert ("paid", "boolean") in table_columns(catalog, "payment")
+        assert {"name": "commercial_contact", "data_type": "character varying", "nullable": True} in (
+            catalog["tables"]["counterparty"]["columns"]
+        )
@@ -0,0 +1,211 @@
+import pytest
+import boto3
+import os
+import threading
+import time
+from moto import mock_aws
+from botocore.exceptions import ClientError
+from src.utils.storage_utils import S3Storage, LocalStorage, get_storage, run
+from src.utils.cache_utils import clear_cache
+
+
+@pytest.fixture(scope="function")
+def aws_credentials():
+    """Mocked AWS Credentials for S3 bucket."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "test"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "test"
+    os.environ["AWS_SECURITY_TOKEN"] = "test"
+    os.environ["AWS_SESSION_TOKEN"] = "test"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    """Mocked S3 client with raw data bucket."""
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(
+            Bucket="totesys-raw-data-000000",
+            CreateBucketConfiguration={"LocationConstraint": "eu-west-2"},
+        )
+        yield s3
+
+
+@pytest.fixture(params=["s3", "local"])
+def storage(request, tmp_path):
+    if request.param == "local":
+        return LocalStorage(str(tmp_path))
+    return S3Storage(request.getfixturevalue("s3"))
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr("src.utils.storage_utils.base_delay", 0)
+
+
+class FlakyClient:  # Throttles the first failures requests, counts how many run at once
+    def __init__(self, failures=0, code="SlowDown"):
+        self.failures = failures
+        self.code = code
+        self.calls = 0
+        self.running = 0
+        self.most_running = 0
+        self.lock = threading.Lock()
+
+    def put_object(self, **kwargs):
+        with self.lock:
+            self.calls += 1
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+            failing = self.calls <= self.failures
+        time.sleep(0.01)
+        with self.lock:
+            self.running -= 1
+        if failing:
+            raise ClientError({"Error": {"Code": self.code, "Message": "Please reduce your request rate"}}, "PutObject")
+
+
+class TestStorage:
+
+    @pytest.mark.it("objects written can be read back, listed and deleted")
+    def test_round_trip(self, storage):
+        async def round_trip():
+            await storage.put_many("totesys-raw-data-000000", {"/state/a.json": b"a", "/state/b.json": b"bb", "/x": b""})
+            objects = await storage.get_many("totesys-raw-data-000000", ["/state/a.json", "/state/b.json"])
+            keys = await storage.list("totesys-raw-data-000000", "/state/")
+            await storage.delete("totesys-raw-data-000000", ["/state/a.json"])
+            return objects, keys, await storage.get("totesys-raw-data-000000", "/state/a.json")
+
+        objects, keys, deleted = run(round_trip())
+        assert {key: obj["body"] for key, obj in objects.items()} == {"/state/a.json": b"a", "/state/b.json": b"bb"}
+        assert objects["/state/a.json"]["last_modified"].tzinfo is not None
+        assert keys == ["/state/a.json", "/state/b.json"]
+        assert deleted is None
+
+    @pytest.mark.it("objects can be copied, streamed in and described without their body")
+    def test_head_copy_and_writer(self, storage):
+        bucket = "totesys-raw-data-000000"
+        with storage.writer(bucket, "/history/a.csv") as writer:
+            writer.write(b"a,b\n")
+            writer.write(b"1,2\n")
+        with pytest.raises(ValueError):
+            with storage.writer(bucket, "/history/aborted.csv") as writer:
+                writer.write(b"a")
+                raise ValueError()
+
+        async def copy_and_head():
+            await storage.copy(bucket, "/history/a.csv", bucket, "/history/b.csv")
+            return [await storage.head(bucket, key) for key in ["/history/a.csv", "/history/b.csv", "/history/aborted.csv"]]
+
+        a, b, aborted = run(copy_and_head())
+        assert writer.bytes_written == 1
+        assert run(storage.get(bucket, "/history/b.csv"))["body"] == b"a,b\n1,2\n"
+        assert (a["size"], a["etag"]) == (8, b["etag"])
+        assert aborted is None
+        assert run(storage.list_buckets()) == [bucket]
+
+    @pytest.mark.it("throttled requests are retried")
+    def test_retries(self):
+        client = FlakyClient(failures=2)
+        assert run(S3Storage(client).put("bucket", "key", b"abc")) == 3
+        assert client.calls == 3
+
+    @pytest.mark.it("raises once the attempts run out or the error won't go away")
+    def test_gives_up(self):
+        client = FlakyClient(failures=10)
+        with pytest.raises(Exception, match="Failed to write key"):
+            run(S3Storage(client).put("bucket", "key", b"abc"))
+        assert client.calls == 5
+
+        client = FlakyClient(failures=1, code="AccessDenied")
+        with pytest.raises(Exception):
+            run(S3Storage(client).put("bucket", "key", b"abc"))
+        assert client.calls == 1
+
+    @pytest.mark.it("runs at most max_concurrency requests at once")
+    def test_bounded_concurrency(self):
+        client = FlakyClient()
+        run(S3Storage(client, max_concurrency=3).put_many("bucket", {f"key_{i}": b"x" for i in range(12)}))
+        assert client.calls == 12
+        assert 1 < client.most_running <= 3
+
+    @pytest.mark.it("one storage is shared, so its limit holds across run calls from any thread")
+    def test_shared_storage(self, monkeypatch):
+        monkeypatch.delenv("STORAGE_BACKEND", raising=False)
+        client = FlakyClient()
+        assert get_storage(client, max_concurrency=3) is get_storage(client, max_concurrency=3)
+
+        threads = [
+            threading.Thread(target=lambda i=i: run(get_storage(client, max_concurrency=3).put("bucket", f"key_{i}", b"x")))
+            for i in range(12)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert client.calls == 12
+        assert 1 < client.most_running <= 3
+
+    @pytest.mark.it("the writer's requests are retried too")
+    def test_writer_retries(self):
+        client = FlakyClient(failures=2)
+        with S3Storage(client).writer("bucket", "key") as writer:
+            writer.write(b"abc")
+        assert client.calls == 3
+
+    @pytest.mark.it("the backend is picked with STORAGE_BACKEND")
+    def test_get_storage(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("STORAGE_BACKEND", "local")
+        monkeypatch.setenv("STORAGE_ROOT", str(tmp_path))
+        storage = get_storage()
+        run(storage.put("bucket", "/source/a.csv", b"a"))
+        assert (tmp_path / "bucket" / "source" / "a.csv").read_bytes() == b"a"
+
+        monkeypatch.setenv("STORAGE_BACKEND", "tape")
+        with pytest.raises(Exception):
+            get_storage()
+
+
+@pytest.fixture
+def local(monkeypatch, tmp_path):
+    """The storage get_storage returns with the local backend rooted in tmp_path."""
+    monkeypatch.setenv("STORAGE_BACKEND", "local")
+    monkeypatch.setenv("STORAGE_ROOT", str(tmp_path))
+    clear_cache()
+    yield get_storage()
+    clear_cache()
+
+
+class TestLocalBackend:
+
+    @pytest.mark.it("objects put through get_storage can be got and listed by prefix")
+    def test_get_put_list(self, local, tmp_path):
+        bucket = "totesys-raw-data-000000"
+        run(local.put_many(bucket, {"/history/currency/a.csv": b"a", "/history/currency/b.csv": b"b", "/state/c.json": b"{}"}))
+        run(local.put(bucket, "/history/currency/a.csv", b"aa"))
+
+        assert run(local.get(bucket, "/history/currency/a.csv"))["body"] == b"aa"
+        assert run(local.list(bucket, "/history/")) == ["/history/currency/a.csv", "/history/currency/b.csv"]
+        assert run(local.list(bucket, "/history/currency/b")) == ["/history/currency/b.csv"]
+        assert run(local.list(bucket)) == ["/history/currency/a.csv", "/history/currency/b.csv", "/state/c.json"]
+        assert run(local.list_buckets()) == [bucket]
+        assert (tmp_path / bucket / "state" / "c.json").read_bytes() == b"{}"
+        assert get_storage() is local
+
+    @pytest.mark.it("missing keys, buckets and roots read as absent rather than raising")
+    def test_missing_keys(self, local, monkeypatch, tmp_path):
+        bucket = "totesys-raw-data-000000"
+        run(local.put(bucket, "/state/a.json", b"a"))
+
+        assert run(local.get(bucket, "/state/missing.json")) is None
+        assert run(local.head(bucket, "/state/missing.json")) is None
+        assert run(local.get_many(bucket, ["/state/a.json", "/state/missing.json"]))["/state/missing.json"] is None
+        assert run(local.list(bucket, "/history/")) == []
+        assert run(local.list("totesys-missing-bucket")) == []
+        run(local.delete(bucket, ["/state/missing.json"]))
+        with pytest.raises(Exception, match="Failed to copy"):
+            run(local.copy(bucket, "/state/missing.json", bucket, "/state/b.json"))
+        assert run(local.list(bucket)) == ["/state/a.json"]
+
+        monkeypatch.setenv("STORAGE_ROOT", str(tmp_path / "missing"))
+        assert run(get_storage().list_buckets()) == []
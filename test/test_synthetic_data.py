@@ -0,0 +1,64 @@
+import pytest
+from datetime import datetime
+from polars.testing import assert_frame_equal
+from src.benchmark.synthetic_data import table_sizes, generate_tables, churn, apply_churn
+from src.utils.diff_utils import primary_keys
+
+
+@pytest.fixture(scope="module")
+def tables():
+    return generate_tables(1000, seed=3)
+
+
+class TestGenerateTables:
+
+    @pytest.mark.it("generates every source table at the sizes from table_sizes")
+    def test_sizes(self, tables):
+        assert list(tables) == list(primary_keys)
+        assert {table_name: df.height for table_name, df in tables.items()} == table_sizes(1000)
+
+    @pytest.mark.it("the same seed generates the same tables")
+    def test_seeded(self, tables):
+        for table_name, df in generate_tables(1000, seed=3).items():
+            assert_frame_equal(df, tables[table_name])
+        assert not generate_tables(1000, seed=4)["sales_order"].equals(tables["sales_order"])
+
+    @pytest.mark.it("foreign keys point at existing rows")
+    def test_foreign_keys(self, tables):
+        sales_order = tables["sales_order"]
+        assert sales_order["design_id"].is_between(1, tables["design"].height).all()
+        assert sales_order["staff_id"].is_between(1, tables["staff"].height).all()
+        assert tables["staff"]["department_id"].is_between(1, tables["department"].height).all()
+        transaction = tables["transaction"]
+        assert transaction["sales_order_id"].drop_nulls().is_in(sales_order["sales_order_id"].implode()).all()
+        assert transaction["purchase_order_id"].drop_nulls().is_in(
+            tables["purchase_order"]["purchase_order_id"].implode()
+        ).all()
+        assert tables["payment"]["transaction_id"].equals(transaction["transaction_id"], check_names=False)
+
+
+class TestChurn:
+
+    @pytest.mark.it("updates and inserts a fraction of the rows, changed at the given time")
+    def test_churn(self, tables):
+        at = datetime(2025, 1, 1)
+        changes = churn(tables, fraction=0.1, at=at)
+
+        assert changes["sales_order"]["updated"].height == 100
+        assert changes["sales_order"]["inserted"].height == 100
+        assert changes["transaction"]["inserted"].height == 150
+        assert (changes["staff"]["updated"]["last_updated"] == at).all()
+        assert changes["sales_order"]["inserted"]["sales_order_id"].min() == 1001
+
+    @pytest.mark.it("apply_churn returns the tables with the changes made")
+    def test_apply_churn(self, tables):
+        changes = churn(tables, fraction=0.1)
+        churned = apply_churn(tables, changes)
+
+        assert churned["sales_order"].height == 1100
+        assert churned["currency"] is tables["currency"]
+        updated = changes["sales_order"]["updated"]
+        assert_frame_equal(
+            churned["sales_order"].filter(churned["sales_order"]["sales_order_id"].is_in(updated["sales_order_id"].implode())),
+            updated,
+        )
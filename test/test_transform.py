@@ -1,8 +1,22 @@
 import pytest
 import boto3
+import json
 import os
+import polars as pl
+from datetime import datetime
+from io import BytesIO
 from moto import mock_aws
 from src.lambda_functions.transform import lambda_handler as transform
+from src.utils.cache_utils import clear_cache
+from src.utils.transform_utils import processed_key
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    """Stops resources cached by one test's invocation leaking into the next."""
+    clear_cache()
+    yield
+    clear_cache()
 
 
 @pytest.fixture(scope="function")
@@ -35,7 +49,7 @@ class DummyContext:  # Dummy context class used for testing
     pass
 
 
-event = {"time_prefix": "YYYY/MM/DD/HH:MM:SS/"}
+event = {"time_prefix": "2024_08_16_10:00:00"}
 context = DummyContext()
 
 
@@ -50,7 +64,7 @@ class TestTransform:
                     5,6,7
                     8,9,10""",
             Bucket='totesys-raw-data-000000',
-            Key='/history/YYYY/MM/DD/HH:MM:SS/sales_order.csv'
+            Key='/history/sales_order/differences_2024_08_16_10:00:00.csv'
         )
         s3.put_object(
             Body="""test,test2,test3
@@ -58,7 +72,7 @@ class TestTransform:
                     5,6,7
                     8,9,10""",
             Bucket='totesys-raw-data-000000',
-            Key='/history/YYYY/MM/DD/HH:MM:SS/design.csv'
+            Key='/history/design/differences_2024_08_16_10:00:00.csv'
         )
         s3.put_object(
             Body="""test,test2,test3
@@ -66,7 +80,7 @@ class TestTransform:
                     5,6,7
                     8,9,10""",
             Bucket='totesys-raw-data-000000',
-            Key='/history/YYYY/MM/DD/HH:MM:SS/currency.csv'
+            Key='/history/currency/differences_2024_08_16_10:00:00.csv'
         )
         s3.put_object(
             Body="""test,test2,test3
@@ -74,7 +88,7 @@ class TestTransform:
                     5,6,7
                     8,9,10""",
             Bucket='totesys-raw-data-000000',
-            Key='/history/YYYY/MM/DD/HH:MM:SS/staff.csv'
+            Key='/history/staff/differences_2024_08_16_10:00:00.csv'
         )
         s3.put_object(
             Body="""test,test2,test3
@@ -82,7 +96,7 @@ class TestTransform:
                     5,6,7
                     8,9,10""",
             Bucket='totesys-raw-data-000000',
-            Key='/history/YYYY/MM/DD/HH:MM:SS/counterparty.csv'
+            Key='/history/counterparty/differences_2024_08_16_10:00:00.csv'
         )
         s3.put_object(
             Body="""test,test2,test3
@@ -90,7 +104,7 @@ class TestTransform:
                     5,6,7
                     8,9,10""",
             Bucket='totesys-raw-data-000000',
-            Key='/history/YYYY/MM/DD/HH:MM:SS/address.csv'
+            Key='/history/address/differences_2024_08_16_10:00:00.csv'
         )
         s3.put_object(
             Body="""test,test2,test3
@@ -98,7 +112,7 @@ class TestTransform:
                     5,6,7
                     8,9,10""",
             Bucket='totesys-raw-data-000000',
-            Key='/history/YYYY/MM/DD/HH:MM:SS/department.csv'
+            Key='/history/department/differences_2024_08_16_10:00:00.csv'
         )
         s3.put_object(
             Body="""test,test2,test3
@@ -106,7 +120,7 @@ class TestTransform:
                     5,6,7
                     8,9,10""",
             Bucket='totesys-raw-data-000000',
-            Key='/history/YYYY/MM/DD/HH:MM:SS/purchase_order.csv'
+            Key='/history/purchase_order/differences_2024_08_16_10:00:00.csv'
         )
         s3.put_object(
             Body="""test,test2,test3
@@ -114,7 +128,7 @@ class TestTransform:
                     5,6,7
                     8,9,10""",
             Bucket='totesys-raw-data-000000',
-            Key='/history/YYYY/MM/DD/HH:MM:SS/payment_type.csv'
+            Key='/history/payment_type/differences_2024_08_16_10:00:00.csv'
         )
         s3.put_object(
             Body="""test,test2,test3
@@ -122,7 +136,7 @@ class TestTransform:
                     5,6,7
                     8,9,10""",
             Bucket='totesys-raw-data-000000',
-            Key='/history/YYYY/MM/DD/HH:MM:SS/payment.csv'
+            Key='/history/payment/differences_2024_08_16_10:00:00.csv'
         )
         s3.put_object(
             Body="""test,test2,test3
@@ -130,25 +144,367 @@ class TestTransform:
                     5,6,7
                     8,9,10""",
             Bucket='totesys-raw-data-000000',
-            Key='/history/YYYY/MM/DD/HH:MM:SS/transaction.csv'
+            Key='/history/transaction/differences_2024_08_16_10:00:00.csv'
         )
 
-        expected_pq = {'/history/YYYY/MM/DD/HH:MM:SS//address.parquet': 0,
-                       '/history/YYYY/MM/DD/HH:MM:SS//design.parquet': 0,
-                       '/history/YYYY/MM/DD/HH:MM:SS//currency.parquet': 0,
-                       '/history/YYYY/MM/DD/HH:MM:SS//staff.parquet': 0,
-                       '/history/YYYY/MM/DD/HH:MM:SS//counterparty.parquet': 0,
-                       '/history/YYYY/MM/DD/HH:MM:SS//sales_order.parquet': 0,
-                       '/history/YYYY/MM/DD/HH:MM:SS//department.parquet': 0,
-                       '/history/YYYY/MM/DD/HH:MM:SS//purchase_order.parquet': 0,
-                       '/history/YYYY/MM/DD/HH:MM:SS//payment_type.parquet': 0,
-                       '/history/YYYY/MM/DD/HH:MM:SS//payment.parquet': 0,
-                       '/history/YYYY/MM/DD/HH:MM:SS//transaction.parquet': 0}
+        expected_pq = {'/history/table=address/date=2024-08-16/20240816T100000.parquet': 0,
+                       '/history/table=design/date=2024-08-16/20240816T100000.parquet': 0,
+                       '/history/table=currency/date=2024-08-16/20240816T100000.parquet': 0,
+                       '/history/table=staff/date=2024-08-16/20240816T100000.parquet': 0,
+                       '/history/table=counterparty/date=2024-08-16/20240816T100000.parquet': 0,
+                       '/history/table=sales_order/date=2024-08-16/20240816T100000.parquet': 0,
+                       '/history/table=department/date=2024-08-16/20240816T100000.parquet': 0,
+                       '/history/table=purchase_order/date=2024-08-16/20240816T100000.parquet': 0,
+                       '/history/table=payment_type/date=2024-08-16/20240816T100000.parquet': 0,
+                       '/history/table=payment/date=2024-08-16/20240816T100000.parquet': 0,
+                       '/history/table=transaction/date=2024-08-16/20240816T100000.parquet': 0}
 
         res = transform(event, context)
-        proc_data_bucket_objects = s3.list_objects(Bucket="totesys-processed-data-000000")['Contents']
+        proc_data_bucket_objects = s3.list_objects(Bucket="totesys-processed-data-000000", Prefix="/history/")["Contents"]
 
         for parquet in proc_data_bucket_objects:
-            assert parquet['Key'] in expected_pq
+            if parquet['Key'].endswith(".parquet"):
+                assert parquet['Key'] in expected_pq
+
+        assert res["time_prefix"] == "2024_08_16_10:00:00"
+        for file in expected_pq:
+            assert res["timings"][file.split("/")[2].removeprefix("table=")]["rows"] == 3
+
+    @pytest.mark.it("returns a timing report for every table")
+    def test_transform_returns_timing_report(self, s3):
+        for table in ["sales_order", "design"]:
+            s3.put_object(
+                Body="test,test2,test3\n1,2,3\n5,6,7\n",
+                Bucket='totesys-raw-data-000000',
+                Key=f'/history/{table}/differences_2024_08_16_10:00:00.csv'
+            )
+
+        res = transform({**event, "max_concurrency": 2}, context)
+
+        assert res["timings"]["sales_order"]["rows"] == 2
+        assert res["timings"]["design"]["parquet_bytes"] > 0
+        for step in ["fetch_seconds", "parse_seconds", "upload_seconds"]:
+            assert res["timings"]["sales_order"][step] >= 0
+        assert res["timings"]["currency"] == {"skipped": True}
+
+    @pytest.mark.it("written parquet matches the raw csv, typed with the table's schema")
+    def test_transform_writes_matching_parquet(self, s3):
+        s3.put_object(
+            Body="currency_id,currency_code,created_at,last_updated\n"
+                 "1,GBP,2022-11-03 14:20:49.962,2022-11-03 14:20:49.962\n"
+                 "2,USD,2022-11-03 14:20:49.962,2022-11-03 14:20:49.962\n",
+            Bucket='totesys-raw-data-000000',
+            Key='/history/currency/differences_2024_08_16_10:00:00.csv'
+        )
+
+        transform(event, context)
+        res = s3.get_object(
+            Bucket="totesys-processed-data-000000",
+            Key='/history/table=currency/date=2024-08-16/20240816T100000.parquet'
+        )
+
+        df = pl.read_parquet(BytesIO(res["Body"].read()))
+        created_at = datetime(2022, 11, 3, 14, 20, 49, 962000)
+        assert df.schema["currency_id"] == pl.Int32
+        assert df.to_dicts() == [
+            {"currency_id": 1, "currency_code": "GBP", "created_at": created_at, "last_updated": created_at},
+            {"currency_id": 2, "currency_code": "USD", "created_at": created_at, "last_updated": created_at},
+        ]
+
+    @pytest.mark.it("raw parquet files are copied to the processed bucket")
+    def test_transform_copies_raw_parquet(self, s3):
+        buffer = BytesIO()
+        pl.DataFrame({"test": [1, 2]}).write_parquet(buffer)
+        s3.put_object(
+            Body=buffer.getvalue(),
+            Bucket='totesys-raw-data-000000',
+            Key='/history/design/differences_2024_08_16_10:00:00.parquet'
+        )
+
+        res = transform({**event, "output_format": "parquet"}, context)
+
+        copied = s3.get_object(
+            Bucket="totesys-processed-data-000000",
+            Key='/history/table=design/date=2024-08-16/20240816T100000.parquet'
+        )["Body"].read()
+        assert copied == buffer.getvalue()
+        assert "copy_seconds" in res["timings"]["design"]
+        assert res["timings"]["payment"] == {"skipped": True}
+
+    @pytest.mark.it("raises when no table could be transformed")
+    def test_transform_raises_when_every_table_fails(self, s3):
+        for file in ["sales_order", "design", "currency", "staff", "counterparty", "address",
+                     "department", "purchase_order", "payment_type", "payment", "transaction"]:
+            s3.put_object(
+                Body="not,a\n1,2,3,4\n",
+                Bucket='totesys-raw-data-000000',
+                Key=f'/history/{file}/differences_2024_08_16_10:00:00.csv'
+            )
+
+        with pytest.raises(Exception, match="Failed to transform every table"):
+            transform(event, context)
+
+
+class TestStarSchema:
+
+    @pytest.mark.it("changes are applied to the current snapshot of each table")
+    def test_current_snapshot_is_updated(self, s3):
+        s3.put_object(
+            Body="currency_id,currency_code,created_at,last_updated\n"
+                 "1,GBP,2022-11-03 14:20:49.962,2022-11-03 14:20:49.962\n"
+                 "2,USD,2022-11-03 14:20:49.962,2022-11-03 14:20:49.962\n",
+            Bucket='totesys-raw-data-000000',
+            Key='/history/currency/differences_2024_08_16_10:00:00.csv'
+        )
+        transform(event, context)
+        s3.put_object(
+            Body="currency_id,currency_code,created_at,last_updated,change_type\n"
+                 "2,USD,2022-11-03 14:20:49.962,2022-11-03 14:20:49.962,delete\n"
+                 "3,EUR,2022-11-04 14:20:49.962,2022-11-04 14:20:49.962,insert\n",
+            Bucket='totesys-raw-data-000000',
+            Key='/history/currency/differences_2024_08_16_10:00:01.csv'
+        )
+        transform({"time_prefix": "2024_08_16_10:00:01"}, context)
+
+        res = s3.get_object(Bucket="totesys-processed-data-000000", Key="/current/currency.parquet")
+        current = pl.read_parquet(BytesIO(res["Body"].read()))
+        assert current["currency_code"].to_list() == ["GBP", "EUR"]
+        assert "change_type" not in current.columns
+
+    @pytest.mark.it("warehouse tables depending on changed tables are built for the load function")
+    def test_star_tables_are_built(self, s3):
+        s3.put_object(
+            Body="currency_id,currency_code,created_at,last_updated\n"
+                 "1,GBP,2022-11-03 14:20:49.962,2022-11-03 14:20:49.962\n",
+            Bucket='totesys-raw-data-000000',
+            Key='/history/currency/differences_2024_08_16_10:00:00.csv'
+        )
+
+        res = transform(event, context)
+
+        assert res["timings"]["dim_currency"]["rows"] == 1
+        assert "dim_staff" not in res["timings"]
+        dim_currency = s3.get_object(
+            Bucket="totesys-processed-data-000000", Key="/history/table=dim_currency/date=2024-08-16/20240816T100000.parquet"
+        )
+        assert pl.read_parquet(BytesIO(dim_currency["Body"].read())).to_dicts() == [
+            {"currency_id": 1, "currency_code": "GBP", "currency_name": "British Pound"}
+        ]
+
+    @pytest.mark.it("dim_date is cached and later runs only upload the new days")
+    def test_dim_date_is_extended(self, s3):
+        header = "sales_order_id,created_at,last_updated,design_id,staff_id,counterparty_id,units_sold," \
+                 "unit_price,currency_id,agreed_delivery_date,agreed_payment_date,agreed_delivery_location_id\n"
+        s3.put_object(
+            Body=header + "1,2022-11-03 14:20:52.186,2022-11-03 14:20:52.186,3,19,8,42972,3.94,2,2022-11-07,2022-11-08,8\n",
+            Bucket='totesys-raw-data-000000',
+            Key='/history/sales_order/differences_2024_08_16_10:00:00.csv'
+        )
+        first = transform(event, context)
+        s3.put_object(
+            Body=header + "2,2022-12-03 14:20:52.186,2022-12-03 14:20:52.186,3,19,8,100,3.94,2,2023-01-07,2023-01-08,8\n",
+            Bucket='totesys-raw-data-000000',
+            Key='/history/sales_order/differences_2024_08_16_10:00:01.csv'
+        )
+        second = transform({"time_prefix": "2024_08_16_10:00:01"}, context)
+        s3.put_object(
+            Body=header + "2,2022-12-03 14:20:52.186,2022-12-04 14:20:52.186,3,19,8,90,3.94,2,2023-01-07,2023-01-08,8\n",
+            Bucket='totesys-raw-data-000000',
+            Key='/history/sales_order/differences_2024_08_16_10:00:02.csv'
+        )
+        third = transform({"time_prefix": "2024_08_16_10:00:02"}, context)
+
+        assert first["timings"]["dim_date"]["rows"] == 365
+        assert second["timings"]["dim_date"]["rows"] == 365
+        assert third["timings"]["dim_date"]["rows"] == 0
+        keys = [o["Key"] for o in s3.list_objects(Bucket="totesys-processed-data-000000")["Contents"]]
+        assert "/history/table=dim_date/date=2024-08-16/20240816T100002.parquet" not in keys
+        cached = s3.get_object(Bucket="totesys-processed-data-000000", Key="/current/dim_date.parquet")
+        assert pl.read_parquet(BytesIO(cached["Body"].read())).height == 365 * 2
+
+
+class TestIncrementalTransform:
+
+    currency_header = "currency_id,currency_code,created_at,last_updated\n"
+
+    def put_currency(self, s3, prefix, body):
+        s3.put_object(
+            Body=self.currency_header + body,
+            Bucket='totesys-raw-data-000000',
+            Key=f'/history/currency/differences_{prefix}.csv'
+        )
+
+    @pytest.mark.it("running the same files again skips every table")
+    def test_retry_is_skipped(self, s3):
+        self.put_currency(s3, "2024_08_16_10:00:00", "1,GBP,2022-11-03 14:20:49.962,2022-11-03 14:20:49.962\n")
+        transform(event, context)
+
+        res = transform(event, context)
+
+        assert res["timings"]["currency"] == {"skipped": True}
+        assert "dim_currency" not in res["timings"]
+
+    @pytest.mark.it("only the changed rows of a dimension are uploaded")
+    def test_dimension_delta(self, s3):
+        self.put_currency(
+            s3, "2024_08_16_10:00:00",
+            "1,GBP,2022-11-03 14:20:49.962,2022-11-03 14:20:49.962\n2,USD,2022-11-03 14:20:49.962,2022-11-03 14:20:49.962\n"
+        )
+        transform(event, context)
+        self.put_currency(s3, "2024_08_16_10:00:01", "3,EUR,2022-11-04 14:20:49.962,2022-11-04 14:20:49.962\n")
+
+        res = transform({"time_prefix": "2024_08_16_10:00:01"}, context)
+
+        assert res["timings"]["dim_currency"]["rows"] == 1
+        delta = s3.get_object(
+            Bucket="totesys-processed-data-000000", Key="/history/table=dim_currency/date=2024-08-16/20240816T100001.parquet"
+        )
+        assert pl.read_parquet(BytesIO(delta["Body"].read()))["currency_code"].to_list() == ["EUR"]
+        compacted = s3.get_object(Bucket="totesys-processed-data-000000", Key="/current/dim_currency.parquet")
+        assert pl.read_parquet(BytesIO(compacted["Body"].read())).height == 3
+
+    @pytest.mark.it("a raw file that doesn't change the current snapshot doesn't rebuild its dimensions")
+    def test_unchanged_snapshot_is_skipped(self, s3):
+        row = "1,GBP,2022-11-03 14:20:49.962,2022-11-03 14:20:49.962\n"
+        self.put_currency(s3, "2024_08_16_10:00:00", row)
+        transform(event, context)
+        # A different file holding the same row, e.g. extracted again after a full snapshot
+        self.put_currency(s3, "2024_08_16_10:00:01", row + row)
+
+        res = transform({"time_prefix": "2024_08_16_10:00:01"}, context)
+
+        assert res["timings"]["currency"]["current"]["changed"] is False
+        assert "dim_currency" not in res["timings"]
+
+
+class TestFactHistoryTransform:
+
+    header = "sales_order_id,created_at,last_updated,design_id,staff_id,counterparty_id,units_sold," \
+             "unit_price,currency_id,agreed_delivery_date,agreed_payment_date,agreed_delivery_location_id\n"
+
+    @pytest.mark.it("every change to a sales order becomes a new fact row with the next version")
+    def test_fact_versions_across_runs(self, s3):
+        s3.put_object(
+            Body=self.header + "1,2022-11-03 14:20:52.186,2022-11-03 14:20:52.186,3,19,8,100,3.94,2,2022-11-07,2022-11-08,8\n"
+                               "1,2022-11-03 14:20:52.186,2022-11-04 14:20:52.186,3,19,8,90,3.94,2,2022-11-07,2022-11-08,8\n",
+            Bucket='totesys-raw-data-000000',
+            Key='/history/sales_order/differences_2024_08_16_10:00:00.csv'
+        )
+        transform(event, context)
+        s3.put_object(
+            Body=self.header + "1,2022-11-03 14:20:52.186,2022-11-05 14:20:52.186,3,19,8,80,3.94,2,2022-11-07,2022-11-08,8\n",
+            Bucket='totesys-raw-data-000000',
+            Key='/history/sales_order/differences_2024_08_16_10:00:01.csv'
+        )
+        transform({"time_prefix": "2024_08_16_10:00:01"}, context)
+
+        facts = [
+            pl.read_parquet(BytesIO(s3.get_object(
+                Bucket="totesys-processed-data-000000", Key=processed_key("fact_sales_order", prefix)
+            )["Body"].read()))
+            for prefix in ["2024_08_16_10:00:00", "2024_08_16_10:00:01"]
+        ]
+        assert facts[0].select("units_sold", "version").rows() == [(100, 1), (90, 2)]
+        assert facts[1].select("units_sold", "version").rows() == [(80, 3)]
+
+
+class TestPartitionedLayout:
+
+    @pytest.mark.it("each table's manifest lists its files and the compact stage merges yesterday's")
+    def test_manifest_and_compaction(self, s3):
+        for prefix, currency_id in [("2024_08_15_23:00:00", 1), ("2024_08_15_23:30:00", 2), ("2024_08_16_00:00:00", 3)]:
+            s3.put_object(
+                Body=f"currency_id,currency_code,created_at,last_updated\n"
+                     f"{currency_id},GBP,2022-11-03 14:20:49.962,2022-11-03 14:20:49.962\n",
+                Bucket='totesys-raw-data-000000',
+                Key=f'/history/currency/differences_{prefix}.csv'
+            )
+            transform({"time_prefix": prefix}, context)
+
+        def manifest_files():
+            manifest = json.loads(s3.get_object(
+                Bucket="totesys-processed-data-000000", Key="/history/table=currency/_manifest.json"
+            )["Body"].read())
+            return [(file["key"], file["rows"]) for file in manifest["files"]]
+
+        assert len(manifest_files()) == 3
+        res = transform({"stage": "compact", "time_prefix": "2024_08_16_00:30:00"}, context)
+
+        assert res["before_date"] == "2024-08-16"
+        assert res["compacted_files"]["currency"] == 2
+        assert res["failed_tables"] == []
+        assert manifest_files() == [
+            ("/history/table=currency/date=2024-08-15/20240815T230000-20240815T233000.parquet", 2),
+            ("/history/table=currency/date=2024-08-16/20240816T000000.parquet", 1),
+        ]
+
+
+class TestPerTableStages:
+
+    currency = "currency_id,currency_code,created_at,last_updated\n" \
+               "1,GBP,2022-11-03 14:20:49.962,2022-11-03 14:20:49.962\n"
+
+    @pytest.mark.it("plan turns the changed tables into waves of per-table steps")
+    def test_plan(self, s3):
+        res = transform({**event, "stage": "plan", "changed_tables": ["currency"]}, context)
+
+        assert res["time_prefix"] == "2024_08_16_10:00:00"
+        assert "stage" not in res
+        assert res["waves"] == [
+            [{"stage": "transform", "table_name": "currency"}],
+            [{"stage": "star", "table_name": "dim_currency"}],
+            [{"stage": "load", "table_name": "dim_currency"}],
+        ]
+
+    @pytest.mark.it("each table is transformed and built in its own invocation")
+    def test_per_table_stages(self, s3):
+        s3.put_object(
+            Body=self.currency, Bucket='totesys-raw-data-000000',
+            Key='/history/currency/differences_2024_08_16_10:00:00.csv'
+        )
+        stage_event = {**event, "changed_tables": ["currency"]}
+
+        raw = transform({**stage_event, "stage": "transform", "table_name": "currency"}, context)
+        star = transform({**stage_event, "stage": "star", "table_name": "dim_currency"}, context)
+        retried = transform({**stage_event, "stage": "star", "table_name": "dim_currency"}, context)
+
+        assert raw["timings"]["rows"] == 1
+        assert raw["timings"]["current"]["changed"]
+        assert raw["metrics"]["stages"]["transform"]["rows"] == 1
+        assert raw["metrics"]["stages"]["transform"]["bytes_in"] == len(self.currency)
+        assert list(star["metrics"]["stages"]) == ["star"]
+        assert star["timings"]["rows"] == 1
+        assert retried["timings"] == {"skipped": True}
+        state = s3.list_objects(Bucket="totesys-processed-data-000000", Prefix="/state/transform_hashes/")["Contents"]
+        assert sorted(obj["Key"] for obj in state) == [
+            "/state/transform_hashes/currency.json", "/state/transform_hashes/dim_currency.json"
+        ]
+        df = pl.read_parquet(BytesIO(s3.get_object(
+            Bucket="totesys-processed-data-000000", Key=processed_key("dim_currency", "2024_08_16_10:00:00")
+        )["Body"].read()))
+        assert df.rows() == [(1, "GBP", "British Pound")]
+
+
+class TestLocalStorage:
+
+    @pytest.mark.it("the whole transform runs on the local storage backend")
+    def test_local_backend(self, aws_credentials, monkeypatch, tmp_path):
+        monkeypatch.setenv("STORAGE_BACKEND", "local")
+        monkeypatch.setenv("STORAGE_ROOT", str(tmp_path))
+        raw = tmp_path / "totesys-raw-data-000000" / "history" / "currency"
+        raw.mkdir(parents=True)
+        (raw / "differences_2024_08_16_10:00:00.csv").write_text(TestPerTableStages.currency)
+        (tmp_path / "totesys-processed-data-000000").mkdir()
+
+        res = transform(event, context)
+        retried = transform(event, context)
 
-        assert res == {"time_prefix": "YYYY/MM/DD/HH:MM:SS/"}
+        assert res["failed_tables"] == []
+        assert res["timings"]["currency"]["rows"] == 1
+        assert res["timings"]["dim_currency"]["rows"] == 1
+        assert retried["timings"]["currency"] == {"skipped": True}
+        processed = tmp_path / "totesys-processed-data-000000"
+        df = pl.read_parquet(processed / processed_key("dim_currency", "2024_08_16_10:00:00").lstrip("/"))
+        assert df.rows() == [(1, "GBP", "British Pound")]
+        manifest = json.loads((processed / "history" / "table=currency" / "_manifest.json").read_text())
+        assert [file["rows"] for file in manifest["files"]] == [1]
@@ -2,9 +2,42 @@ import pytest
 import boto3
 import os
 from moto import mock_aws
-from src.lambda_functions.transform import finds_data_buckets, convert_csv_to_parquet
+from src.utils.transform_utils import (
+    finds_data_buckets,
+    convert_csv_to_parquet,
+    read_raw_parquet,
+    build_star_table,
+    update_current_snapshot,
+    get_hashes,
+    save_hashes,
+    content_hash,
+    changed_rows,
+    assign_versions,
+    latest_versions,
+    processed_key,
+    get_manifest,
+    save_manifest,
+    manifest_entry,
+    add_to_manifest,
+    compaction_groups,
+    compact_files,
+    merge_parquet_files,
+    write_parquet_to_bucket,
+    read_typed_csv,
+    parquet_options,
+)
+from src.utils.cache_utils import clear_cache
 import polars as pl
 from io import BytesIO
+from datetime import date, time, datetime
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    """Stops resources cached by one test's invocation leaking into the next."""
+    clear_cache()
+    yield
+    clear_cache()
 
 
 @pytest.fixture(scope="function")
@@ -119,3 +152,523 @@ class TestConvertCsvToParquet:
         )
         result = convert_csv_to_parquet('test.txt')
         assert result == "test.txt is not a .csv file."
+
+
+class TestReadTypedCsv:
+
+    payment = (
+        "payment_id,created_at,last_updated,transaction_id,counterparty_id,payment_amount,currency_id,"
+        "payment_type_id,paid,payment_date,company_ac_number,counterparty_ac_number,change_type\n"
+        "1,2022-11-03 14:20:52.186,2022-11-03 14:20:52.186,1,15,552548.62,2,3,f,2022-11-04,67305075,31622269,insert\n"
+        "2,2022-11-03 14:20:52.187000,2022-11-03 14:20:52.187,2,18,205952.22,3,1,True,2022-11-04,81718079,47839086,update\n"
+    )
+
+    @pytest.mark.it("parses columns with the types of the table's schema")
+    def test_typed(self):
+        df = read_typed_csv(self.payment.encode(), "payment")
+        assert df.schema["payment_id"] == pl.Int32
+        assert df.schema["payment_amount"] == pl.Decimal(38, 10)
+        assert df.schema["created_at"] == pl.Datetime("us")
+        assert df["paid"].to_list() == [False, True]
+        assert df["payment_date"].to_list() == ["2022-11-04", "2022-11-04"]
+        assert df["change_type"].to_list() == ["insert", "update"]
+        assert str(df["payment_amount"][0]) == "552548.6200000000"
+
+    @pytest.mark.it("keeps nullable text columns as text")
+    def test_nullable(self):
+        csv = (
+            "counterparty_id,counterparty_legal_name,legal_address_id,commercial_contact,delivery_contact,created_at,last_updated\n"
+            "1,Fahey and Sons,15,,Myra Kovacek,2022-11-03 14:20:51.563,2022-11-03 14:20:51.563\n"
+            "2,Leannon Inc,28,1234,,2022-11-03 14:20:51.563,2022-11-03 14:20:51.563\n"
+        )
+        df = read_typed_csv(csv.encode(), "counterparty")
+        assert df["commercial_contact"].to_list() == [None, "1234"]
+
+    @pytest.mark.it("raises an exception when a value doesn't parse as its column's type")
+    def test_bad_value(self):
+        with pytest.raises(Exception, match="Failed to parse payment"):
+            read_typed_csv(self.payment.replace("552548.62", "lots").encode(), "payment")
+
+    @pytest.mark.it("raises an exception when a NOT NULL column has nulls")
+    def test_not_null(self):
+        with pytest.raises(Exception, match="payment_date"):
+            read_typed_csv(self.payment.replace("2022-11-04", "").encode(), "payment")
+
+    @pytest.mark.it("tables without a schema are read with inference")
+    def test_unknown_table(self):
+        df = read_typed_csv(b"a,b\n1,x\n", "not_a_table")
+        assert df.schema == {"a": pl.Int64, "b": pl.String}
+
+
+class TestReadRawParquet:
+
+    @pytest.mark.it("parquet files keep their types without being parsed")
+    def test_parquet(self, s3):
+        df = pl.DataFrame({'paid': [True, False], 'amount': [2.5, 3.75]})
+        buffer = BytesIO()
+        df.write_parquet(buffer)
+        s3.put_object(Body=buffer.getvalue(), Bucket='totesys-raw-data-000000', Key='test.parquet')
+        result = read_raw_parquet('test.parquet')
+        assert result == buffer.getvalue()
+        assert pl.read_parquet(BytesIO(result)).equals(df)
+
+    @pytest.mark.it("parquet file not found")
+    def test_parquet_not_found(self, s3):
+        assert read_raw_parquet('test.parquet') == "parquet file not found"
+
+    @pytest.mark.it("correct message shown when file is not type parquet")
+    def test_not_parquet(self, s3):
+        assert read_raw_parquet('test.csv') == "test.csv is not a .parquet file."
+
+
+class TestParquetOptions:
+
+    @pytest.mark.it("tables without a profile are written with the default one")
+    def test_default(self):
+        assert parquet_options("sales_order") == {
+            "compression": "zstd", "compression_level": 3, "row_group_size": 100000, "statistics": True,
+        }
+
+    @pytest.mark.it("an explicit profile overrides the table's")
+    def test_profile(self):
+        assert parquet_options("sales_order", "fast") == {"compression": "lz4", "row_group_size": 100000, "statistics": False}
+        with pytest.raises(Exception):
+            parquet_options("sales_order", "tiny")
+
+    @pytest.mark.it("a table's own settings only apply under the tables profile")
+    def test_tables_profile(self):
+        assert parquet_options("currency", "balanced") == parquet_options("sales_order")
+        assert parquet_options("currency", "tables") == parquet_options("currency")
+        assert parquet_options("currency")["pyarrow_options"] == {"use_dictionary": ["currency_code"]}
+        assert parquet_options("dim_design") == parquet_options(profile="compact")
+
+    @pytest.mark.it("only the listed columns are dictionary encoded")
+    def test_dictionary(self):
+        import pyarrow.parquet as pq
+
+        options = parquet_options("dim_currency")
+        assert options["pyarrow_options"] == {"use_dictionary": ["currency_code", "currency_name"]}
+        df = pl.DataFrame({"currency_id": [1, 2], "currency_code": ["GBP", "USD"], "currency_name": ["British Pound", "US Dollar"]})
+        buffer = BytesIO()
+        df.write_parquet(buffer, **options)
+        metadata = pq.ParquetFile(BytesIO(buffer.getvalue())).metadata.row_group(0)
+        assert ["RLE_DICTIONARY" in metadata.column(i).encodings for i in range(3)] == [False, True, True]
+        assert pl.read_parquet(BytesIO(buffer.getvalue())).equals(df)
+
+
+staff = pl.DataFrame({
+    "staff_id": [1, 2],
+    "first_name": ["Jeremie", "Deron"],
+    "last_name": ["Franey", "Beier"],
+    "department_id": [2, 6],
+    "email_address": ["jeremie.franey@terrifictotes.com", "deron.beier@terrifictotes.com"],
+    "created_at": ["2022-11-03 14:20:51.563", "2022-11-03 14:20:51.563"],
+    "last_updated": ["2022-11-03 14:20:51.563", "2022-11-03 14:20:51.563"],
+})
+department = pl.DataFrame({
+    "department_id": [2, 6],
+    "department_name": ["Purchasing", "Facilities"],
+    "location": ["Manchester", "Leeds"],
+    "manager": ["Naomi Lapaglia", "Shelley Levene"],
+})
+address = pl.DataFrame({
+    "address_id": [1],
+    "address_line_1": ["6826 Herzog Via"],
+    "address_line_2": [None],
+    "district": ["Avon"],
+    "city": ["New Patienceburgh"],
+    "postal_code": ["28441"],
+    "country": ["Turkey"],
+    "phone": ["1803 637401"],
+})
+sales_order = pl.DataFrame({
+    "sales_order_id": [2],
+    "created_at": ["2022-11-03 14:20:52.186"],
+    "last_updated": ["2022-11-04 09:10:00.000"],
+    "design_id": [3],
+    "staff_id": [19],
+    "counterparty_id": [8],
+    "units_sold": [42972],
+    "unit_price": [3.941],
+    "currency_id": [2],
+    "agreed_delivery_date": ["2022-11-07"],
+    "agreed_payment_date": ["2022-11-08"],
+    "agreed_delivery_location_id": [8],
+})
+
+
+class TestStarSchema:
+
+    @pytest.mark.it("dim_staff joins staff to their department")
+    def test_dim_staff(self):
+        result = build_star_table("dim_staff", {"staff": staff.lazy(), "department": department.lazy()}).collect()
+        assert result.to_dicts()[0] == {
+            "staff_id": 1,
+            "first_name": "Jeremie",
+            "last_name": "Franey",
+            "department_name": "Purchasing",
+            "location": "Manchester",
+            "email_address": "jeremie.franey@terrifictotes.com",
+        }
+
+    @pytest.mark.it("dim_counterparty takes its legal address from address")
+    def test_dim_counterparty(self):
+        counterparty = pl.DataFrame({
+            "counterparty_id": [1],
+            "counterparty_legal_name": ["Fahey and Sons"],
+            "legal_address_id": [1],
+            "commercial_contact": ["Micheal Toy"],
+        })
+        result = build_star_table(
+            "dim_counterparty", {"counterparty": counterparty.lazy(), "address": address.lazy()}
+        ).collect()
+        assert result.row(0, named=True)["counterparty_legal_city"] == "New Patienceburgh"
+        assert result.row(0, named=True)["counterparty_legal_phone_number"] == "1803 637401"
+        assert "commercial_contact" not in result.columns
+
+    @pytest.mark.it("dim_location renames address_id")
+    def test_dim_location(self):
+        result = build_star_table("dim_location", {"address": address.lazy()}).collect()
+        assert result.columns[0] == "location_id"
+        assert result["address_line_2"].to_list() == [None]
+
+    @pytest.mark.it("dim_currency adds the currency name")
+    def test_dim_currency(self):
+        currency = pl.DataFrame({"currency_id": [1, 2], "currency_code": ["GBP", "XYZ"]})
+        result = build_star_table("dim_currency", {"currency": currency.lazy()}).collect()
+        assert result["currency_name"].to_list() == ["British Pound", "XYZ"]
+
+    @pytest.mark.it("fact_sales_order splits timestamps into dates and times")
+    def test_fact_sales_order(self):
+        result = build_star_table("fact_sales_order", {"sales_order": sales_order.lazy()}).collect()
+        assert result.to_dicts() == [{
+            "sales_order_id": 2,
+            "created_date": date(2022, 11, 3),
+            "created_time": time(14, 20, 52, 186000),
+            "last_updated_date": date(2022, 11, 4),
+            "last_updated_time": time(9, 10),
+            "sales_staff_id": 19,
+            "counterparty_id": 8,
+            "units_sold": 42972,
+            "unit_price": 3.94,
+            "currency_id": 2,
+            "design_id": 3,
+            "agreed_payment_date": date(2022, 11, 8),
+            "agreed_delivery_date": date(2022, 11, 7),
+            "agreed_delivery_location_id": 8,
+            "version": 1,
+            "valid_from": datetime(2022, 11, 4, 9, 10),
+            "valid_to": None,
+            "is_deleted": False,
+        }]
+
+    @pytest.mark.it("fact_sales_order accepts already typed parquet extracts")
+    def test_fact_sales_order_typed(self):
+        typed = sales_order.with_columns(
+            pl.col("created_at").str.to_datetime(), pl.col("last_updated").str.to_datetime()
+        )
+        result = build_star_table("fact_sales_order", {"sales_order": typed.lazy()}).collect()
+        assert result["created_time"].to_list() == [time(14, 20, 52, 186000)]
+
+    @pytest.mark.it("dim_date has one row per day of every year a sales order uses")
+    def test_dim_date(self):
+        result = build_star_table("dim_date", {"sales_order": sales_order.lazy()}).collect()
+        assert result.height == 365
+        assert result["date_id"].is_sorted()
+        assert result["date_id"].to_list()[0] == date(2022, 1, 1)
+        assert result.filter(pl.col("date_id") == date(2022, 11, 3)).row(0, named=True) == {
+            "date_id": date(2022, 11, 3),
+            "year": 2022,
+            "month": 11,
+            "day": 3,
+            "day_of_week": 4,
+            "day_name": "Thursday",
+            "month_name": "November",
+            "quarter": 4,
+        }
+
+    @pytest.mark.it("dim_date only builds the days missing from the cached range")
+    def test_dim_date_extends_cached_range(self):
+        later_order = sales_order.with_columns(
+            pl.lit("2024-02-29 10:00:00.000").alias("created_at"),
+            pl.lit("2024-03-01").alias("agreed_delivery_date"),
+        )
+        result = build_star_table(
+            "dim_date", {"sales_order": later_order.lazy()}, cached_range=(date(2022, 1, 1), date(2022, 12, 31))
+        ).collect()
+        assert result["date_id"].min() == date(2023, 1, 1)
+        assert result["date_id"].max() == date(2024, 12, 31)
+        assert result.height == 365 + 366
+
+    @pytest.mark.it("dim_date covers the dates of every fact, even when only some of their sources changed")
+    def test_dim_date_every_fact(self):
+        payment = pl.DataFrame({
+            "created_at": ["2022-11-03 14:20:52.186"],
+            "last_updated": ["2023-01-02 09:00:00.000"],
+            "payment_date": ["2024-02-29"],
+        })
+        purchase_order = pl.DataFrame({
+            "created_at": ["2021-06-01 10:00:00.000"],
+            "last_updated": ["2021-06-01 10:00:00.000"],
+            "agreed_delivery_date": ["2021-06-05"],
+            "agreed_payment_date": ["2021-06-07"],
+        })
+        result = build_star_table(
+            "dim_date", {"sales_order": sales_order.lazy(), "purchase_order": purchase_order.lazy(), "payment": payment.lazy()}
+        ).collect()
+        assert result["date_id"].min() == date(2021, 1, 1)
+        assert result["date_id"].max() == date(2024, 12, 31)
+
+        result = build_star_table("dim_date", {"payment": payment.lazy()}).collect()
+        assert result["date_id"].min() == date(2022, 1, 1)
+        assert result["date_id"].max() == date(2024, 12, 31)
+
+    @pytest.mark.it("dim_date is empty when every date is already cached")
+    def test_dim_date_nothing_to_extend(self):
+        result = build_star_table(
+            "dim_date", {"sales_order": sales_order.lazy()}, cached_range=(date(2022, 1, 1), date(2022, 12, 31))
+        ).collect()
+        assert result.is_empty()
+
+    @pytest.mark.it("only the columns in the spec are read from the sources")
+    def test_projection_pushdown(self):
+        plan = build_star_table("dim_staff", {"staff": staff.lazy(), "department": department.lazy()}).explain()
+        assert "5/7 COLUMNS" in plan
+        assert "3/4 COLUMNS" in plan
+
+
+class TestUpdateCurrentSnapshot:
+
+    @pytest.mark.it("keeps the latest version of each key and drops deleted keys")
+    def test_update_current_snapshot(self):
+        current = pl.DataFrame({
+            "department_id": [1, 2, 3],
+            "department_name": ["Sales", "Purchasing", "Dispatch"],
+            "last_updated": [datetime(2022, 11, 3)] * 3,
+        })
+        changes = pl.DataFrame({
+            "department_id": [2, 3, 4, 2],
+            "department_name": ["Buying", "Dispatch", "Finance", "Procurement"],
+            "last_updated": ["2022-11-04 00:00:00"] * 4,
+            "change_type": ["update", "delete", "insert", "update"],
+        })
+        result = update_current_snapshot(current.lazy(), changes.lazy(), "department_id").collect()
+        assert result.sort("department_id")["department_name"].to_list() == ["Sales", "Procurement", "Finance"]
+        assert result.columns == ["department_id", "department_name", "last_updated"]
+
+    @pytest.mark.it("the first run's changes become the snapshot")
+    def test_first_snapshot(self):
+        result = update_current_snapshot(None, department.lazy(), "department_id").collect()
+        assert result.equals(department)
+
+
+class TestContentHashes:
+
+    @pytest.mark.it("content hash doesn't depend on row order")
+    def test_content_hash_ignores_order(self):
+        assert content_hash(department) == content_hash(department.reverse())
+
+    @pytest.mark.it("content hash changes when a value changes")
+    def test_content_hash_changes(self):
+        changed = department.with_columns(pl.lit("Leeds").alias("location"))
+        assert content_hash(department) != content_hash(changed)
+
+    @pytest.mark.it("changed rows are the inserted and updated rows")
+    def test_changed_rows(self):
+        new = pl.DataFrame({"currency_id": [1, 2, 3], "currency_code": ["GBP", "USD", "EUR"]})
+        old = pl.DataFrame({"currency_id": [1, 2], "currency_code": ["GBP", "CHF"]})
+        assert changed_rows(new, old)["currency_id"].to_list() == [2, 3]
+        assert changed_rows(new, None).equals(new)
+
+    @pytest.mark.it("hashes can be saved and read back")
+    def test_save_and_get_hashes(self, s3_processed):
+        assert get_hashes(s3_processed, "totesys-processed-data-000000") == {"raw": {}, "current": {}, "tables": {}}
+        hashes = {"raw": {"currency": "abc"}, "current": {}, "tables": {}}
+        save_hashes(s3_processed, "totesys-processed-data-000000", hashes)
+        assert get_hashes(s3_processed, "totesys-processed-data-000000") == hashes
+
+
+class TestFactHistory:
+
+    changes = pl.DataFrame({
+        "sales_order_id": [1, 2, 1, 1],
+        "last_updated": [
+            datetime(2022, 11, 5), datetime(2022, 11, 3), datetime(2022, 11, 3), datetime(2022, 11, 4)
+        ],
+        "units_sold": [30, 5, 10, 20],
+        "change_type": ["update", "insert", "insert", "update"],
+    })
+
+    @pytest.mark.it("changes to the same key in one batch are numbered in time order")
+    def test_versions_in_one_batch(self):
+        result = assign_versions(self.changes.lazy(), "sales_order_id").collect()
+        order_1 = result.filter(pl.col("sales_order_id") == 1)
+        assert order_1["units_sold"].to_list() == [10, 20, 30]
+        assert order_1["version"].to_list() == [1, 2, 3]
+        assert order_1["valid_to"].to_list() == [datetime(2022, 11, 4), datetime(2022, 11, 5), None]
+        assert result.filter(pl.col("sales_order_id") == 2)["version"].to_list() == [1]
+
+    @pytest.mark.it("version numbers carry on from previous runs")
+    def test_versions_carry_on(self):
+        previous = pl.LazyFrame({"sales_order_id": [1], "version": [4]})
+        result = assign_versions(self.changes.lazy(), "sales_order_id", previous_versions=previous).collect()
+        assert result.filter(pl.col("sales_order_id") == 1)["version"].to_list() == [5, 6, 7]
+        assert result.filter(pl.col("sales_order_id") == 2)["version"].to_list() == [1]
+
+    @pytest.mark.it("deletes are valid from the time of the run and come last")
+    def test_deletes(self):
+        changes = pl.DataFrame({
+            "sales_order_id": [1, 1],
+            "last_updated": [datetime(2022, 11, 3), datetime(2022, 11, 3)],
+            "change_type": ["delete", "update"],
+        })
+        result = assign_versions(changes.lazy(), "sales_order_id", deleted_at=datetime(2022, 11, 6)).collect()
+        assert result["is_deleted"].to_list() == [False, True]
+        assert result["valid_from"].to_list() == [datetime(2022, 11, 3), datetime(2022, 11, 6)]
+        assert result["valid_to"].to_list() == [datetime(2022, 11, 6), None]
+
+    @pytest.mark.it("latest versions keep the highest version of every key")
+    def test_latest_versions(self):
+        previous = pl.LazyFrame({"sales_order_id": [1, 3], "version": [4, 2]})
+        versions = assign_versions(self.changes.lazy(), "sales_order_id", previous_versions=previous)
+        result = latest_versions(previous, versions, "sales_order_id").collect().sort("sales_order_id")
+        assert result.rows() == [(1, 7), (2, 1), (3, 2)]
+
+    @pytest.mark.it("incremental changes get their change type from created_at")
+    def test_fact_without_change_type(self):
+        updated = pl.concat([
+            sales_order,
+            sales_order.with_columns(pl.lit("2022-11-05 09:10:00.000").alias("last_updated"), pl.lit(1, dtype=pl.Int64).alias("units_sold")),
+        ])
+        result = build_star_table("fact_sales_order", {"sales_order": updated.lazy()}).collect()
+        assert result["version"].to_list() == [1, 2]
+        assert result["units_sold"].to_list() == [42972, 1]
+
+
+class TestProcessedLayout:
+
+    bucket = "totesys-processed-data-000000"
+
+    def write_run(self, s3, manifest, prefix, df):
+        key = processed_key("currency", prefix)
+        add_to_manifest(manifest, manifest_entry(df, key, write_parquet_to_bucket(df, s3, self.bucket, key)))
+
+    @pytest.mark.it("processed files are partitioned by table and day with sortable names")
+    def test_processed_key(self):
+        assert processed_key("sales_order", "2024_08_05_09:03:07") == (
+            "/history/table=sales_order/date=2024-08-05/20240805T090307.parquet"
+        )
+        assert processed_key("sales_order", "2024_8_5_09:03:07") == processed_key("sales_order", "2024_08_05_09:03:07")
+        assert processed_key("sales_order", "2024_08_05_09:03:07") < processed_key("sales_order", "2024_08_05_10:00:00")
+
+    @pytest.mark.it("manifest entries record rows, bytes and the range of updates")
+    def test_manifest_entry(self):
+        df = pl.DataFrame({"currency_id": [1, 2], "last_updated": ["2022-11-04 14:20:49", "2022-11-03 14:20:49"]})
+        entry = manifest_entry(df, processed_key("currency", "2024_08_05_09:03:07"), 100)
+
+        assert entry["date"] == "2024-08-05"
+        assert (entry["rows"], entry["bytes"]) == (2, 100)
+        assert (entry["min_last_updated"], entry["max_last_updated"]) == ("2022-11-03 14:20:49", "2022-11-04 14:20:49")
+        assert manifest_entry(df.drop("last_updated"), entry["key"], 100)["min_last_updated"] is None
+
+    @pytest.mark.it("manifest can be saved and read back, and retried runs replace their entry")
+    def test_save_and_get_manifest(self, s3_processed):
+        manifest = get_manifest(s3_processed, self.bucket, "currency")
+        assert manifest == {"files": []}
+
+        entry = {"key": "b", "date": "2024-08-05", "rows": 1, "bytes": 10}
+        add_to_manifest(manifest, entry)
+        add_to_manifest(manifest, {"key": "a", "date": "2024-08-05", "rows": 1, "bytes": 10})
+        add_to_manifest(manifest, {**entry, "rows": 2})
+        save_manifest(s3_processed, self.bucket, "currency", manifest)
+
+        files = get_manifest(s3_processed, self.bucket, "currency")["files"]
+        assert [(file["key"], file["rows"]) for file in files] == [("a", 1), ("b", 2)]
+
+    @pytest.mark.it("only small files of days before the current one are grouped for compaction")
+    def test_compaction_groups(self):
+        files = [
+            {"key": "1", "date": "2024-08-04", "bytes": 40},
+            {"key": "2", "date": "2024-08-04", "bytes": 40},
+            {"key": "3", "date": "2024-08-04", "bytes": 40},
+            {"key": "4", "date": "2024-08-04", "bytes": 500},
+            {"key": "5", "date": "2024-08-04", "bytes": 10},
+            {"key": "6", "date": "2024-08-05", "bytes": 10},
+            {"key": "7", "date": "2024-08-06", "bytes": 10},
+            {"key": "8", "date": "2024-08-06", "bytes": 10},
+        ]
+        groups = compaction_groups(files, "2024-08-06", target_bytes=100)
+        assert [[file["key"] for file in group] for group in groups] == [["1", "2"]]
+
+    @pytest.mark.it("compaction merges a closed day's files and updates the manifest")
+    def test_compact_files(self, s3_processed):
+        manifest = {"files": []}
+        for prefix, currency_id in [("2024_08_05_09:00:00", 1), ("2024_08_05_09:20:00", 2), ("2024_08_06_09:00:00", 3)]:
+            df = pl.DataFrame({"currency_id": [currency_id], "last_updated": [f"2022-11-0{currency_id} 14:20:49"]})
+            self.write_run(s3_processed, manifest, prefix, df)
+        save_manifest(s3_processed, self.bucket, "currency", manifest)
+
+        assert compact_files(s3_processed, self.bucket, "currency", "2024-08-06") == 2
+
+        saved = get_manifest(s3_processed, self.bucket, "currency")
+        assert [file["key"] for file in saved["files"]][1:] == [manifest["files"][2]["key"]]
+        merged = saved["files"][0]
+        assert merged["key"] == "/history/table=currency/date=2024-08-05/20240805T090000-20240805T092000.parquet"
+        assert (merged["rows"], merged["min_last_updated"], merged["max_last_updated"]) == (
+            2, "2022-11-01 14:20:49", "2022-11-02 14:20:49"
+        )
+        keys = [obj["Key"] for obj in s3_processed.list_objects(Bucket=self.bucket, Prefix="/history/")["Contents"]]
+        assert sorted(keys) == sorted([file["key"] for file in saved["files"]] + ["/history/table=currency/_manifest.json"])
+        df = pl.read_parquet(BytesIO(s3_processed.get_object(Bucket=self.bucket, Key=merged["key"])["Body"].read()))
+        assert df["currency_id"].to_list() == [1, 2]
+
+    @pytest.mark.it("merged files keep every column, filled with nulls where a file lacks it")
+    def test_merge_parquet_files(self, s3_processed):
+        import pyarrow.parquet as pq
+
+        write_parquet_to_bucket(pl.DataFrame({"currency_id": [1]}), s3_processed, self.bucket, "a.parquet")
+        write_parquet_to_bucket(
+            pl.DataFrame({"currency_id": [2], "currency_code": ["GBP"]}), s3_processed, self.bucket, "b.parquet"
+        )
+
+        parquet_bytes = merge_parquet_files(s3_processed, self.bucket, ["a.parquet", "b.parquet"], "merged.parquet")
+
+        body = s3_processed.get_object(Bucket=self.bucket, Key="merged.parquet")["Body"].read()
+        assert parquet_bytes == len(body)
+        df = pl.read_parquet(BytesIO(body))
+        assert df.to_dicts() == [
+            {"currency_id": 1, "currency_code": None},
+            {"currency_id": 2, "currency_code": "GBP"},
+        ]
+        assert pq.ParquetFile(BytesIO(body)).metadata.num_row_groups == 1
+
+    @pytest.mark.it("nothing is compacted while a day is still being written")
+    def test_nothing_to_compact(self, s3_processed):
+        manifest = {"files": []}
+        for prefix in ["2024_08_06_09:00:00", "2024_08_06_09:20:00"]:
+            self.write_run(s3_processed, manifest, prefix, pl.DataFrame({"currency_id": [1]}))
+        save_manifest(s3_processed, self.bucket, "currency", manifest)
+
+        assert compact_files(s3_processed, self.bucket, "currency", "2024-08-06") == 0
+        assert get_manifest(s3_processed, self.bucket, "currency") == manifest
+
+    @pytest.mark.it("files the transform adds while a compaction runs stay in the manifest")
+    def test_compaction_keeps_new_files(self, s3_processed, monkeypatch):
+        manifest = {"files": []}
+        for prefix in ["2024_08_05_09:00:00", "2024_08_05_09:20:00"]:
+            self.write_run(s3_processed, manifest, prefix, pl.DataFrame({"currency_id": [1]}))
+        save_manifest(s3_processed, self.bucket, "currency", manifest)
+
+        def write_during_compaction(client, bucket, keys, key):
+            transformed = get_manifest(client, bucket, "currency")
+            self.write_run(client, transformed, "2024_08_06_09:00:00", pl.DataFrame({"currency_id": [2]}))
+            save_manifest(client, bucket, "currency", transformed)
+            return merge_parquet_files(client, bucket, keys, key)
+
+        monkeypatch.setattr("src.utils.transform_utils.merge_parquet_files", write_during_compaction)
+        assert compact_files(s3_processed, self.bucket, "currency", "2024-08-06") == 2
+
+        assert [file["key"] for file in get_manifest(s3_processed, self.bucket, "currency")["files"]] == [
+            "/history/table=currency/date=2024-08-05/20240805T090000-20240805T092000.parquet",
+            "/history/table=currency/date=2024-08-06/20240806T090000.parquet",
+        ]